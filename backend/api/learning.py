@@ -11,7 +11,6 @@ from backend.models.material import Material
 from backend.models.assessment import Assessment, StudentAnswer, AssessmentSubmission
 import hashlib
 import requests
-import openai
 import re
 from dotenv import load_dotenv
 import time
@@ -1673,13 +1672,11 @@ def ai_grade_question(submission_id):
             return jsonify({'error': 'API密钥未配置'}), 500
         
         # 设置API客户端
-        if api_base:
-            client = openai.OpenAI(api_key=api_key, base_url=api_base)
-        else:
-            client = openai.OpenAI(api_key=api_key)
+        from backend.rag.llm_gateway import get_llm_client
+        client = get_llm_client(api_key, api_base)
         
         # 调用AI API
-        response = client.chat.completions.create(
+        response = client.complete(
             model=model_name or "gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "你是一位专业的教育评分助手，根据题目和参考答案为学生答案打分。"},
@@ -1771,10 +1768,8 @@ def ai_grade_all_subjective(submission_id):
             return jsonify({'error': 'API密钥未配置'}), 500
         
         # 设置API客户端
-        if api_base:
-            client = openai.OpenAI(api_key=api_key, base_url=api_base)
-        else:
-            client = openai.OpenAI(api_key=api_key)
+        from backend.rag.llm_gateway import get_llm_client
+        client = get_llm_client(api_key, api_base)
             
         # 对每个主观题进行评分
         for question_data in questions_data:
@@ -1808,7 +1803,7 @@ def ai_grade_all_subjective(submission_id):
             """
             
             # 调用AI API
-            response = client.chat.completions.create(
+            response = client.complete(
                 model=model_name or "gpt-3.5-turbo",
                 messages=[
                     {"role": "system", "content": "你是一位专业的教育评分助手，根据题目和参考答案为学生答案打分。"},
@@ -2704,10 +2699,8 @@ def generate_assessment_with_ai(course_name, course_description, extra_info='',
         raise ValueError("API密钥未配置，请在环境变量中设置LLM_API_KEY或OPENAI_API_KEY")
     
     # 设置API客户端
-    if api_base:
-        client = openai.OpenAI(api_key=api_key, base_url=api_base)
-    else:
-        client = openai.OpenAI(api_key=api_key)
+    from backend.rag.llm_gateway import get_llm_client
+    client = get_llm_client(api_key, api_base)
     
     current_app.logger.info(f"使用模型 {model_name} 生成评估内容")
     
@@ -2775,7 +2768,7 @@ def generate_assessment_with_ai(course_name, course_description, extra_info='',
     
     # 调用AI API生成内容
     try:
-        response = client.chat.completions.create(
+        response = client.complete(
             model=model_name,
             messages=[
                 {"role": "system", "content": "你是一个专业的教育内容创建者，擅长根据课程信息生成高质量的测验和考试题目。"},
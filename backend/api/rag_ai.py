@@ -2,7 +2,6 @@ from flask import Blueprint, request, jsonify, current_app, Response, stream_wit
 from flask_jwt_extended import jwt_required, get_jwt_identity
 import os
 import time
-import requests
 import json
 import sys
 import logging
@@ -150,10 +149,24 @@ def get_module_status_api():
     ai_status = "可用" if (api_key and api_base) else "未配置"
     logger.info(f"AI API状态: {ai_status}")
     
+    # 语义答案缓存的命中率和LLM调用指标
+    answer_cache_stats = None
+    llm_stats = None
+    if RAG_AVAILABLE:
+        try:
+            from backend.rag.semantic_cache import answer_cache
+            from backend.rag.llm_gateway import get_llm_gateway
+            answer_cache_stats = answer_cache.stats()
+            llm_stats = get_llm_gateway().stats()
+        except Exception as e:
+            logger.warning(f"获取答案缓存统计失败: {str(e)}")
+    
     return jsonify({
         'status': 'success',
         'rag_enabled': RAG_AVAILABLE,  # 根据是否成功导入RAG模块来确定
         'ai_enabled': bool(api_key and api_base),
+        'answer_cache': answer_cache_stats,
+        'llm': llm_stats,
         'message': '模块状态获取成功'
     })
 
@@ -184,13 +197,16 @@ def chat_with_ai():
     conversation_id = data.get('conversation_id')  # 可选参数
     stream = data.get('stream', False)  # 是否使用流式输出，默认为False
     use_rag = data.get('use_rag', True)  # 是否使用RAG，默认为True
+    use_cache = data.get('use_cache', True)  # 是否使用语义答案缓存，默认为True
     
-    # 对于GET请求，将stream和use_rag参数转换为布尔值
+    # 对于GET请求，将stream、use_rag和use_cache参数转换为布尔值
     if request.method == 'GET':
         if stream == 'true':
             stream = True
         if use_rag == 'false':
             use_rag = False
+        if use_cache == 'false':
+            use_cache = False
     
     if not message:
         return jsonify({'status': 'error', 'message': '消息不能为空'}), 400
@@ -241,11 +257,53 @@ def chat_with_ai():
         db.session.add(user_chat)
         db.session.commit()
         
-        # 准备API请求头
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
+        # 语义答案缓存：同一课程中相似的单轮问题直接返回已保存的回答
+        answer_cache = None
+        cache_answer = False
+        if use_rag and course_id:
+            try:
+                from backend.rag.semantic_cache import answer_cache
+            except Exception as e:
+                app_logger.warning(f"答案缓存不可用: {str(e)}")
+        if answer_cache is not None:
+            if use_cache and len(history) == 1:
+                cache_answer = True
+                cached = answer_cache.lookup(str(course_id), message, model_name)
+                if cached:
+                    ai_response = cached['answer']
+                    sources = cached['sources']
+                    ai_chat = ChatHistory(
+                        user_id=user_id,
+                        course_id=course_id,
+                        conversation_id=conversation_id,
+                        role='assistant',
+                        message=ai_response,
+                        timestamp=int(time.time())
+                    )
+                    db.session.add(ai_chat)
+                    db.session.commit()
+                    
+                    if stream:
+                        def generate_cached():
+                            yield f"data: {json.dumps({'content': ai_response})}\n\n"
+                            yield f"data: {json.dumps({'status': 'done', 'conversation_id': conversation_id, 'sources': sources, 'cached': True})}\n\n"
+                        return Response(stream_with_context(generate_cached()), content_type='text/event-stream')
+                    
+                    return jsonify({
+                        'status': 'success',
+                        'response': {
+                            'content': ai_response,
+                            'sources': sources,
+                            'conversation_id': conversation_id,
+                            'cached': True
+                        }
+                    })
+            else:
+                answer_cache.record_bypass()
+        
+        # 共享连接池、限流和重试的LLM客户端
+        from backend.rag.llm_gateway import get_llm_client
+        llm = get_llm_client(api_key, api_base)
         
         # 判断是否使用RAG
         retrieved_docs = []
@@ -334,14 +392,15 @@ def chat_with_ai():
                                     page_num = doc.metadata['page']
                                     source_info += f"第{page_num+1}页" if isinstance(page_num, int) else f"第{page_num}页"
                                 
-                                if 'chunk_id' in doc.metadata and doc.metadata['chunk_id']:
-                                    chunk_id = doc.metadata['chunk_id']
-                                    if chunk_id.startswith('chunk_'):
-                                        chunk_num = chunk_id[6:]
-                                        if source_info:
-                                            source_info += f", 片段{chunk_num}"
-                                        else:
-                                            source_info += f"片段{chunk_num}"
+                                chunk_num = doc.metadata.get('chunk_index')
+                                if chunk_num is None and str(doc.metadata.get('chunk_id', '')).startswith('chunk_'):
+                                    # 兼容旧格式的块ID
+                                    chunk_num = doc.metadata['chunk_id'][6:]
+                                if chunk_num is not None:
+                                    if source_info:
+                                        source_info += f", 片段{chunk_num}"
+                                    else:
+                                        source_info += f"片段{chunk_num}"
                                 
                                 # 如果有额外信息，添加到标题中
                                 if source_info:
@@ -399,6 +458,9 @@ def chat_with_ai():
                 app_logger.warning("RAG模块不可用，回退到普通对话")
                 use_rag = False
         
+        # 只缓存基于检索资料生成的回答
+        cache_answer = cache_answer and use_rag and RAG_AVAILABLE and bool(retrieved_docs)
+        
         # 如果不使用RAG或RAG检索失败
         if not use_rag or not RAG_AVAILABLE or not course_id:
             # 准备普通对话的API请求体
@@ -425,42 +487,16 @@ def chat_with_ai():
         # 如果请求流式输出
         if stream:
             def generate():
-                # 流式请求
-                with requests.post(
-                    f"{api_base}/chat/completions",  # 直接使用API基础URL，不添加额外路径前缀
-                    headers=headers,
-                    json=payload,
-                    stream=True,
-                    timeout=120  # 增加超时时间到120秒
-                ) as response:
-                    
-                    if response.status_code != 200:
-                        yield f"data: {json.dumps({'status': 'error', 'message': f'API调用失败: {response.text}'})}\n\n"
-                        return
-                    
-                    # 初始化变量，用于收集完整的回复
-                    full_response = ""
-                    
-                    # 处理流式响应
-                    for line in response.iter_lines():
-                        if line:
-                            line_text = line.decode('utf-8')
-                            if line_text.startswith('data: '):
-                                line_json = line_text[6:]  # 移除 'data: ' 前缀
-                                if line_json.strip() == '[DONE]':
-                                    break
-                                
-                                try:
-                                    chunk = json.loads(line_json)
-                                    if 'choices' in chunk and len(chunk['choices']) > 0:
-                                        if 'delta' in chunk['choices'][0] and 'content' in chunk['choices'][0]['delta']:
-                                            content = chunk['choices'][0]['delta']['content']
-                                            if content:
-                                                full_response += content
-                                                # 发送数据到客户端
-                                                yield f"data: {json.dumps({'content': content})}\n\n"
-                                except json.JSONDecodeError:
-                                    continue
+                # 初始化变量，用于收集完整的回复
+                full_response = ""
+                try:
+                    for content in llm.stream(**payload):
+                        full_response += content
+                        # 发送数据到客户端
+                        yield f"data: {json.dumps({'content': content})}\n\n"
+                except Exception as e:
+                    yield f"data: {json.dumps({'status': 'error', 'message': f'API调用失败: {str(e)}'})}\n\n"
+                    return
                 
                 # 流式响应结束后，保存完整回复到数据库
                 ai_response = full_response.lstrip()
@@ -475,6 +511,9 @@ def chat_with_ai():
                 db.session.add(ai_chat)
                 db.session.commit()
                 
+                if cache_answer:
+                    answer_cache.store(str(course_id), message, model_name, ai_response, sources)
+                
                 # 发送结束信号，包含引用源
                 yield f"data: {json.dumps({'status': 'done', 'conversation_id': conversation_id, 'sources': sources})}\n\n"
             
@@ -483,23 +522,13 @@ def chat_with_ai():
         # 非流式请求
         else:
             # 发送请求
-            response = requests.post(
-                f"{api_base}/chat/completions", 
-                headers=headers, 
-                json=payload,
-                timeout=60  # 设置超时时间
-            )
-            
-            # 检查响应
-            if response.status_code != 200:
+            try:
+                ai_response = llm.chat(**payload)
+            except Exception as e:
                 return jsonify({
                     'status': 'error',
-                    'message': f'API调用失败: {response.text}'
+                    'message': f'API调用失败: {str(e)}'
                 }), 500
-                
-            # 解析响应
-            result = response.json()
-            ai_response = result["choices"][0]["message"]["content"]
             
             # 去除开头的空行
             ai_response = ai_response.lstrip()
@@ -516,6 +545,9 @@ def chat_with_ai():
             db.session.add(ai_chat)
             db.session.commit()
             
+            if cache_answer:
+                answer_cache.store(str(course_id), message, model_name, ai_response, sources)
+            
             return jsonify({
                 'status': 'success',
                 'response': {
@@ -741,11 +773,13 @@ def add_to_knowledge_base():
             existing_file.progress = 0.0
             existing_file.error_message = None
             existing_file.completed_at = None
+            existing_file.attempts = 0
+            existing_file.available_at = 0
             existing_file.purpose = purpose  # 更新用途
             db.session.commit()
             
             # Start processing in background
-            start_processing_queue_item(existing_file.id)
+            start_processing_queue_item(existing_file.id, course_id=existing_file.course_id)
             
             return jsonify({
                 'status': 'success',
@@ -774,7 +808,7 @@ def add_to_knowledge_base():
     db.session.commit()
     
     # Start processing in background
-    start_processing_queue_item(queue_item.id)
+    start_processing_queue_item(queue_item.id, course_id=queue_item.course_id)
     
     return jsonify({
         'status': 'success',
@@ -1256,6 +1290,16 @@ def generate_lesson_plan():
 4. 不要在输出内容的开头或结尾添加```markdown或```标记
 """
 
+        # 课程核心概念（保存知识图谱时预先计算，直接读取）
+        if use_knowledge_base and course_id:
+            try:
+                from backend.rag.graph_analytics import format_key_concepts
+                key_concepts = format_key_concepts(str(course_id))
+                if key_concepts:
+                    system_prompt += f"\n\n本课程资料中的核心概念（按重要性排序）：{key_concepts}"
+            except Exception as e:
+                app_logger.warning(f"读取课程核心概念失败: {str(e)}")
+
         # 如果有知识库内容，添加到提示词中
         if knowledge_context:
             system_prompt += f"\n\n请参考以下资料生成内容:\n{knowledge_context}"
@@ -1281,11 +1325,9 @@ def generate_lesson_plan():
 请提供结构化、专业的{'课程总纲' if outline_type == 'course' else '课堂教案'}，使用Markdown格式，包含清晰的标题、列表和合适的结构安排。
 """
 
-        # 准备API请求头
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
+        # 共享连接池、限流和重试的LLM客户端
+        from backend.rag.llm_gateway import LLMTimeoutError, get_llm_client
+        llm = get_llm_client(api_key, api_base)
         
         # 准备API请求体
         payload = {
@@ -1309,40 +1351,11 @@ def generate_lesson_plan():
             # 流式请求API
             full_response = ""
             try:
-                with requests.post(
-                    f"{api_base}/chat/completions",  # 直接使用API基础URL，不添加额外路径前缀
-                    headers=headers,
-                    json=payload,
-                    stream=True,
-                    timeout=120  # 增加超时时间到120秒
-                ) as response:
-                    
-                    if response.status_code != 200:
-                        error_msg = f"API请求失败: {response.status_code}, {response.text}"
-                        app_logger.error(error_msg)
-                        yield f"data: {json.dumps({'status': 'error', 'message': error_msg})}\n\n"
-                        return
-                    
-                    # 处理流式响应
-                    for line in response.iter_lines():
-                        if line:
-                            line_text = line.decode('utf-8')
-                            if line_text.startswith('data: '):
-                                line_json = line_text[6:]  # 移除 'data: ' 前缀
-                                if line_json.strip() == '[DONE]':
-                                    break
-                                
-                                try:
-                                    chunk = json.loads(line_json)
-                                    if 'choices' in chunk and len(chunk['choices']) > 0:
-                                        if 'delta' in chunk['choices'][0] and 'content' in chunk['choices'][0]['delta']:
-                                            content = chunk['choices'][0]['delta']['content']
-                                            if content:
-                                                full_response += content
-                                                # 发送数据到客户端
-                                                yield f"data: {json.dumps({'status': 'chunk', 'content': content})}\n\n"
-                                except json.JSONDecodeError:
-                                    continue
+                # 处理流式响应
+                for content in llm.stream(**payload):
+                    full_response += content
+                    # 发送数据到客户端
+                    yield f"data: {json.dumps({'status': 'chunk', 'content': content})}\n\n"
                 
                 # 保存用户请求到数据库
                 user_message = ChatHistory(
@@ -1370,7 +1383,7 @@ def generate_lesson_plan():
                 # 发送结束信号，包含引用源
                 yield f"data: {json.dumps({'status': 'done', 'conversation_id': conversation_id, 'outline_type': outline_type, 'selected_chapter': selected_chapter_title, 'sources': sources})}\n\n"
                 
-            except requests.exceptions.Timeout:
+            except LLMTimeoutError:
                 error_msg = "请求超时，请稍后再试"
                 app_logger.error(f"生成教案时出错: {error_msg}")
                 yield f"data: {json.dumps({'status': 'error', 'message': error_msg})}\n\n"
@@ -1514,12 +1527,11 @@ def process_temp_files():
                     app_logger.warning(f"不支持的文件类型: {ext}")
                     continue
                 
-                # 分割文档
-                from backend.rag.segmentor import segment_text
-                for doc in docs:
-                    # 对文本进行分段
-                    segments = segment_text(doc.page_content)
-                    
+                # 分割文档（批量分割，共享按配置缓存的分割器，长文本借用入库工作池的进程池）
+                from backend.rag.segmentor import segment_many
+                from backend.tasks.rag_processor import get_ingestion_pool
+                split_executor = get_ingestion_pool().split_executor
+                for segments in segment_many([doc.page_content for doc in docs], executor=split_executor):
                     # 添加到上下文
                     context += "\n\n" + "\n".join(segments)
                 
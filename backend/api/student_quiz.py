@@ -13,7 +13,6 @@ from backend.extensions import db
 from backend.api.learning import api_error_handler, generate_assessment_with_ai
 from backend.api.rag_ai import get_api_config
 import re
-import openai
 import difflib  # 用于计算文本相似度
 
 # 计算文本相似度的函数
@@ -23,6 +22,16 @@ def calculate_similarity(text1, text2):
 
 student_quiz_bp = Blueprint('student_quiz', __name__)
 
+def get_key_concepts_text(course_id):
+    """课程知识图谱预先计算的核心概念，用于出题提示词；没有知识图谱时返回空字符串"""
+    try:
+        from backend.rag.graph_analytics import format_key_concepts
+        key_concepts = format_key_concepts(str(course_id))
+    except Exception as e:
+        current_app.logger.warning(f"读取课程核心概念失败: {str(e)}")
+        return ""
+    return f"课程核心概念（可从中选取考查点）: {key_concepts}" if key_concepts else ""
+
 @student_quiz_bp.route('/student/quizzes/ai-generate', methods=['POST'])
 @api_error_handler
 def generate_student_quiz():
@@ -142,6 +151,7 @@ def generate_quiz_questions_incrementally(app, quiz_id, data, course):
             
             # 初始化问题列表
             questions = []
+            key_concepts_text = get_key_concepts_text(course.id)
             
             # 设置测验状态为进行中
             quiz.status = "generating"
@@ -165,6 +175,7 @@ def generate_quiz_questions_incrementally(app, quiz_id, data, course):
                         课程名称: {course.name}
                         课程描述: {course.description or ""}
                         难度级别: {difficulty}
+                        {key_concepts_text}
                         
                         请按照以下JSON格式返回题目内容，确保格式正确：
                         {{
@@ -206,13 +217,11 @@ def generate_quiz_questions_incrementally(app, quiz_id, data, course):
                             continue
                         
                         # 设置API客户端
-                        if api_base:
-                            client = openai.OpenAI(api_key=api_key, base_url=api_base)
-                        else:
-                            client = openai.OpenAI(api_key=api_key)
+                        from backend.rag.llm_gateway import get_llm_client
+                        client = get_llm_client(api_key, api_base)
                         
                         # 调用AI API
-                        response = client.chat.completions.create(
+                        response = client.complete(
                             model=model_name or "gpt-3.5-turbo",
                             messages=[
                                 {"role": "system", "content": "你是一个专业的教育内容创建者，擅长根据课程信息生成高质量的测验题目。"},
@@ -331,6 +340,7 @@ def generate_student_quiz_incremental():
         # 获取配置
         difficulty = data.get('difficulty', 'medium')
         question_types = data.get('question_types', [])
+        key_concepts_text = get_key_concepts_text(course_id)
         
         # 如果有题型配置，尝试生成第一道题
         if question_types:
@@ -345,6 +355,7 @@ def generate_student_quiz_incremental():
             课程名称: {course_name}
             课程描述: {course_description}
             难度级别: {difficulty}
+            {key_concepts_text}
             """
             
             # 如果有题目侧重点，添加到提示中
@@ -396,13 +407,11 @@ def generate_student_quiz_incremental():
             
             if api_key:
                 # 设置API客户端
-                if api_base:
-                    client = openai.OpenAI(api_key=api_key, base_url=api_base)
-                else:
-                    client = openai.OpenAI(api_key=api_key)
+                from backend.rag.llm_gateway import get_llm_client
+                client = get_llm_client(api_key, api_base)
                 
                 # 调用AI API
-                response = client.chat.completions.create(
+                response = client.complete(
                     model=model_name or "gpt-3.5-turbo",
                     messages=[
                         {"role": "system", "content": "你是一个专业的教育内容创建者，擅长根据课程信息生成高质量的测验题目。"},
@@ -476,6 +485,7 @@ def generate_student_quiz_incremental():
                 
                 course_name = course_obj.name
                 course_description = course_obj.description or ""
+                key_concepts_text = get_key_concepts_text(course_id)
                 
                 # 获取已生成的题目
                 existing_questions = []
@@ -517,6 +527,7 @@ def generate_student_quiz_incremental():
                             课程名称: {course_name}
                             课程描述: {course_description}
                             难度级别: {difficulty}
+                            {key_concepts_text}
                             """
                             
                             # 如果有题目侧重点，添加到提示中
@@ -571,13 +582,11 @@ def generate_student_quiz_incremental():
                                 continue
                             
                             # 设置API客户端
-                            if api_base:
-                                client = openai.OpenAI(api_key=api_key, base_url=api_base)
-                            else:
-                                client = openai.OpenAI(api_key=api_key)
+                            from backend.rag.llm_gateway import get_llm_client
+                            client = get_llm_client(api_key, api_base)
                             
                             # 调用AI API
-                            response = client.chat.completions.create(
+                            response = client.complete(
                                 model=model_name or "gpt-3.5-turbo",
                                 messages=[
                                     {"role": "system", "content": "你是一个专业的教育内容创建者，擅长根据课程信息生成高质量的测验题目。"},
@@ -849,10 +858,8 @@ def submit_quiz_answers(quiz_id):
                                         feedback = f"回答错误，正确答案是: {correct_answer}"
                             else:
                                 # 设置API客户端
-                                if api_base:
-                                    client = openai.OpenAI(api_key=api_key, base_url=api_base)
-                                else:
-                                    client = openai.OpenAI(api_key=api_key)
+                                from backend.rag.llm_gateway import get_llm_client
+                                client = get_llm_client(api_key, api_base)
                                 
                                 # 构建评分提示
                                 prompt = f"""
@@ -880,7 +887,7 @@ def submit_quiz_answers(quiz_id):
                                 """
                                 
                                 # 调用AI API
-                                response = client.chat.completions.create(
+                                response = client.complete(
                                     model=model_name or "gpt-3.5-turbo",
                                     messages=[
                                         {"role": "system", "content": "你是一个专业的教育评分助手，擅长灵活评价填空题答案。"},
@@ -947,10 +954,8 @@ def submit_quiz_answers(quiz_id):
                                 feedback = "无法进行AI评分，给予默认分数"
                             else:
                                 # 设置API客户端
-                                if api_base:
-                                    client = openai.OpenAI(api_key=api_key, base_url=api_base)
-                                else:
-                                    client = openai.OpenAI(api_key=api_key)
+                                from backend.rag.llm_gateway import get_llm_client
+                                client = get_llm_client(api_key, api_base)
                                 
                                 # 构建评分提示
                                 reference_answer = question.get('reference_answer', '') or question.get('explanation', '')
@@ -985,7 +990,7 @@ def submit_quiz_answers(quiz_id):
                                 """
                                 
                                 # 调用AI API
-                                response = client.chat.completions.create(
+                                response = client.complete(
                                     model=model_name or "gpt-3.5-turbo",
                                     messages=[
                                         {"role": "system", "content": "你是一个专业的教育评分助手，擅长公平客观地评价学生回答。"},
@@ -1059,10 +1064,8 @@ def submit_quiz_answers(quiz_id):
                         overall_feedback = basic_feedback
                     else:
                         # 设置API客户端
-                        if api_base:
-                            client = openai.OpenAI(api_key=api_key, base_url=api_base)
-                        else:
-                            client = openai.OpenAI(api_key=api_key)
+                        from backend.rag.llm_gateway import get_llm_client
+                        client = get_llm_client(api_key, api_base)
                         
                         # 准备题目和答案的摘要
                         question_summary = []
@@ -1106,7 +1109,7 @@ def submit_quiz_answers(quiz_id):
                         """
                         
                         # 调用AI API
-                        response = client.chat.completions.create(
+                        response = client.complete(
                             model=model_name or "gpt-3.5-turbo",
                             messages=[
                                 {"role": "system", "content": "你是一个专业的教育顾问，擅长根据学生的测验结果提供有针对性的学习建议。"},
@@ -1248,10 +1251,8 @@ def generate_learning_advice(quiz_obj, questions, answers, question_scores, ques
             return get_basic_feedback(percentage)
         
         # 设置API客户端
-        if api_base:
-            client = openai.OpenAI(api_key=api_key, base_url=api_base)
-        else:
-            client = openai.OpenAI(api_key=api_key)
+        from backend.rag.llm_gateway import get_llm_client
+        client = get_llm_client(api_key, api_base)
         
         # 获取课程信息
         course = Course.query.get(quiz_obj.course_id)
@@ -1320,7 +1321,7 @@ def generate_learning_advice(quiz_obj, questions, answers, question_scores, ques
         """
         
         # 调用AI API
-        response = client.chat.completions.create(
+        response = client.complete(
             model=model_name or "gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "你是一个专业的教育顾问，擅长根据学生的测验结果提供有针对性的学习建议。"},
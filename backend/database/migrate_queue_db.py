@@ -16,7 +16,7 @@ project_root = os.path.dirname(current_dir)
 db_path = os.path.join(current_dir, 'eduNova.sqlite')  # 使用eduNova.sqlite文件
 
 def migrate_knowledge_base_queue():
-    """为KnowledgeBaseQueue表添加file_hash和purpose字段"""
+    """为KnowledgeBaseQueue表添加file_hash、purpose及任务队列字段"""
     print(f"正在迁移数据库: {db_path}")
     
     if not os.path.exists(db_path):
@@ -52,6 +52,21 @@ def migrate_knowledge_base_queue():
         else:
             print("purpose列已存在")
         
+        # 任务队列的租约与重试字段
+        job_columns = {
+            'attempts': "INTEGER DEFAULT 0",
+            'lease_owner': "TEXT",
+            'lease_expires_at': "INTEGER",
+            'available_at': "INTEGER DEFAULT 0",
+        }
+        for name, definition in job_columns.items():
+            if name not in columns:
+                print(f"添加{name}列...")
+                cursor.execute(f"ALTER TABLE knowledge_base_queue ADD COLUMN {name} {definition}")
+            else:
+                print(f"{name}列已存在")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_knowledge_base_queue_status_available ON knowledge_base_queue(status, available_at)")
+        
         conn.commit()
         print("迁移完成!")
         return True
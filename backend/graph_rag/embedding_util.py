@@ -6,6 +6,8 @@ import logging
 from typing import List, Union, Dict, Any
 from dotenv import load_dotenv
 
+from backend.rag.embedding_cache import get_embedding_cache
+
 # 设置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,6 +20,14 @@ rag_env_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__fi
 if os.path.exists(rag_env_path):
     load_dotenv(rag_env_path)  # If exists, load from RAG/.env
 
+def _build_result(vectors: List[List[float]], embedding_model: str, usage: Dict[str, Any] = None) -> Dict[str, Any]:
+    """按API响应格式组装embedding结果"""
+    return {
+        "data": [{"embedding": vector, "index": i} for i, vector in enumerate(vectors)],
+        "model": embedding_model,
+        "usage": usage or {"prompt_tokens": 0, "total_tokens": 0}
+    }
+
 def get_embedding(texts: Union[str, List[str]], max_retries: int = 3) -> Dict[str, Any]:
     """
     Get embeddings for text or list of texts using the Silicon Flow API.
@@ -28,6 +38,8 @@ def get_embedding(texts: Union[str, List[str]], max_retries: int = 3) -> Dict[st
         
     Returns:
         Dictionary containing the embedding results
+        
+    已缓存的文本直接从持久化向量缓存返回，只有未命中的文本会请求API。
     """
     # 使用Silicon Flow API配置
     api_key = os.getenv("LLM_API_KEY")
@@ -52,6 +64,18 @@ def get_embedding(texts: Union[str, List[str]], max_retries: int = 3) -> Dict[st
             "usage": {"prompt_tokens": 0, "total_tokens": 0}
         }
     
+    # 先查询持久化向量缓存，全部命中时不请求API
+    cache = get_embedding_cache()
+    cached = [None] * len(texts)
+    if cache:
+        try:
+            cached = cache.get_many(embedding_model, texts)
+        except Exception as e:
+            logger.error(f"查询向量缓存失败: {e}")
+    if all(vector is not None for vector in cached):
+        return _build_result(cached, embedding_model)
+    texts = [text for text, vector in zip(texts, cached) if vector is None]
+    
     # Prepare headers
     headers = {
         "Content-Type": "application/json",
@@ -108,7 +132,17 @@ def get_embedding(texts: Union[str, List[str]], max_retries: int = 3) -> Dict[st
                     raise Exception(f"API响应格式错误：第 {i} 个embedding维度不正确，期望1024，实际{len(embedding)}")
             
             logger.info(f"向量化成功: {len(result['data'])} 个embedding")
-            return result
+            
+            # 写入缓存并与命中的结果按原顺序合并
+            vectors = [item['embedding'] for item in result['data']]
+            if cache:
+                try:
+                    cache.put_many(embedding_model, texts, vectors)
+                except Exception as e:
+                    logger.error(f"写入向量缓存失败: {e}")
+            fetched = iter(vectors)
+            merged = [vector if vector is not None else next(fetched) for vector in cached]
+            return _build_result(merged, embedding_model, result.get("usage"))
             
         except requests.exceptions.Timeout:
             logger.error(f"API请求超时 (尝试 {attempt + 1}/{max_retries})")
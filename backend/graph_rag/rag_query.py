@@ -26,32 +26,31 @@ from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from langchain_openai import ChatOpenAI
 from langchain_core.documents import Document
-from backend.rag.embedding_util import get_embedding
+from backend.rag.embedding_engine import get_embedding_engine
 
 # 导入自定义的EmbeddingFunction，避免从create_db导入
 class EmbeddingFunction:
-    """Custom embedding function for use with Chroma."""
+    """Custom embedding function for use with Chroma.
+
+    与入库端共用同一个向量化引擎：批量并发请求、复用连接池，
+    查询向量使用进程内 LRU 缓存，重复的问题不再请求API。
+    """
     def __init__(self):
-        self.get_embedding = get_embedding
+        self.engine = get_embedding_engine()
         
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Embed a list of documents."""
-        embeddings = []
-        for text in texts:
-            try:
-                result = self.get_embedding(text)
-                embeddings.append(result["data"][0]["embedding"])
-            except Exception as e:
-                print(f"Error embedding document: {e}")
-                # 返回1024维零向量作为后备
-                embeddings.append([0.0] * 1024)
-        return embeddings
+        try:
+            return self.engine.embed(texts, placeholder_on_error=True)
+        except Exception as e:
+            print(f"Error embedding documents: {e}")
+            # 返回1024维零向量作为后备
+            return [[0.0] * 1024 for _ in texts]
 
     def embed_query(self, text: str) -> List[float]:
         """Embed a single query."""
         try:
-            result = self.get_embedding(text)
-            return result["data"][0]["embedding"]
+            return self.engine.embed_query(text)
         except Exception as e:
             print(f"Error embedding query: {e}")
             # 返回1024维零向量作为后备
@@ -216,6 +216,19 @@ def create_tables():
             db.session.commit()
             print("示例课程创建成功！")
 
+def start_background_workers(debug=False):
+    """启动知识库任务的后台调度（应在 create_tables 之后、app.run 之前调用）
+
+    调试模式的自动重载会先启动一个只负责监视文件的父进程，只在实际运行应用的子进程中启动。
+    """
+    if debug and os.environ.get('WERKZEUG_RUN_MAIN') != 'true':
+        return
+    from backend.tasks.rag_processor import start_job_dispatcher
+    from backend.rag.context_packer import preload_tokenizer
+    start_job_dispatcher()
+    # tiktoken 首次使用编码时需要下载，在启动时后台加载，避免第一个查询等待
+    preload_tokenizer()
+
 # 配置静态文件路由
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
@@ -253,6 +266,7 @@ def avatar_file(filename):
 
 if __name__ == '__main__':
     create_tables()
+    start_background_workers()
     # 打印所有注册的路由，方便排查 404 问题
     print('==== 所有注册的路由 ====')
     for rule in app.url_map.iter_rules():
@@ -75,6 +75,11 @@ class KnowledgeBaseQueue(db.Model):
     last_updated = db.Column(db.Integer, default=lambda: int(time.time()))
     file_hash = db.Column(db.String(64), nullable=True, index=True)  # SHA-256哈希值
     purpose = db.Column(db.String(20), default='general')  # general, lesson_plan, assessment, etc.
+    # 任务队列租约与重试（见 backend/tasks/job_queue.py）
+    attempts = db.Column(db.Integer, default=0)  # 已尝试处理的次数
+    lease_owner = db.Column(db.String(128), nullable=True)  # 当前持有租约的工作者
+    lease_expires_at = db.Column(db.Integer, nullable=True)  # 租约过期时间，过期后可被重新领取
+    available_at = db.Column(db.Integer, default=0)  # 重试任务最早可被领取的时间
     
     # Add relationship
     course = db.relationship('Course')
@@ -99,5 +104,6 @@ class KnowledgeBaseQueue(db.Model):
             'progress_detail': progress_detail_obj,
             'last_updated': self.last_updated,
             'file_hash': self.file_hash,
-            'purpose': self.purpose
+            'purpose': self.purpose,
+            'attempts': self.attempts or 0
         } 
\ No newline at end of file
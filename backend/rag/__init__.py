@@ -9,7 +9,7 @@ This module provides functionality for:
 
 # 导出主要函数
 from .rag_query import hybrid_retriever, initialize_resources, format_docs
-from .segmentor import segment_text
+from .segmentor import segment_text, segment_many, get_segmenter, Segmenter
 from .query_expansion import expand_query, multi_query_expansion
 
 # 避免循环导入，延迟导入
@@ -25,4 +25,4 @@ def get_query_expansion():
     from backend.rag.query_expansion import expand_query, multi_query_expansion
     return expand_query, multi_query_expansion
 
-__all__ = ['hybrid_retriever', 'initialize_resources', 'format_docs', 'segment_text', 'get_process_document_with_progress', 'get_embedding_function', 'get_query_expansion'] 
\ No newline at end of file
+__all__ = ['hybrid_retriever', 'initialize_resources', 'format_docs', 'segment_text', 'segment_many', 'get_segmenter', 'Segmenter', 'get_process_document_with_progress', 'get_embedding_function', 'get_query_expansion'] 
\ No newline at end of file
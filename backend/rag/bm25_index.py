@@ -0,0 +1,310 @@
+"""
+课程全文检索索引（BM25）
+
+每门课程一个 SQLite 倒排索引（uploads/knowledge_base/<course_id>/bm25.db），与向量库
+由同一条入库流水线维护：文本块写入 Chroma 后同步写入索引，删除文件或清理旧版本的块时同步删除。
+
+- 索引词由 zh_tokenizer.index_terms 生成（jieba 搜索引擎模式，未安装时按相邻两字切分），
+  函数名、公式符号、章节号等英文/数字词按整词索引，弥补向量检索对精确词的不敏感
+- 倒排表按 (词, 文本块ID) 存放词频，查询只读取查询词的倒排列表
+- 文本块总数、总长度（meta）和每个词的文档频率（terms）随写入和删除增量维护，查询不扫描全表，
+  高频词在读取倒排列表之前就被跳过
+- 索引记录建立时的分词方式，分词方式变化或索引缺失时可从向量库重建
+- reciprocal_rank_fusion 把多路检索结果按排名融合
+"""
+
+import os
+import math
+import json
+import sqlite3
+import logging
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+from backend.rag.course_lock import KNOWLEDGE_BASE_ROOT
+from backend.rag.zh_tokenizer import index_terms, tokenizer_name
+from backend.rag.sqlite_store import ThreadLocalConnection
+
+logger = logging.getLogger(__name__)
+
+BM25_FILENAME = "bm25.db"
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# 倒排列表超过文档总数的这个比例时视为高频词，不参与打分
+BM25_MAX_DF_RATIO = 0.5
+# RRF 融合常数
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+
+def document_key(doc: Document) -> str:
+    """检索结果的去重键：优先用稳定的文本块ID，旧数据没有时用内容"""
+    return doc.metadata.get('chunk_id') or doc.page_content
+
+
+def reciprocal_rank_fusion(result_lists: Sequence[Sequence[Document]], k: int = RRF_K,
+                           limit: Optional[int] = None) -> List[Document]:
+    """倒数排名融合：score(d) = Σ 1 / (k + rank)，多路结果中排名都靠前的文档得分最高"""
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results, 1):
+            key = document_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            docs.setdefault(key, doc)
+    ranked = sorted(scores, key=lambda key: -scores[key])
+    if limit is not None:
+        ranked = ranked[:limit]
+    return [docs[key] for key in ranked]
+
+
+class BM25Index:
+    """单门课程的 BM25 倒排索引，线程安全，可被多个进程共享"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = ThreadLocalConnection(path)
+        conn = self._conn()
+        conn.executescript('''
+        CREATE TABLE IF NOT EXISTS docs (
+            chunk_id TEXT PRIMARY KEY,
+            source TEXT,
+            length INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            metadata TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_docs_source ON docs (source);
+        CREATE TABLE IF NOT EXISTS postings (
+            term TEXT NOT NULL,
+            chunk_id TEXT NOT NULL,
+            tf INTEGER NOT NULL,
+            PRIMARY KEY (term, chunk_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_postings_chunk ON postings (chunk_id);
+        CREATE TABLE IF NOT EXISTS terms (
+            term TEXT PRIMARY KEY,
+            df INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        ''')
+        conn.commit()
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'n_docs'").fetchone() is None:
+            self._rebuild_stats(conn)
+
+    def _rebuild_stats(self, conn: sqlite3.Connection):
+        """从 docs 和 postings 重新统计文本块总数、总长度和文档频率（旧版本建立的索引只需做一次）"""
+        with conn:
+            # 先写后读，写锁保证统计时没有其他进程在写入
+            conn.execute("DELETE FROM terms")
+            conn.execute("INSERT INTO terms SELECT term, COUNT(*) FROM postings GROUP BY term")
+            n_docs, total_length = conn.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+            self._set_stats(conn, n_docs, total_length)
+
+    @staticmethod
+    def _set_stats(conn: sqlite3.Connection, n_docs: int, total_length: int):
+        conn.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                         [("n_docs", str(n_docs)), ("total_length", str(total_length))])
+
+    @staticmethod
+    def _add_stats(conn: sqlite3.Connection, n_docs: int, total_length: int):
+        conn.executemany("UPDATE meta SET value = CAST(value AS INTEGER) + ? WHERE key = ?",
+                         [(n_docs, "n_docs"), (total_length, "total_length")])
+
+    def stats(self) -> Tuple[int, int]:
+        """返回 (文本块总数, 总长度)"""
+        values = dict(self._conn().execute(
+            "SELECT key, value FROM meta WHERE key IN ('n_docs', 'total_length')"
+        ).fetchall())
+        return int(values.get("n_docs", 0)), int(values.get("total_length", 0))
+
+    def tokenizer(self) -> Optional[str]:
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'tokenizer'").fetchone()
+        return row[0] if row else None
+
+    def __len__(self) -> int:
+        return self.stats()[0]
+
+    def _delete(self, conn: sqlite3.Connection, chunk_ids: Sequence[str]):
+        for start in range(0, len(chunk_ids), 500):
+            part = list(chunk_ids[start:start + 500])
+            placeholders = ",".join("?" * len(part))
+            n_docs, total_length = conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs WHERE chunk_id IN ({placeholders})", part
+            ).fetchone()
+            if not n_docs:
+                continue
+            df = conn.execute(
+                f"SELECT term, COUNT(*) FROM postings WHERE chunk_id IN ({placeholders}) GROUP BY term", part
+            ).fetchall()
+            conn.executemany("UPDATE terms SET df = df - ? WHERE term = ?", [(count, term) for term, count in df])
+            conn.executemany("DELETE FROM terms WHERE term = ? AND df <= 0", [(term,) for term, _ in df])
+            self._add_stats(conn, -n_docs, -total_length)
+            conn.execute(f"DELETE FROM postings WHERE chunk_id IN ({placeholders})", part)
+            conn.execute(f"DELETE FROM docs WHERE chunk_id IN ({placeholders})", part)
+
+    def add_documents(self, docs: Iterable[Document]):
+        """写入或覆盖一批文本块（按 chunk_id）"""
+        rows = []
+        postings = []
+        df = Counter()
+        for doc in docs:
+            chunk_id = doc.metadata.get('chunk_id')
+            if not chunk_id:
+                continue
+            terms = Counter(index_terms(doc.page_content))
+            rows.append((chunk_id, doc.metadata.get('source'), sum(terms.values()), doc.page_content,
+                         json.dumps(doc.metadata, ensure_ascii=False, default=str)))
+            postings.extend((term, chunk_id, tf) for term, tf in terms.items())
+            df.update(terms.keys())
+        if not rows:
+            return
+        conn = self._conn()
+        with conn:
+            self._delete(conn, [row[0] for row in rows])
+            conn.executemany("INSERT INTO docs VALUES (?, ?, ?, ?, ?)", rows)
+            conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+            conn.executemany(
+                "INSERT INTO terms VALUES (?, ?) ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+                df.items()
+            )
+            self._add_stats(conn, len(rows), sum(row[2] for row in rows))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (tokenizer_name(),))
+
+    def remove(self, chunk_ids: Sequence[str]):
+        """删除文本块"""
+        if not chunk_ids:
+            return
+        conn = self._conn()
+        with conn:
+            self._delete(conn, list(chunk_ids))
+
+    def remove_stale(self, source: str, keep_ids) -> int:
+        """删除某个文件旧版本遗留、本次没有写入的块，返回删除数量"""
+        conn = self._conn()
+        existing = [row[0] for row in conn.execute("SELECT chunk_id FROM docs WHERE source = ?", (source,))]
+        stale = sorted(set(existing) - set(keep_ids))
+        self.remove(stale)
+        return len(stale)
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM postings")
+            conn.execute("DELETE FROM docs")
+            conn.execute("DELETE FROM terms")
+            conn.execute("DELETE FROM meta")
+            self._set_stats(conn, 0, 0)
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[Document, float]]:
+        """BM25 检索，返回 [(文档, 分数)]，按分数从高到低"""
+        terms = Counter(index_terms(query))
+        if not terms:
+            return []
+        conn = self._conn()
+        n_docs, total_length = self.stats()
+        if not n_docs:
+            return []
+        avg_length = total_length / n_docs or 1.0
+
+        scores: Dict[str, float] = {}
+        for term, query_tf in terms.items():
+            row = conn.execute("SELECT df FROM terms WHERE term = ?", (term,)).fetchone()
+            df = row[0] if row else 0
+            # 出现在大多数文本块中的词区分度很低，不参与打分，也不读取其倒排列表
+            if not df or (n_docs > 20 and df > n_docs * BM25_MAX_DF_RATIO):
+                continue
+            rows = conn.execute(
+                "SELECT p.chunk_id, p.tf, d.length FROM postings p JOIN docs d ON d.chunk_id = p.chunk_id "
+                "WHERE p.term = ?", (term,)
+            ).fetchall()
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for chunk_id, tf, length in rows:
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + query_tf * idf * tf * (BM25_K1 + 1) / norm
+
+        top = sorted(scores.items(), key=lambda item: -item[1])[:k]
+        if not top:
+            return []
+        placeholders = ",".join("?" * len(top))
+        stored = {
+            chunk_id: (content, metadata)
+            for chunk_id, content, metadata in conn.execute(
+                f"SELECT chunk_id, content, metadata FROM docs WHERE chunk_id IN ({placeholders})",
+                [chunk_id for chunk_id, _ in top]
+            )
+        }
+        results = []
+        for chunk_id, score in top:
+            if chunk_id in stored:
+                content, metadata = stored[chunk_id]
+                results.append((Document(page_content=content, metadata=json.loads(metadata)), score))
+        return results
+
+    def rebuild_from_vectorstore(self, vectorstore, batch_size: int = 1000) -> int:
+        """从向量库中已有的文本块重建索引，返回写入的块数"""
+        self.clear()
+        count = 0
+        offset = 0
+        while True:
+            data = vectorstore.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+            ids = data.get('ids') or []
+            if not ids:
+                break
+            docs = []
+            for chunk_id, content, metadata in zip(ids, data.get('documents') or [], data.get('metadatas') or []):
+                metadata = dict(metadata or {})
+                metadata.setdefault('chunk_id', chunk_id)
+                docs.append(Document(page_content=content or "", metadata=metadata))
+            self.add_documents(docs)
+            count += len(docs)
+            offset += len(ids)
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('tokenizer', ?)", (tokenizer_name(),))
+        logger.info(f"已从向量库重建全文索引: {count} 个文本块 ({self.path})")
+        return count
+
+
+_indexes: Dict[str, BM25Index] = {}
+_indexes_lock = threading.Lock()
+
+
+def bm25_index_path(course_id: str) -> str:
+    return os.path.join(KNOWLEDGE_BASE_ROOT, str(course_id), BM25_FILENAME)
+
+
+def get_bm25_index(course_id: str) -> BM25Index:
+    """返回课程的全文索引（进程内按课程复用）"""
+    path = bm25_index_path(course_id)
+    with _indexes_lock:
+        index = _indexes.get(path)
+        if index is None:
+            index = _indexes[path] = BM25Index(path)
+        return index
+
+
+def ensure_bm25_index(course_id: str, vectorstore) -> Optional[BM25Index]:
+    """返回可用的全文索引；索引为空而向量库中有数据、或分词方式已变化时从向量库重建
+
+    在课程写锁下重建，避免与正在进行的入库交错。失败时返回 None，调用方只用向量检索。
+    """
+    from backend.rag.course_lock import course_write_lock
+
+    try:
+        index = get_bm25_index(course_id)
+        if index.tokenizer() == tokenizer_name() and len(index):
+            return index
+        if not vectorstore._collection.count():
+            return index
+        with course_write_lock(str(course_id)):
+            if index.tokenizer() != tokenizer_name() or not len(index):
+                index.rebuild_from_vectorstore(vectorstore)
+        return index
+    except Exception as e:
+        logger.error(f"全文索引不可用: {e}")
+        return None
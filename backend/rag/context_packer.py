@@ -0,0 +1,243 @@
+"""
+RAG 上下文打包
+
+把重排序后的候选文本块装进固定的 token 预算：
+- 按目标模型的分词器计数（tiktoken，按模型缓存）；没有对应编码或编码文件无法加载时
+  退回 embedding_engine.estimate_tokens 的估算。tiktoken 首次使用某个编码时要下载编码文件，
+  分词器在后台线程中加载（应用启动时 preload_tokenizer 预先加载），加载完成前同样使用估算，
+  查询不会等待下载；离线部署可把编码文件放入 TIKTOKEN_CACHE_DIR 指定的目录
+- 去掉重复和被其他块包含的文本块
+- 以相关性分数为价值、token 数为重量做 0/1 背包，在预算内取总相关性最高的组合
+- 选中的同一文件相邻文本块合并为一段，去掉切分时的重叠部分，省下的 token 再按
+  分数/token 比继续填充
+"""
+
+import os
+import logging
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from backend.rag.embedding_engine import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# 非 OpenAI 模型使用的 tiktoken 编码；Qwen/DeepSeek 等中文模型的词表更大，同样的中文切出的
+# token 更少，用 cl100k_base 计数会略微高估，不会超出预算
+CONTEXT_TOKENIZER_ENCODING = os.getenv("CONTEXT_TOKENIZER_ENCODING", "cl100k_base")
+# 目标模型的上下文窗口（token）
+LLM_CONTEXT_WINDOW = int(os.getenv("LLM_CONTEXT_WINDOW", "32768"))
+# 背包容量最多划分的格数，token 数按格向上取整
+_KNAPSACK_BUCKETS = 512
+# 判断相邻文本块重叠时比较的最大字符数
+_MAX_OVERLAP_CHARS = 400
+
+_tokenizers: Dict[str, Optional[Callable[[str], int]]] = {}
+_loading: Dict[str, threading.Thread] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def _load_tokenizer(model: str) -> Optional[Callable[[str], int]]:
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding(CONTEXT_TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning(f"无法加载模型 {model} 的分词器，使用估算的 token 数: {e}")
+        return None
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def _load_in_background(model: str):
+    counter = _load_tokenizer(model)
+    with _tokenizers_lock:
+        _tokenizers[model] = counter
+        _loading.pop(model, None)
+
+
+def preload_tokenizer(model: Optional[str] = None) -> Optional[threading.Thread]:
+    """在后台线程中加载模型的分词器，返回加载线程；已加载或正在加载时返回 None"""
+    model = model or os.getenv("LLM_MODEL", "Qwen/Qwen3-32B")
+    with _tokenizers_lock:
+        if model in _tokenizers or model in _loading:
+            return None
+        thread = _loading[model] = threading.Thread(
+            target=_load_in_background, args=(model,), name="tokenizer-loader", daemon=True
+        )
+    thread.start()
+    return thread
+
+
+def get_token_counter(model: Optional[str] = None) -> Callable[[str], int]:
+    """返回模型的 token 计数函数，按模型缓存（包括加载失败的结果）
+
+    分词器尚未加载时在后台开始加载，本次返回估算函数，不阻塞调用方。
+    """
+    model = model or os.getenv("LLM_MODEL", "Qwen/Qwen3-32B")
+    with _tokenizers_lock:
+        counter = _tokenizers.get(model)
+        loaded = model in _tokenizers
+    if not loaded:
+        preload_tokenizer(model)
+    return counter or estimate_tokens
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    return get_token_counter(model)(text)
+
+
+def context_budget(max_tokens: int, reserved_tokens: int = 0, window: int = LLM_CONTEXT_WINDOW) -> int:
+    """上下文可用的 token 数：不超过 max_tokens，也不超过窗口减去提示词和回答预留的部分"""
+    return max(0, min(max_tokens, window - reserved_tokens))
+
+
+def _overlap(left: str, right: str) -> int:
+    """left 的后缀与 right 的前缀重叠的字符数"""
+    limit = min(len(left), len(right), _MAX_OVERLAP_CHARS)
+    for size in range(limit, 0, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _position(metadata: Dict[str, Any]) -> Optional[Tuple[str, int]]:
+    """文本块在文件中的位置 (文件, 序号)，旧数据没有序号时返回 None"""
+    index = metadata.get('chunk_index')
+    # 内容相同的两个文件 file_hash 相同，文件名一起区分
+    source = (metadata.get('file_hash'), metadata.get('source'))
+    if source == (None, None) or not isinstance(index, int):
+        return None
+    return str(source), index
+
+
+def deduplicate(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """去掉内容重复或被更长文本块完整包含的条目，保留分数较高的一个"""
+    ordered = sorted((dict(item) for item in items), key=lambda item: (-len(item['content']), -item.get('score', 0.0)))
+    kept: List[Dict[str, Any]] = []
+    for item in ordered:
+        content = item['content'].strip()
+        if not content:
+            continue
+        container = next((other for other in kept if content in other['content']), None)
+        if container is None:
+            kept.append(item)
+        elif item.get('score', 0.0) > container.get('score', 0.0):
+            container['score'] = item['score']
+    return sorted(kept, key=lambda item: -item.get('score', 0.0))
+
+
+def knapsack(weights: List[int], values: List[float], capacity: int) -> List[int]:
+    """0/1 背包，返回选中的下标；重量按格向上取整，选中组合的真实重量不超过容量"""
+    if capacity <= 0 or not weights:
+        return []
+    unit = max(1, -(-capacity // _KNAPSACK_BUCKETS))
+    slots = capacity // unit
+    sizes = [-(-weight // unit) for weight in weights]
+
+    best = [0.0] * (slots + 1)
+    taken = [[False] * (slots + 1) for _ in weights]
+    for i, (size, value) in enumerate(zip(sizes, values)):
+        if value <= 0 or size > slots:
+            continue
+        for c in range(slots, size - 1, -1):
+            candidate = best[c - size] + value
+            if candidate > best[c]:
+                best[c] = candidate
+                taken[i][c] = True
+
+    chosen = []
+    c = slots
+    for i in range(len(weights) - 1, -1, -1):
+        if taken[i][c]:
+            chosen.append(i)
+            c -= sizes[i]
+    return sorted(chosen)
+
+
+def _merge_adjacent(items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """把同一文件中序号相邻的条目合并为一段，去掉重叠文本；分数取各段之和"""
+    groups: List[Dict[str, Any]] = []
+    by_position = {}
+    for item in sorted(items, key=lambda item: _position(item['metadata']) or ("", -1)):
+        position = _position(item['metadata'])
+        previous = by_position.get((position[0], position[1] - 1)) if position else None
+        if previous is None:
+            group = {
+                'content': item['content'],
+                'metadata': dict(item['metadata']),
+                'score': item.get('score', 0.0),
+                'best': item.get('score', 0.0),
+                'chunks': 1,
+            }
+            groups.append(group)
+        else:
+            group = previous
+            overlap = _overlap(group['content'], item['content'])
+            group['content'] += item['content'][overlap:] if overlap else "\n" + item['content']
+            group['score'] += item.get('score', 0.0)
+            group['best'] = max(group['best'], item.get('score', 0.0))
+            group['chunks'] += 1
+        if position:
+            by_position[position] = group
+    return sorted(groups, key=lambda group: -group['best'])
+
+
+def pack_context(items: List[Dict[str, Any]], budget: int, model: Optional[str] = None,
+                 template: str = "文档片段:\n{content}\n") -> List[Dict[str, Any]]:
+    """在 token 预算内选择并合并文本块
+
+    items 为 query_knowledge_base 的结果（content / metadata / score），返回按相关性排序的
+    段落列表，每段包含合并后的 content、metadata、score 和 tokens。
+    """
+    counter = get_token_counter(model)
+    items = deduplicate(items)
+    if not items or budget <= 0:
+        return []
+
+    def cost(content: str) -> int:
+        return counter(template.format(content=content))
+
+    # 分数全为非正数（如回退排序）时按排名给出价值
+    values = [max(item.get('score', 0.0), 0.0) for item in items]
+    if not any(values):
+        values = [1.0 / (i + 1) for i in range(len(items))]
+    for item, value in zip(items, values):
+        item['score'] = value
+
+    weights = [cost(item['content']) for item in items]
+    chosen = set(knapsack(weights, values, budget))
+
+    # 合并相邻块会去掉重叠文本，省出的预算按分数/token 比继续填充
+    while True:
+        groups = _merge_adjacent([items[i] for i in sorted(chosen)])
+        for group in groups:
+            group['tokens'] = cost(group['content'])
+        used = sum(group['tokens'] for group in groups)
+        remaining = sorted(
+            (i for i in range(len(items)) if i not in chosen and values[i] > 0),
+            key=lambda i: -values[i] / max(weights[i], 1)
+        )
+        added = False
+        for i in remaining:
+            trial = _merge_adjacent([items[j] for j in sorted(chosen | {i})])
+            if sum(cost(group['content']) for group in trial) <= budget:
+                chosen.add(i)
+                added = True
+                break
+        if not added:
+            break
+
+    logger.debug(f"上下文打包: {len(chosen)}/{len(items)} 个文本块，合并为 {len(groups)} 段，{used}/{budget} tokens")
+    return [
+        {
+            'content': group['content'],
+            'metadata': group['metadata'],
+            'score': group['score'],
+            'tokens': group['tokens'],
+        }
+        for group in groups
+    ]
@@ -0,0 +1,45 @@
+"""
+课程知识库写锁
+
+同一课程的 Chroma 目录和 processed_files.json 同时只允许一个写入者。
+进程内用 threading.Lock 串行化，跨进程（Flask 与 process_queue.py）在支持 fcntl
+的平台上额外对知识库目录下的 .write.lock 文件加排他锁。
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict
+
+try:
+    import fcntl
+except ImportError:  # Windows 上只做进程内互斥
+    fcntl = None
+
+KNOWLEDGE_BASE_ROOT = "uploads/knowledge_base"
+
+_locks: Dict[str, threading.Lock] = {}
+_locks_guard = threading.Lock()
+
+
+def _thread_lock(course_id: str) -> threading.Lock:
+    with _locks_guard:
+        return _locks.setdefault(course_id, threading.Lock())
+
+
+@contextmanager
+def course_write_lock(course_id: str):
+    """获取课程知识库的写锁，用法: with course_write_lock(course_id): ..."""
+    course_id = str(course_id)
+    with _thread_lock(course_id):
+        if fcntl is None:
+            yield
+            return
+        kb_dir = os.path.join(KNOWLEDGE_BASE_ROOT, course_id)
+        os.makedirs(kb_dir, exist_ok=True)
+        with open(os.path.join(kb_dir, ".write.lock"), "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
@@ -3,9 +3,8 @@ import sys
 import argparse
 import hashlib
 import json
-import networkx as nx
 from tqdm.asyncio import tqdm
-from typing import List, Callable, Optional
+from typing import List, Callable, Optional, Iterable, Iterator
 import logging
 import asyncio
 import subprocess
@@ -16,6 +15,11 @@ import requests
 import shutil as _shutil
 import time
 import traceback
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # 禁用 ChromaDB telemetry 以防止崩溃
 os.environ["ANONYMIZED_TELEMETRY"] = "False"
@@ -37,7 +41,13 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.embeddings import Embeddings  # 添加Embeddings导入
 from backend.rag.embedding_util import get_embedding
-from backend.rag.knowledge_graph import build_knowledge_graph
+from backend.rag.knowledge_graph import build_knowledge_graph, retract_document_from_graph
+from backend.rag.graph_store import remove_course_graph
+from backend.rag.graph_analytics import remove_graph_analytics
+from backend.rag.bm25_index import get_bm25_index
+from backend.rag.resource_registry import invalidate_course_resources
+from backend.rag.course_lock import course_write_lock
+from backend.rag.segmentor import SEGMENT_PARALLEL_MIN_CHARS
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -48,6 +58,11 @@ CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "300"))  # 减小到300字符，确保
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))  # 相应减小overlap
 # Max parallel API calls (respect provider's rate-limit)
 CONCURRENCY_LIMIT = int(os.getenv("LLM_CONCURRENCY", "8"))
+# 流式入库：每批向量化和写入的文本块数量，以及各阶段之间队列最多缓存的批次数
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+INGEST_QUEUE_DEPTH = int(os.getenv("INGEST_QUEUE_DEPTH", "4"))
+# 命令行入库时每攒够这么多文本块就合并一次知识图谱，内存中最多保留两批，与文档总大小无关
+GRAPH_INGEST_CHUNKS = int(os.getenv("GRAPH_INGEST_CHUNKS", "512"))
 
 # --- LLM and Parser Initialization ---
 def get_llm():
@@ -95,23 +110,23 @@ class CustomTextSplitter:
     def __init__(self, chunk_size=300, chunk_overlap=50):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        # 延迟导入segment_text，避免循环导入
-        self._segment_text = None
+        # 延迟创建分割器，避免循环导入
+        self._segmenter = None
     
     @property
-    def segment_text(self):
-        """延迟加载segment_text函数"""
-        if self._segment_text is None:
+    def segmenter(self):
+        """按 chunk_size 缓存的共享分割器（正则只编译一次）"""
+        if self._segmenter is None:
             # 在需要时才导入，避免循环导入
-            from backend.rag.segmentor import segment_text
-            self._segment_text = segment_text
-        return self._segment_text
+            from backend.rag.segmentor import get_segmenter
+            self._segmenter = get_segmenter(self.chunk_size)
+        return self._segmenter
     
-    def split_text(self, text):
-        """使用自定义分割器分割文本"""
+    def split_text(self, text, executor=None):
+        """使用自定义分割器分割文本，给出进程池时长文本分片并行"""
         try:
             # 使用自定义分割器
-            chunks = self.segment_text(text, self.chunk_size)
+            chunks = self.segmenter.segment(text, executor)
             logging.info(f"使用分割器成功分割文本为 {len(chunks)} 个块")
             return chunks
         except Exception as e:
@@ -128,11 +143,16 @@ class CustomTextSplitter:
                 chunks.append(chunk)
         return chunks
     
-    def split_documents(self, documents):
+    def split_documents(self, documents, executor=None):
         """分割文档列表，兼容LangChain接口"""
+        try:
+            # 批量分割，给出进程池且总量较大时由分割器交给进程池
+            all_texts = self.segmenter.segment_many([doc.page_content for doc in documents], executor)
+        except Exception as e:
+            logging.error(f"批量分割失败: {e}，逐个分割")
+            all_texts = [self.split_text(doc.page_content) for doc in documents]
         texts = []
-        for doc in documents:
-            doc_texts = self.split_text(doc.page_content)
+        for doc, doc_texts in zip(documents, all_texts):
             for text in doc_texts:
                 new_doc = Document(
                     page_content=text,
@@ -145,104 +165,36 @@ class CustomTextSplitter:
 class EmbeddingFunction(Embeddings):  # 继承自Embeddings接口
     def __init__(self, progress_callback=None):
         self.progress_callback = progress_callback
-        self.batch_size = 5  # 进一步减小批处理大小，避免API限制
         self.logger = logging.getLogger(__name__)
 
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
-        """Embed documents using Silicon Flow API with correct dimension"""
+        """Embed documents using Silicon Flow API with correct dimension
+
+        通过共享的并发批量引擎向量化，结果与输入顺序一致；
+        单个批次最终失败时使用零向量占位，不中断整个文档。
+        """
         try:
-            from backend.rag.embedding_util import get_embedding
-            
-            # 过滤空文本
-            texts = [text.strip() for text in texts if text and text.strip()]
-            if not texts:
-                self.logger.warning("没有有效的文本进行向量化")
-                return [[0.0] * 1024]
-            
-            # 分批处理
-            batch_size = self.batch_size
-            all_embeddings = []
-            
-            self.logger.info(f"开始向量化 {len(texts)} 个文本，批处理大小: {batch_size}")
-            
-            for i in range(0, len(texts), batch_size):
-                batch = texts[i:i + batch_size]
-                batch_num = i // batch_size + 1
-                total_batches = (len(texts) + batch_size - 1) // batch_size
-                
-                self.logger.info(f"处理批次 {batch_num}/{total_batches}: {len(batch)} 个文本")
-                
-                try:
-                    result = get_embedding(batch, max_retries=3)
-                    
-                    if 'data' in result and result['data']:
-                        batch_embeddings = [item['embedding'] for item in result['data']]
-                        all_embeddings.extend(batch_embeddings)
-                        self.logger.info(f"批次 {batch_num} 向量化成功: {len(batch_embeddings)} 个embedding")
-                    else:
-                        self.logger.error(f"批次 {batch_num} API返回格式错误")
-                        # 为这个批次创建占位符embedding
-                        batch_embeddings = [[0.0] * 1024 for _ in batch]
-                        all_embeddings.extend(batch_embeddings)
-                    
-                    # 更新进度
-                    if self.progress_callback:
-                        progress = min(100, (i + len(batch)) / len(texts) * 100)
-                        self.progress_callback(progress)
-                        
-                except Exception as batch_error:
-                    self.logger.error(f"批次 {batch_num} 向量化失败: {batch_error}")
-                    # 为这个批次创建占位符embedding
-                    batch_embeddings = [[0.0] * 1024 for _ in batch]
-                    all_embeddings.extend(batch_embeddings)
-                    
-                    # 继续处理下一个批次，而不是完全失败
-                    continue
-            
-            # 验证维度（siliconflow BAAI/bge-large-zh-v1.5 = 1024维）
-            embedding_dimension = 1024
-            if all_embeddings:
-                for i, embedding in enumerate(all_embeddings):
-                    if len(embedding) != embedding_dimension:
-                        self.logger.error(f"第 {i} 个embedding维度不匹配: 期望{embedding_dimension}，实际{len(embedding)}")
-                        # 修正维度
-                        if len(embedding) > embedding_dimension:
-                            all_embeddings[i] = embedding[:embedding_dimension]
-                        else:
-                            all_embeddings[i] = embedding + [0.0] * (embedding_dimension - len(embedding))
+            from backend.rag.embedding_engine import get_embedding_engine
             
-            self.logger.info(f"向量化完成: {len(all_embeddings)} 个embedding")
-            return all_embeddings
+            engine = get_embedding_engine()
+            return engine.embed(texts, progress_callback=self.progress_callback, placeholder_on_error=True)
             
         except Exception as e:
             self.logger.error(f"向量化过程中出现严重错误: {e}")
             # 返回占位符embedding，确保不会崩溃
             embedding_dimension = 1024
-            return [[0.0] * embedding_dimension] * len(texts)
+            return [[0.0] * embedding_dimension for _ in texts]
 
     def embed_query(self, text: str) -> List[float]:
         """用于查询的embedding方法"""
         try:
-            from backend.rag.embedding_util import get_embedding
+            from backend.rag.embedding_engine import get_embedding_engine
             
             if not text or not text.strip():
                 self.logger.warning("查询文本为空")
                 return [0.0] * 1024
             
-            result = get_embedding([text], max_retries=3)
-            if 'data' in result and result['data']:
-                embedding = result['data'][0]['embedding']
-                # 验证维度
-                if len(embedding) != 1024:
-                    self.logger.error(f"查询embedding维度不匹配: 期望1024，实际{len(embedding)}")
-                    if len(embedding) > 1024:
-                        embedding = embedding[:1024]
-                    else:
-                        embedding = embedding + [0.0] * (1024 - len(embedding))
-                return embedding
-            else:
-                self.logger.error("查询embedding API返回格式错误")
-                return [0.0] * 1024
+            return get_embedding_engine().embed_query(text)
         except Exception as e:
             self.logger.error(f"查询embedding失败: {e}")
             return [0.0] * 1024
@@ -278,6 +230,62 @@ def save_processed_files_metadata(metadata_file: str, data: dict):
     with open(metadata_file, 'w', encoding='utf-8') as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
 
+def make_chunk_id(file_hash: str, chunk_index: int, filename: str) -> str:
+    """由文件哈希、文件名和块序号生成确定性的块ID
+
+    同一文件重复入库时ID保持不变；文件名参与哈希，同一课程中内容相同的两个文件
+    各有自己的块，删除或更新其中一个不会影响另一个。
+    """
+    key = hashlib.sha256(f"{file_hash}\0{filename}".encode("utf-8")).hexdigest()
+    return f"{key[:16]}_{chunk_index:05d}"
+
+def assign_chunk_ids(splits: List[Document], file_hash: str, filename: str, start: int = 0):
+    """为同一文件的文本块写入稳定ID及其来源信息，start 为第一个块在文件中的序号"""
+    for i, doc in enumerate(splits, start):
+        doc.metadata['chunk_id'] = make_chunk_id(file_hash, i, filename)
+        doc.metadata['chunk_index'] = i
+        doc.metadata['file_hash'] = file_hash
+
+def open_course_vectorstore(course_id: str, embedding_function=None) -> Chroma:
+    """打开课程的向量数据库（uploads/knowledge_base/<course_id>/vectordb）"""
+    from chromadb.config import Settings
+    persist_dir = os.path.join("uploads/knowledge_base", course_id, "vectordb")
+    os.makedirs(persist_dir, exist_ok=True)
+    return Chroma(
+        persist_directory=persist_dir,
+        embedding_function=embedding_function or EmbeddingFunction(),
+        client_settings=Settings(anonymized_telemetry=False)
+    )
+
+def get_source_chunk_ids(vectorstore: Chroma, filename: str) -> List[str]:
+    """通过 source 元数据过滤获取某个文件的全部块ID，不扫描整个集合"""
+    return vectorstore.get(where={"source": filename}, include=[])['ids']
+
+def write_chunk_batch(vectorstore: Chroma, splits: List[Document], embeddings: List[List[float]]):
+    """按稳定ID upsert 一批已向量化的文本块，相同ID的块被覆盖而不是重复写入"""
+    if not splits:
+        return
+    vectorstore._collection.upsert(
+        ids=[doc.metadata['chunk_id'] for doc in splits],
+        embeddings=embeddings,
+        documents=[doc.page_content for doc in splits],
+        metadatas=[doc.metadata for doc in splits]
+    )
+
+def delete_stale_chunks(vectorstore: Chroma, filename: str, keep_ids) -> int:
+    """删除该文件旧版本遗留、本次没有写入的块，返回删除数量"""
+    stale_ids = set(get_source_chunk_ids(vectorstore, filename)) - set(keep_ids)
+    if stale_ids:
+        vectorstore.delete(ids=list(stale_ids))
+    return len(stale_ids)
+
+def _update_bm25(course_id: str, update: Callable):
+    """同步更新课程的全文索引；失败时只记录日志，索引可用 BM25Index.rebuild_from_vectorstore 重建"""
+    try:
+        update(get_bm25_index(course_id))
+    except Exception as e:
+        logging.error(f"更新全文索引失败: {e}")
+
 async def process_chunk_for_graph(chunk, graph_extraction_chain):
     """Asynchronously processes a single chunk to extract graph data."""
     chunk_id = chunk.metadata['chunk_id']
@@ -305,6 +313,66 @@ async def process_chunk_for_graph(chunk, graph_extraction_chain):
         logging.error(f"Failed to process chunk {chunk_id} for graph extraction: {e}")
         return chunk_id, [], []
 
+class _StreamingGraphBuilder:
+    """在后台线程中把入库的文本块分批合并进知识图谱
+
+    同一时刻最多一批在合并、一批在累积，内存占用与文档总大小无关。每个文件开始前先撤回它在图中的
+    旧来源，之后它的文本块分批合并时不再撤回，避免后一批撤回前一批刚合并的来源。
+    """
+
+    def __init__(self, course_id: str, progress_callback=None, batch_chunks: int = GRAPH_INGEST_CHUNKS):
+        self.course_id = course_id
+        self.progress_callback = progress_callback
+        self.batch_chunks = max(1, batch_chunks)
+        self.buffer: List[Document] = []
+        self.chunks = 0
+        self.failed = 0
+        self._pending: Optional[Future] = None
+        # 单线程保证撤回和各批合并按提交顺序执行；图谱构建内部使用 asyncio.run，不能在调用方的事件循环中运行
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"graph-{course_id}")
+
+    def start_file(self, filename: str):
+        self.flush()
+        self._submit(retract_document_from_graph, self.course_id, filename)
+
+    def add(self, chunks: List[Document]):
+        self.buffer.extend(chunks)
+        if len(self.buffer) >= self.batch_chunks:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        batch, self.buffer = self.buffer, []
+        self.chunks += len(batch)
+        self._submit(build_knowledge_graph, self.course_id, batch, self.progress_callback, False)
+
+    def _submit(self, fn, *args):
+        # 先等上一项完成，合并与下一批的向量化入库重叠进行
+        self._wait()
+        self._pending = self._executor.submit(fn, *args)
+
+    def _wait(self):
+        if self._pending is None:
+            return
+        try:
+            ok = self._pending.result() is not False
+        except Exception as e:
+            logging.error(f"合并知识图谱时出错: {e}")
+            ok = False
+        if not ok:
+            self.failed += 1
+        self._pending = None
+
+    def close(self) -> bool:
+        """合并剩余的文本块并等待完成，返回是否全部成功"""
+        try:
+            self.flush()
+            self._wait()
+        finally:
+            self._executor.shutdown()
+        return self.failed == 0
+
 # --- Main Processing Function ---
 async def process_documents(course_id: str, force_rebuild: bool = False):
     """处理文档并构建知识图谱"""
@@ -315,14 +383,14 @@ async def process_documents(course_id: str, force_rebuild: bool = False):
 
     persist_dir = get_or_create_course_db_path(course_id)
     metadata_file = os.path.join(persist_dir, 'processed_files_metadata.json')
-    graph_file_path = os.path.join(persist_dir, 'knowledge_graph.gml')
     
     # 加载已处理文件的元数据
     processed_files_metadata = load_processed_files_metadata(metadata_file)
 
-    if force_rebuild and os.path.exists(graph_file_path):
+    if force_rebuild:
         logging.info("Force rebuild enabled: Removing old knowledge graph.")
-        os.remove(graph_file_path)
+        remove_course_graph(course_id)
+        remove_graph_analytics(course_id)
 
     if force_rebuild:
         logging.info("Force rebuild enabled: Clearing old metadata to re-process all files.")
@@ -346,10 +414,16 @@ async def process_documents(course_id: str, force_rebuild: bool = False):
 
     logging.info(f"Found {len(files_to_process)} new or modified files to process.")
     
-    # 处理文档并构建知识图谱
-    all_docs = []
+    # 处理文档并构建知识图谱：文本块写入向量存储后分批交给图谱构建，不在内存中累积全部文本块
+    logging.info(f"Streaming documents into vectorstore (chunk size={CHUNK_SIZE}, overlap={CHUNK_OVERLAP})...")
+    
+    def progress_callback(progress):
+        logging.info(f"知识图谱构建进度: {progress:.1f}%")
+    
+    graph_builder = _StreamingGraphBuilder(course_id, progress_callback)
     for filename, file_path in tqdm(files_to_process, desc="Loading documents"):
         try:
+            graph_builder.start_file(filename)
             ext = os.path.splitext(filename)[1].lower()
             if ext == ".pdf":
                 loader = PyMuPDFLoader(file_path)
@@ -383,65 +457,34 @@ async def process_documents(course_id: str, force_rebuild: bool = False):
                     logging.error(f"LibreOffice PDF conversion failed for {file_path}: {convert_err}")
                     loader = UnstructuredFileLoader(file_path, mode="single")
             elif ext in ['.md', '.markdown']:
-                # 直接用open读取Markdown文本，避免复杂Loader
-                try:
-                    from langchain_core.documents import Document
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        content = f.read()
-                    docs = [Document(page_content=content, metadata={"source": filename})]
-                    print("用open直接读取md文件成功")
-                except Exception as e:
-                    print(f"open读取md失败: {e}")
-                    raise
+                # Markdown 由 iter_document_pages 直接用open读取，避免复杂Loader
+                loader = None
             else:
                 # Fallback to generic loader
                 loader = UnstructuredFileLoader(file_path, mode="single")
 
-            docs = loader.load()
-            for doc in docs:
-                doc.metadata['source'] = filename
-            all_docs.extend(docs)
+            # 逐页加载、分割、向量化并写入向量存储，写入的文本块分批合并进知识图谱
+            stream_file_into_vectorstore(
+                course_id,
+                file_path,
+                file_hash=processed_files_metadata[filename],
+                loader=loader,
+                on_chunks=graph_builder.add
+            )
         except Exception as e:
             logging.error(f"Error loading file {file_path}: {e}")
             if filename in processed_files_metadata:
                 del processed_files_metadata[filename]
     
-    if not all_docs:
-        logging.info("No content loaded from new/modified files.")
-        return
-
-    # 分割文档
-    logging.info(f"Splitting documents into chunks (size={CHUNK_SIZE}, overlap={CHUNK_OVERLAP})...")
-    text_splitter = CustomTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-    splits = text_splitter.split_documents(all_docs)
-    
-    # 添加唯一ID
-    for i, doc in enumerate(splits):
-        doc.metadata['chunk_id'] = f"chunk_{i}"
-
-    # 创建向量存储
-    logging.info("Creating/updating vectorstore...")
-    embedding_function = EmbeddingFunction()
-    Chroma.from_documents(
-        documents=splits,
-        embedding=embedding_function,
-        persist_directory=persist_dir
-    )
+    graph_success = graph_builder.close()
+    invalidate_course_resources(course_id)
     
-    # 构建知识图谱
-    logging.info("开始构建知识图谱...")
-    try:
-        def progress_callback(progress):
-            logging.info(f"知识图谱构建进度: {progress:.1f}%")
-        
-        graph_success = build_knowledge_graph(course_id, splits, progress_callback)
-        if graph_success:
-            logging.info("知识图谱构建成功")
-        else:
-            logging.warning("知识图谱构建失败，但向量存储已创建")
-    except Exception as e:
-        logging.error(f"构建知识图谱时出错: {e}")
-        logging.info("继续处理，向量存储已创建")
+    if not graph_builder.chunks:
+        logging.info("No content loaded from new/modified files.")
+    elif graph_success:
+        logging.info(f"知识图谱构建成功，共合并 {graph_builder.chunks} 个文本块")
+    else:
+        logging.warning(f"知识图谱有 {graph_builder.failed} 批合并失败，但向量存储已创建")
     
     # 保存元数据
     logging.info("Saving updated file metadata...")
@@ -527,7 +570,200 @@ def transcribe_audio(audio_path: str) -> str:
             return data.get("text", "")
         return data
 
-def process_document_with_progress(course_id: str, file_path: str, progress_callback: Optional[Callable[[float], None]] = None, purpose: str = 'general'):
+def _select_loader(file_path: str):
+    """按文件类型选择加载器，Markdown 返回 None（直接读取文本）"""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.pdf':
+        return PyMuPDFLoader(file_path)
+    if ext in ['.docx', '.doc']:
+        return Docx2txtLoader(file_path)
+    if ext in ['.md', '.markdown']:
+        return None
+    # Fallback to generic loader
+    return UnstructuredFileLoader(file_path, mode="single")
+
+def iter_document_pages(file_path: str, purpose: str = 'general', loader=None) -> Iterator[Document]:
+    """逐页加载文档（PDF每页一个Document），并写入 source 和 purpose 元数据"""
+    filename = os.path.basename(file_path)
+    if loader is None:
+        loader = _select_loader(file_path)
+    if loader is None:
+        # 直接用open读取Markdown文本，避免复杂Loader
+        with open(file_path, "r", encoding="utf-8") as f:
+            pages = iter([Document(page_content=f.read(), metadata={})])
+    else:
+        pages = loader.lazy_load()
+    for page in pages:
+        page.metadata['source'] = filename
+        # 添加文件用途标记
+        page.metadata['purpose'] = purpose
+        yield page
+
+def split_page_text(text: str, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                    executor=None) -> List[str]:
+    """分割单页文本，只依赖参数，可以提交到进程池中执行；在当前进程中执行时可以给出进程池做分片并行"""
+    return CustomTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap).split_text(text, executor)
+
+def iter_page_chunks(pages: Iterable[Document], split_executor=None) -> Iterator[List[Document]]:
+    """逐页分割，每页产出一个文本块列表
+
+    提供进程池时最多同时分割 INGEST_QUEUE_DEPTH * 2 页，产出顺序与页顺序一致。
+    超过 SEGMENT_PARALLEL_MIN_CHARS 的长页（如整个 txt 文件）在当前线程中协调，
+    由分割器把分片提交到同一个进程池，不会整页落在单个子进程里。
+    """
+    def to_chunks(metadata, texts):
+        return [Document(page_content=text, metadata=metadata.copy()) for text in texts]
+    
+    pending = deque()
+    for page in pages:
+        if split_executor is None:
+            yield to_chunks(page.metadata, split_page_text(page.page_content))
+            continue
+        if len(page.page_content) >= SEGMENT_PARALLEL_MIN_CHARS:
+            future = Future()
+            future.set_result(split_page_text(page.page_content, executor=split_executor))
+        else:
+            future = split_executor.submit(split_page_text, page.page_content)
+        pending.append((page, future))
+        if len(pending) >= INGEST_QUEUE_DEPTH * 2:
+            yield _split_result(*pending.popleft(), to_chunks)
+    while pending:
+        yield _split_result(*pending.popleft(), to_chunks)
+
+def _split_result(page: Document, future, to_chunks) -> List[Document]:
+    try:
+        texts = future.result()
+    except BrokenProcessPool as e:
+        logging.warning(f"入库进程池不可用，改为在当前进程中分割: {e}")
+        texts = split_page_text(page.page_content)
+    return to_chunks(page.metadata, texts)
+
+class _PipelineFailed(Exception):
+    """流水线中某个阶段已失败"""
+
+def _queue_put(q: "queue.Queue", item, stop: threading.Event):
+    """向有界队列放入数据，下游失败时不再阻塞"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            continue
+    raise _PipelineFailed()
+
+def _queue_get(q: "queue.Queue", stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    raise _PipelineFailed()
+
+def stream_file_into_vectorstore(course_id: str, file_path: str, purpose: str = 'general',
+                                 file_hash: Optional[str] = None, embedding_function=None,
+                                 split_executor=None, loader=None,
+                                 on_progress: Optional[Callable[[dict], None]] = None,
+                                 on_chunks: Optional[Callable[[List[Document]], None]] = None) -> int:
+    """流式入库单个文件，返回写入的文本块数量
+
+    加载页 → 分割 → 批量向量化 → 批量写入 四个阶段并行执行，阶段之间用有界队列连接，
+    内存中最多保留 INGEST_QUEUE_DEPTH 个批次，与文档大小无关。
+    同一课程的写入在 course_write_lock 下逐批进行，向量化不占用写锁。
+    on_progress 收到 {pages_done, total_pages, chunks_total, chunks_written, loading_done}。
+    """
+    filename = os.path.basename(file_path)
+    file_hash = file_hash or get_file_hash(file_path)
+    embedding_function = embedding_function or EmbeddingFunction()
+    vectorstore = open_course_vectorstore(course_id, embedding_function)
+    
+    state = {'pages_done': 0, 'total_pages': None, 'chunks_total': 0, 'chunks_written': 0, 'loading_done': False}
+    stop = threading.Event()
+    errors = []
+    to_embed = queue.Queue(maxsize=INGEST_QUEUE_DEPTH)
+    to_write = queue.Queue(maxsize=INGEST_QUEUE_DEPTH)
+    
+    def produce():
+        try:
+            batch = []
+            pages = iter_document_pages(file_path, purpose, loader)
+            for chunks in iter_page_chunks(pages, split_executor):
+                assign_chunk_ids(chunks, file_hash, filename, start=state['chunks_total'])
+                state['chunks_total'] += len(chunks)
+                if chunks and state['total_pages'] is None:
+                    state['total_pages'] = chunks[0].metadata.get('total_pages')
+                state['pages_done'] += 1
+                for doc in chunks:
+                    batch.append(doc)
+                    if len(batch) >= INGEST_BATCH_SIZE:
+                        _queue_put(to_embed, batch, stop)
+                        batch = []
+            if batch:
+                _queue_put(to_embed, batch, stop)
+            state['loading_done'] = True
+            _queue_put(to_embed, None, stop)
+        except _PipelineFailed:
+            pass
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+    
+    def embed():
+        try:
+            while True:
+                batch = _queue_get(to_embed, stop)
+                if batch is None:
+                    _queue_put(to_write, None, stop)
+                    return
+                vectors = embedding_function.embed_documents([doc.page_content for doc in batch])
+                _queue_put(to_write, (batch, vectors), stop)
+        except _PipelineFailed:
+            pass
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+    
+    workers = [
+        threading.Thread(target=produce, name=f"ingest-load-{filename}", daemon=True),
+        threading.Thread(target=embed, name=f"ingest-embed-{filename}", daemon=True),
+    ]
+    for worker in workers:
+        worker.start()
+    
+    written_ids = []
+    try:
+        while True:
+            item = _queue_get(to_write, stop)
+            if item is None:
+                break
+            batch, vectors = item
+            with course_write_lock(course_id):
+                write_chunk_batch(vectorstore, batch, vectors)
+                _update_bm25(course_id, lambda index: index.add_documents(batch))
+            written_ids.extend(doc.metadata['chunk_id'] for doc in batch)
+            state['chunks_written'] += len(batch)
+            if on_chunks:
+                on_chunks(batch)
+            if on_progress:
+                on_progress(dict(state))
+    except _PipelineFailed:
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+    if errors:
+        raise errors[0]
+    
+    with course_write_lock(course_id):
+        removed = delete_stale_chunks(vectorstore, filename, written_ids)
+        _update_bm25(course_id, lambda index: index.remove_stale(filename, written_ids))
+    if removed:
+        print(f"✓ 删除了旧版本遗留的 {removed} 个文本块")
+    return len(written_ids)
+
+def process_document_with_progress(course_id: str, file_path: str, progress_callback: Optional[Callable[[float], None]] = None, purpose: str = 'general', split_executor=None):
     """Process a single document and report progress - 简化版本，暂时关闭知识图谱构建
     
     Args:
@@ -535,164 +771,98 @@ def process_document_with_progress(course_id: str, file_path: str, progress_call
         file_path: 文件路径
         progress_callback: 进度回调函数
         purpose: 文件用途，如'general'(一般),'lesson_plan'(备课),'assessment'(考核)等
+        split_executor: 可选的进程池，用于逐页分割
     """
     
-    def report_progress(stage: str, current: int, total: int):
-        """Report progress for a specific stage"""
+    def report_progress(percent: float, stage: str, message: str):
+        """Report overall progress with stage and message"""
         if progress_callback:
-            # 简化进度计算，去掉知识图谱阶段
-            stage_weights = {
-                'loading': 0.2,
-                'splitting': 0.1,
-                'vectorizing': 0.6,
-                'saving': 0.1
-            }
-            
-            # Calculate overall progress
-            stage_start = sum([w for s, w in stage_weights.items() if s < stage]) * 100
-            stage_progress = (current / total) * stage_weights[stage] * 100
-            total_progress = stage_start + stage_progress
-            
-            # Create stage message
-            stage_messages = {
-                'loading': '正在加载文档',
-                'splitting': '正在分割文档',
-                'vectorizing': '正在向量化文档',
-                'saving': '正在保存元数据'
-            }
-            message = stage_messages.get(stage, f'处理阶段: {stage}')
-            
-            # Call progress callback with stage and message
             try:
                 # First try with all parameters
-                progress_callback(min(total_progress, 99.9), stage, message)
+                progress_callback(min(percent, 99.9), stage, message)
             except TypeError:
                 try:
                     # Then try with just progress
-                    progress_callback(min(total_progress, 99.9))
+                    progress_callback(min(percent, 99.9))
                 except Exception as e:
                     # If all fails, log the error but continue
                     logging.error(f"Error calling progress_callback: {e}")
     
+    reported = {'percent': 0.0}
+    
+    def report_pipeline(state: dict):
+        """根据真实的页数和文本块数计算进度（5%~95%）"""
+        if state['loading_done']:
+            loaded = 1.0
+        elif state['total_pages']:
+            loaded = state['pages_done'] / state['total_pages']
+        else:
+            loaded = 0.5
+        written = state['chunks_written'] / max(state['chunks_total'], 1)
+        # 进度单调递增：总块数在加载过程中还会增长
+        percent = max(reported['percent'], 5 + 90 * loaded * written)
+        reported['percent'] = percent
+        pages = f"{state['pages_done']}/{state['total_pages']}" if state['total_pages'] else f"{state['pages_done']}"
+        report_progress(percent, 'vectorizing',
+                        f"已加载 {pages} 页，已写入 {state['chunks_written']}/{state['chunks_total']} 个文本块")
+    
     try:
         print(f"=== 开始处理文档: {os.path.basename(file_path)} ===")
         
         # Set up knowledge base directory
         kb_dir = os.path.join("uploads/knowledge_base", course_id)
         os.makedirs(kb_dir, exist_ok=True)
-        
-        # Stage 1: Loading document
-        print("阶段1: 加载文档...")
-        report_progress('loading', 0, 1)
-        
-        # Determine file type and load document
-        filename = os.path.basename(file_path)
-        _, ext = os.path.splitext(filename)
-        ext = ext.lower()
-        
-        if ext == '.pdf':
-            loader = PyMuPDFLoader(file_path)
-            print("✓ 使用PyMuPDFLoader加载PDF文件")
-        elif ext in ['.docx', '.doc']:
-            loader = Docx2txtLoader(file_path)
-            print("✓ 使用Docx2txtLoader加载Word文件")
-        elif ext in ['.md', '.markdown']:
-            # 直接用open读取Markdown文本，避免复杂Loader
-            try:
-                from langchain_core.documents import Document
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read()
-                docs = [Document(page_content=content, metadata={"source": filename})]
-                print("✓ 用open直接读取md文件成功")
-            except Exception as e:
-                print(f"✗ open读取md失败: {e}")
-                raise
-        else:
-            # Fallback to generic loader
-            loader = UnstructuredFileLoader(file_path, mode="single")
-            print("✓ 使用UnstructuredFileLoader加载文件")
-        
-        if ext not in ['.md', '.markdown']:
-            docs = loader.load()
-        for doc in docs:
-            doc.metadata['source'] = filename
-            # 添加文件用途标记
-            doc.metadata['purpose'] = purpose
-        
-        print(f"✓ 文档加载完成，共 {len(docs)} 个文档")
-        report_progress('loading', 1, 1)
-        
-        # Stage 2: Splitting document
-        print("阶段2: 分割文档...")
-        report_progress('splitting', 0, 1)
-        text_splitter = CustomTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
-        splits = text_splitter.split_documents(docs)
-        
-        # Add a unique ID to each split
-        for i, doc in enumerate(splits):
-            doc.metadata['chunk_id'] = f"chunk_{i}"
-            # 确保每个分割后的文档也有用途标记
-            if 'purpose' not in doc.metadata:
-                doc.metadata['purpose'] = purpose
-        
-        print(f"✓ 文档分割完成，共 {len(splits)} 个文本块")
-        report_progress('splitting', 1, 1)
-        
-        # Stage 3: Vectorizing
-        print("阶段3: 向量化文档...")
-        report_progress('vectorizing', 0, 1)
-        
-        # 创建向量数据库
+        metadata_path = os.path.join(kb_dir, 'processed_files.json')
         persist_dir = os.path.join(kb_dir, "vectordb")
-        os.makedirs(persist_dir, exist_ok=True)
-        
-        # 使用现有的EmbeddingFunction类
-        embedding_function = EmbeddingFunction()
+        filename = os.path.basename(file_path)
+        file_hash = get_file_hash(file_path)
         
-        # 创建Chroma向量数据库，关闭遥测
-        from chromadb.config import Settings
-        vectorstore = Chroma(
-            persist_directory=persist_dir,
-            embedding_function=embedding_function,
-            client_settings=Settings(anonymized_telemetry=False)
+        # 内容和用途都未变化且向量库中已有该文件的块，则跳过重复入库
+        processed_files = load_processed_files_metadata(metadata_path)
+        previous = processed_files.get(filename)
+        if previous and previous.get('hash') == file_hash and previous.get('purpose', 'general') == purpose:
+            vectorstore = open_course_vectorstore(course_id)
+            existing_ids = get_source_chunk_ids(vectorstore, filename)
+            if len(existing_ids) == previous.get('chunks'):
+                print(f"✓ 文件未变化，跳过重复入库: {filename}")
+                report_progress(99.9, 'saving', '文件未变化，跳过重复入库')
+                return True
+        
+        # 流式处理：逐页加载 → 分割 → 批量向量化 → 批量写入
+        print("阶段1-3: 流式加载、分割并向量化文档...")
+        report_progress(0, 'loading', '正在加载文档')
+        chunk_count = stream_file_into_vectorstore(
+            course_id,
+            file_path,
+            purpose=purpose,
+            file_hash=file_hash,
+            split_executor=split_executor,
+            on_progress=report_pipeline
         )
+        print(f"✓ 向量化完成，共 {chunk_count} 个文本块")
         
-        # Add documents to vectorstore
-        print(f"正在添加 {len(splits)} 个文本块到向量数据库...")
-        vectorstore.add_documents(splits)
-        print("✓ 向量化完成")
-        
-        report_progress('vectorizing', 100, 100)
-        
-        # Stage 4: Saving metadata (简化版本，跳过知识图谱)
+        # Stage 4: Saving metadata
         print("阶段4: 保存元数据...")
-        report_progress('saving', 0, 1)
-        
-        # Save metadata about processed files
-        metadata_path = os.path.join(kb_dir, 'processed_files.json')
-        processed_files = {}
-        
-        if os.path.exists(metadata_path):
-            with open(metadata_path, 'r') as f:
-                processed_files = json.load(f)
-        
-        # Add this file to processed files
-        file_hash = hashlib.md5(open(file_path, 'rb').read()).hexdigest()
-        processed_files[filename] = {
-            'hash': file_hash,
-            'processed_at': int(time.time()),
-            'chunks': len(splits),
-            'purpose': purpose  # 添加文件用途
-        }
+        report_progress(95, 'saving', '正在保存元数据')
+        with course_write_lock(course_id):
+            # Save metadata about processed files（重新读取，避免覆盖其他任务的写入）
+            processed_files = load_processed_files_metadata(metadata_path)
+            processed_files[filename] = {
+                'hash': file_hash,
+                'processed_at': int(time.time()),
+                'chunks': chunk_count,
+                'purpose': purpose  # 添加文件用途
+            }
+            save_processed_files_metadata(metadata_path, processed_files)
         
-        with open(metadata_path, 'w') as f:
-            json.dump(processed_files, f, indent=2)
+        # 知识库内容已变化，使查询端缓存的向量存储失效
+        invalidate_course_resources(course_id)
         
         print("✓ 元数据保存完成")
-        report_progress('saving', 1, 1)
+        report_progress(99.9, 'saving', '元数据保存完成')
         
         print(f"=== 文档处理完成: {filename} ===")
-        print(f"✓ 文本块数量: {len(splits)}")
+        print(f"✓ 文本块数量: {chunk_count}")
         print(f"✓ 向量数据库位置: {persist_dir}")
         print(f"✓ 文件用途: {purpose}")
         
@@ -719,75 +889,39 @@ def remove_document_from_knowledge_base(course_id: str, file_path: str) -> bool:
     """
     try:
         # 获取知识库路径
-        persist_dir = get_or_create_course_db_path(course_id)
-        
-        # 计算文件哈希值
-        file_hash = get_file_hash(file_path)
-        
-        # 初始化向量数据库
-        embedding_function = EmbeddingFunction()
-        vectorstore = Chroma(
-            persist_directory=persist_dir,
-            embedding_function=embedding_function
-        )
-        
-        # 获取所有文档
-        all_docs = vectorstore.get()
+        kb_dir = get_or_create_course_db_path(course_id)
+        filename = os.path.basename(file_path)
         
-        # 找到要删除的文档
-        documents_to_remove = []
-        metadatas_to_remove = []
-        ids_to_remove = []
+        with course_write_lock(course_id):
+            # 通过 source 元数据过滤找到该文件的所有块
+            vectorstore = open_course_vectorstore(course_id)
+            ids_to_remove = get_source_chunk_ids(vectorstore, filename)
+            
+            # 更新元数据文件
+            metadata_file = os.path.join(kb_dir, 'processed_files.json')
+            processed_files = load_processed_files_metadata(metadata_file)
+            if filename in processed_files:
+                del processed_files[filename]
+                save_processed_files_metadata(metadata_file, processed_files)
+            
+            # 从向量数据库和全文索引中删除
+            if ids_to_remove:
+                vectorstore.delete(ids=ids_to_remove)
+                _update_bm25(course_id, lambda index: index.remove(ids_to_remove))
+        invalidate_course_resources(course_id)
         
-        for i, metadata in enumerate(all_docs['metadatas']):
-            if metadata.get('file_path') == file_path:
-                documents_to_remove.append(all_docs['documents'][i])
-                metadatas_to_remove.append(metadata)
-                ids_to_remove.append(all_docs['ids'][i])
+        # 撤回该文件在知识图谱中的来源，只删除不再被其他文件引用的节点和边
+        try:
+            removed_nodes, removed_edges = retract_document_from_graph(course_id, filename, ids_to_remove)
+            print(f"从知识图谱中删除了 {removed_nodes} 个节点, {removed_edges} 条关系")
+        except Exception as e:
+            print(f"更新知识图谱时出错: {e}")
         
         if not ids_to_remove:
             print(f"未找到文件 {file_path} 在知识库中的记录")
             return True  # 认为删除成功，因为文件本来就不存在
         
-        # 从向量数据库中删除
-        vectorstore.delete(ids=ids_to_remove)
-        
-        # 更新元数据文件
-        metadata_file = os.path.join(persist_dir, 'processed_files_metadata.json')
-        processed_files = load_processed_files_metadata(metadata_file)
-        
-        # 删除文件记录
-        if file_hash in processed_files:
-            del processed_files[file_hash]
-            save_processed_files_metadata(metadata_file, processed_files)
-        
-        # 重新构建知识图谱（删除相关节点）
-        try:
-            graph_path = os.path.join(persist_dir, 'knowledge_graph.gml')
-            if os.path.exists(graph_path):
-                G = nx.read_gml(graph_path)
-                
-                # 找到与删除文件相关的节点
-                nodes_to_remove = []
-                for node in G.nodes():
-                    node_data = G.nodes[node]
-                    source_chunks = node_data.get('source_chunks', [])
-                    # 检查是否有chunk来自被删除的文件
-                    for chunk_id in source_chunks:
-                        if any(chunk_id == doc_id for doc_id in ids_to_remove):
-                            nodes_to_remove.append(node)
-                            break
-                
-                # 删除相关节点
-                G.remove_nodes_from(nodes_to_remove)
-                
-                # 保存更新后的图谱
-                nx.write_gml(G, graph_path)
-                print(f"从知识图谱中删除了 {len(nodes_to_remove)} 个节点")
-        except Exception as e:
-            print(f"更新知识图谱时出错: {e}")
-        
-        print(f"成功从知识库中删除文件: {file_path}")
+        print(f"成功从知识库中删除文件: {file_path}（{len(ids_to_remove)} 个文本块）")
         return True
         
     except Exception as e:
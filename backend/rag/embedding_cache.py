@@ -0,0 +1,107 @@
+"""
+持久化向量缓存
+
+以 (embedding模型名, 规范化文本的SHA-256) 为键，把向量以 float32 二进制存入 SQLite。
+重新上传修订过的资料、或同一份讲义用于多门课程时，未变化的文本块直接命中缓存，
+不再调用付费的 embedding API。
+
+- 总大小超过上限时按最近访问时间淘汰最旧的条目
+- stats() 返回命中/未命中次数和占用空间
+"""
+
+import os
+import time
+import array
+import hashlib
+import logging
+import unicodedata
+from typing import Dict, List, Optional, Sequence
+
+from backend.config.knowledge_base_config import KnowledgeBaseConfig
+from backend.rag.sqlite_store import LRU_TOUCH_INTERVAL, SQLiteLRUStore, SharedStore
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() != "false"
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(KnowledgeBaseConfig.UPLOADS_DIR, "cache", "embedding_cache.db")
+)
+EMBEDDING_CACHE_MAX_BYTES = int(float(os.getenv("EMBEDDING_CACHE_MAX_MB", "512")) * 1024 * 1024)
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本：NFKC、合并空白、去掉首尾空白"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def text_hash(text: str) -> str:
+    """规范化文本的 SHA-256"""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def _pack(vector: Sequence[float]) -> bytes:
+    return array.array("f", vector).tobytes()
+
+
+def _unpack(blob: bytes) -> List[float]:
+    values = array.array("f")
+    values.frombytes(blob)
+    return values.tolist()
+
+
+class EmbeddingCache(SQLiteLRUStore):
+    """基于 SQLite 的向量缓存，线程安全，可被多个进程共享"""
+
+    TABLE = "embeddings"
+    COLUMNS = (
+        ("model", "TEXT NOT NULL"),
+        ("text_hash", "TEXT NOT NULL"),
+        ("dim", "INTEGER NOT NULL"),
+        ("vector", "BLOB NOT NULL"),
+    )
+    KEY_COLUMNS = ("model", "text_hash")
+    SIZE_EXPR = "LENGTH(vector)"
+    NAME = "向量缓存"
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_bytes: int = EMBEDDING_CACHE_MAX_BYTES):
+        super().__init__(path, max_bytes)
+
+    def get_many(self, model: str, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """批量查询，未命中的位置返回 None"""
+        hashes = [text_hash(text) for text in texts]
+        found: Dict[str, List[float]] = {}
+        stale = []
+        now = int(time.time())
+        rows = self._select("text_hash, vector, last_access", "model = ?", [model], hashes)
+        for key, blob, last_access in rows:
+            found[key] = _unpack(blob)
+            if now - last_access > LRU_TOUCH_INTERVAL:
+                stale.append((model, key))
+        self._touch(stale, now)
+
+        results = [found.get(key) for key in hashes]
+        self._record(sum(1 for vector in results if vector is not None), len(results))
+        return results
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]]):
+        """批量写入向量"""
+        now = int(time.time())
+        rows = []
+        seen = set()
+        for text, vector in zip(texts, vectors):
+            key = text_hash(text)
+            # 不缓存失败时的零向量占位
+            if key in seen or not any(vector):
+                continue
+            seen.add(key)
+            rows.append((model, key, len(vector), _pack(vector), now))
+        self._insert(rows, [len(row[3]) for row in rows])
+
+
+_shared = SharedStore(EmbeddingCache, f"向量缓存 {EMBEDDING_CACHE_PATH}", EMBEDDING_CACHE_ENABLED)
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """返回进程级共享的向量缓存，禁用或无法打开时返回 None"""
+    return _shared.get()
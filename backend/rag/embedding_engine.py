@@ -0,0 +1,351 @@
+"""
+并发批量向量化引擎
+
+用于文档入库阶段的批量 embedding：
+- 复用共享连接池（http_session.get_http_session）
+- 多个批次并发请求，并发数可配置
+- 按 token 预算组批，遇到 429 时自动缩小批次，连续成功后逐步恢复
+- 指数退避 + 随机抖动重试，优先遵循 Retry-After
+- 返回结果与输入顺序一致
+- 先查询持久化向量缓存，只对未命中的文本发起请求
+- 查询向量额外使用进程内 LRU 缓存，重复的问题不再请求API
+
+入库端（create_db）和查询端（rag_query）的 EmbeddingFunction 都委托给同一个引擎。
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from backend.rag.http_session import get_http_session
+from backend.rag.embedding_cache import get_embedding_cache, normalize_text
+
+logger = logging.getLogger(__name__)
+
+# --- Configurable parameters via environment variables ---
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "BAAI/bge-large-zh-v1.5")
+EMBEDDING_DIMENSION = int(os.getenv("EMBEDDING_DIMENSION", "1024"))
+# 同时在途的批次数
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+# 单个请求最多包含的文本数
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+# 单个请求的估算 token 上限
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", "8192"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "5"))
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "30"))
+# 退避参数（秒）
+EMBEDDING_BACKOFF_BASE = 1.0
+EMBEDDING_BACKOFF_CAP = 30.0
+# 连续成功多少个批次后放大批次上限
+EMBEDDING_GROW_AFTER = 4
+# 进程内查询向量 LRU 缓存的条目数
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class EmbeddingAPIError(Exception):
+    """embedding API 请求失败"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约 1 token，其它字符约 4 个 1 token"""
+    cjk = sum(1 for ch in text if '㐀' <= ch <= '鿿' or '豈' <= ch <= '﫿')
+    return cjk + (len(text) - cjk + 3) // 4 + 1
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 头（只支持秒数形式）"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class EmbeddingEngine:
+    """并发批量向量化引擎，线程安全，可在多个入库任务之间共享"""
+
+    def __init__(self,
+                 model: Optional[str] = None,
+                 concurrency: int = EMBEDDING_CONCURRENCY,
+                 max_batch_size: int = EMBEDDING_BATCH_SIZE,
+                 max_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+                 max_retries: int = EMBEDDING_MAX_RETRIES,
+                 dimension: int = EMBEDDING_DIMENSION):
+        self.model = model or EMBEDDING_MODEL
+        self.concurrency = max(1, concurrency)
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_batch_tokens = max(1, max_batch_tokens)
+        self.max_retries = max_retries
+        self.dimension = dimension
+
+        # 自适应批次上限：429 时减半，连续成功后逐步增大
+        self._batch_limit = self.max_batch_size
+        self._success_streak = 0
+        self._limit_lock = threading.Lock()
+
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embedding")
+
+        # 查询向量的进程内 LRU 缓存
+        self._query_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+
+    # --- 批次大小自适应 ---
+    @property
+    def batch_limit(self) -> int:
+        with self._limit_lock:
+            return self._batch_limit
+
+    def _on_success(self):
+        with self._limit_lock:
+            self._success_streak += 1
+            if self._success_streak >= EMBEDDING_GROW_AFTER and self._batch_limit < self.max_batch_size:
+                self._batch_limit = min(self.max_batch_size, self._batch_limit * 2)
+                self._success_streak = 0
+                logger.info(f"embedding 批次上限恢复到 {self._batch_limit}")
+
+    def _on_rate_limited(self):
+        with self._limit_lock:
+            self._success_streak = 0
+            if self._batch_limit > 1:
+                self._batch_limit = max(1, self._batch_limit // 2)
+                logger.warning(f"embedding 请求被限流，批次上限降为 {self._batch_limit}")
+
+    def _next_batch(self, texts: List[str], indices: List[int], start: int) -> List[int]:
+        """从 indices[start:] 中按当前批次上限和 token 预算取出下一批"""
+        limit = self.batch_limit
+        batch = []
+        tokens = 0
+        for i in indices[start:]:
+            cost = estimate_tokens(texts[i])
+            if batch and (len(batch) >= limit or tokens + cost > self.max_batch_tokens):
+                break
+            batch.append(i)
+            tokens += cost
+        return batch
+
+    # --- HTTP 请求 ---
+    def _request(self, batch: List[str]) -> List[List[float]]:
+        """发送一次 embedding 请求，返回与 batch 顺序一致的向量"""
+        api_key = os.getenv("LLM_API_KEY")
+        api_base = os.getenv("LLM_API_BASE", "https://api.siliconflow.cn/v1")
+        if not api_key:
+            raise EmbeddingAPIError("LLM_API_KEY not found in .env file.", status_code=401)
+
+        try:
+            response = get_http_session().post(
+                f"{api_base}/embeddings",
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {api_key}"
+                },
+                json={
+                    "model": self.model,
+                    "input": batch,
+                    "encoding_format": "float"
+                },
+                timeout=EMBEDDING_TIMEOUT
+            )
+        except requests.exceptions.RequestException as e:
+            raise EmbeddingAPIError(f"API请求异常: {e}") from e
+
+        if response.status_code != 200:
+            raise EmbeddingAPIError(
+                f"API request failed with status {response.status_code}: {response.text[:200]}",
+                status_code=response.status_code,
+                retry_after=_parse_retry_after(response.headers.get("Retry-After"))
+            )
+
+        data = response.json().get("data")
+        if not isinstance(data, list) or len(data) != len(batch):
+            raise EmbeddingAPIError(f"API响应格式错误：期望 {len(batch)} 个embedding")
+        # OpenAI 兼容接口带 index 字段，按 index 排序保证顺序
+        if all("index" in item for item in data):
+            data = sorted(data, key=lambda item: item["index"])
+
+        vectors = []
+        for i, item in enumerate(data):
+            embedding = item.get("embedding")
+            if not isinstance(embedding, list) or len(embedding) != self.dimension:
+                actual = len(embedding) if isinstance(embedding, list) else None
+                raise EmbeddingAPIError(f"API响应格式错误：第 {i} 个embedding维度不正确，期望{self.dimension}，实际{actual}")
+            vectors.append(embedding)
+        return vectors
+
+    def _embed_batch(self, batch: List[str]) -> List[List[float]]:
+        """带重试地向量化一个批次，成功后写入向量缓存"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                vectors = self._request(batch)
+                self._on_success()
+                cache = get_embedding_cache()
+                if cache:
+                    try:
+                        cache.put_many(self.model, batch, vectors)
+                    except Exception as e:
+                        logger.error(f"写入向量缓存失败: {e}")
+                return vectors
+            except EmbeddingAPIError as e:
+                if e.status_code == 413 and len(batch) > 1:
+                    # 请求体过大，拆成两半分别处理
+                    self._on_rate_limited()
+                    mid = len(batch) // 2
+                    return self._embed_batch(batch[:mid]) + self._embed_batch(batch[mid:])
+                retryable = e.status_code is None or e.status_code in RETRYABLE_STATUS
+                if e.status_code == 429:
+                    self._on_rate_limited()
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                # 指数退避 + 全抖动，服务端给出 Retry-After 时至少等待该时长
+                backoff = random.uniform(0, min(EMBEDDING_BACKOFF_CAP, EMBEDDING_BACKOFF_BASE * (2 ** attempt)))
+                wait_time = max(backoff, e.retry_after or 0.0)
+                logger.warning(f"embedding 批次失败 (尝试 {attempt + 1}/{self.max_retries + 1}): {e}，{wait_time:.1f} 秒后重试")
+                time.sleep(wait_time)
+        raise EmbeddingAPIError("embedding 重试次数已用尽")
+
+    # --- 对外接口 ---
+    def embed(self,
+              texts: List[str],
+              progress_callback: Optional[Callable[[float], None]] = None,
+              placeholder_on_error: bool = False) -> List[List[float]]:
+        """
+        并发批量向量化，结果与输入顺序一一对应。
+
+        Args:
+            texts: 待向量化的文本列表，空文本返回零向量
+            progress_callback: 进度回调，参数为 0-100 的完成百分比
+            placeholder_on_error: 批次最终失败时用零向量占位而不是抛出异常
+        """
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        indices = []
+        for i, text in enumerate(texts):
+            if text and text.strip():
+                indices.append(i)
+            else:
+                results[i] = [0.0] * self.dimension
+        stripped = {i: texts[i].strip() for i in indices}
+
+        # 命中缓存的文本不再请求API
+        cache = get_embedding_cache()
+        if cache and indices:
+            try:
+                cached = cache.get_many(self.model, [stripped[i] for i in indices])
+                misses = []
+                for i, vector in zip(indices, cached):
+                    if vector is None:
+                        misses.append(i)
+                    else:
+                        results[i] = vector
+                if len(misses) < len(indices):
+                    logger.info(f"向量缓存命中 {len(indices) - len(misses)}/{len(indices)} 个文本")
+                indices = misses
+            except Exception as e:
+                logger.error(f"查询向量缓存失败: {e}")
+
+        total = len(indices)
+        completed = 0
+        position = 0
+        in_flight: Dict = {}
+
+        if total:
+            logger.info(f"开始向量化 {total} 个文本，并发数: {self.concurrency}，批次上限: {self.batch_limit}")
+
+        try:
+            while position < total or in_flight:
+                # 填满在途批次
+                while position < total and len(in_flight) < self.concurrency:
+                    batch_indices = self._next_batch(texts, indices, position)
+                    position += len(batch_indices)
+                    future = self._executor.submit(self._embed_batch, [stripped[i] for i in batch_indices])
+                    in_flight[future] = batch_indices
+
+                done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch_indices = in_flight.pop(future)
+                    try:
+                        vectors = future.result()
+                    except Exception as e:
+                        if not placeholder_on_error:
+                            raise
+                        logger.error(f"{len(batch_indices)} 个文本向量化失败，使用零向量占位: {e}")
+                        vectors = [[0.0] * self.dimension for _ in batch_indices]
+                    for i, vector in zip(batch_indices, vectors):
+                        results[i] = vector
+
+                    completed += len(batch_indices)
+                    if progress_callback:
+                        try:
+                            progress_callback(completed / total * 100)
+                        except Exception as e:
+                            logger.error(f"Error calling progress_callback: {e}")
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+        if total:
+            logger.info(f"向量化完成: {total} 个embedding")
+        elif texts and progress_callback:
+            progress_callback(100.0)
+        return results  # type: ignore[return-value]
+
+
+    def embed_query(self, text: str) -> List[float]:
+        """向量化单个查询，重复的问题直接从进程内 LRU 缓存返回
+
+        规范化文本只用作缓存键，请求的是原始文本。查询直接在调用线程上请求，
+        不进入入库共用的线程池，批量上传时不会排在入库批次和它们的退避等待之后。
+        """
+        key = normalize_text(text)
+        if not key:
+            return [0.0] * self.dimension
+        with self._query_cache_lock:
+            vector = self._query_cache.get(key)
+            if vector is not None:
+                self._query_cache.move_to_end(key)
+                return vector
+
+        query = text.strip()
+        vector = None
+        cache = get_embedding_cache()
+        if cache:
+            try:
+                vector = cache.get_many(self.model, [query])[0]
+            except Exception as e:
+                logger.error(f"查询向量缓存失败: {e}")
+        if vector is None:
+            vector = self._embed_batch([query])[0]
+
+        with self._query_cache_lock:
+            self._query_cache[key] = vector
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return vector
+
+
+_engine: Optional[EmbeddingEngine] = None
+_engine_lock = threading.Lock()
+
+
+def get_embedding_engine() -> EmbeddingEngine:
+    """返回进程级共享的向量化引擎"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = EmbeddingEngine()
+    return _engine
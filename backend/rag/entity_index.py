@@ -0,0 +1,254 @@
+"""
+知识图谱实体名索引
+
+图谱加载后为节点名建立一次索引，查询时不再逐个节点做字符串比较：
+- 精确查找：归一化名称 -> 节点名的哈希表
+- Aho-Corasick 自动机：一次扫描找出查询中出现的所有已知实体名，耗时与查询长度成正比
+- 字符 n-gram 倒排：模糊匹配近似的实体名（错字、缺字），以及查找包含某个词的实体名
+- extract_entities：结合以上三者和中文分词在本地识别查询实体，多数查询无需再调用 LLM
+
+CSRGraph 是只读的，索引按图对象缓存；文件被替换后 load_course_graph 返回新的图对象，
+索引随之重建。
+"""
+
+import os
+import logging
+import threading
+import weakref
+from collections import Counter, deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from backend.rag.zh_tokenizer import segment
+
+logger = logging.getLogger(__name__)
+
+# 模糊匹配使用的 n-gram 长度
+FUZZY_NGRAM = 2
+# 模糊匹配的最低相似度（Dice 系数）
+FUZZY_THRESHOLD = 0.6
+# 从查询分词结果模糊匹配实体时使用更严格的阈值，避免普通词误匹配
+QUERY_FUZZY_THRESHOLD = float(os.getenv("QUERY_ENTITY_FUZZY_THRESHOLD", "0.75"))
+
+# 提问常用词，不作为实体候选
+_QUERY_STOPWORDS = {
+    "什么", "如何", "怎么", "怎样", "为什么", "哪些", "哪个", "是否", "请问", "介绍", "解释",
+    "说明", "区别", "关系", "联系", "作用", "意思", "含义", "举例", "一下", "可以", "能否",
+    "WHAT", "HOW", "WHY", "WHICH", "THE", "AND", "IS", "ARE", "OF",
+}
+
+
+def normalize_entity_name(name) -> str:
+    """实体名归一化：去除首尾空白、合并连续空白并转为大写，作为图中节点的键"""
+    if not isinstance(name, str):
+        return ""
+    return " ".join(name.split()).upper()
+
+
+def _is_word_char(ch: str) -> bool:
+    """ASCII 字母数字，英文实体名需要在这类字符处断词"""
+    return ch.isascii() and ch.isalnum()
+
+
+def _ngrams(text: str, n: int = FUZZY_NGRAM, padded: bool = False) -> List[str]:
+    """字符 n-gram；padded 时在首尾补边界符，让首尾字符相同的名称得分更高"""
+    if padded and text:
+        text = "\x02" + text + "\x03"
+    if len(text) <= n:
+        return [text] if text else []
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+class EntityIndex:
+    """实体名索引，构建后只读，可在多个线程间共享"""
+
+    def __init__(self, names: Iterable[str]):
+        # 归一化名称 -> 节点名
+        self._exact: Dict[str, str] = {}
+        for name in names:
+            key = normalize_entity_name(name)
+            if key:
+                self._exact.setdefault(key, name)
+        self._keys: List[str] = list(self._exact)
+
+        # n-gram 倒排（含首尾边界 gram）：gram -> 名称编号
+        self._grams: Dict[str, List[int]] = {}
+        self._gram_counts: List[int] = []
+        for i, key in enumerate(self._keys):
+            grams = set(_ngrams(key, padded=True))
+            self._gram_counts.append(len(grams))
+            for gram in grams:
+                self._grams.setdefault(gram, []).append(i)
+
+        self._build_automaton()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    # --- Aho-Corasick ---
+
+    def _build_automaton(self):
+        """构建 goto / fail / output 表，状态 0 为根"""
+        goto: List[Dict[str, int]] = [{}]
+        output: List[List[int]] = [[]]
+        for i, key in enumerate(self._keys):
+            state = 0
+            for ch in key:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    output.append([])
+                state = nxt
+            output[state].append(i)
+
+        # 第一层状态的失败指针指向根，其余按 BFS 顺序沿父状态的失败链计算
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                if state == 0:
+                    continue
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                # 合并失败链上的输出，匹配时不用再沿失败链回溯
+                output[nxt] = output[nxt] + output[fail[nxt]]
+
+        self._goto = goto
+        self._fail = fail
+        self._output = output
+
+    def find_all(self, text: str) -> List[Tuple[int, int, str]]:
+        """一次扫描找出文本中出现的所有实体名，返回 [(起始, 结束, 节点名)]
+
+        英文实体名要求两侧不是字母数字（避免 AI 匹配到 MAIL 中），中文实体名不做此限制。
+        """
+        text = normalize_entity_name(text)
+        goto, fail, output = self._goto, self._fail, self._output
+        matches = []
+        state = 0
+        for pos, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for i in output[state]:
+                key = self._keys[i]
+                start = pos - len(key) + 1
+                end = pos + 1
+                if _is_word_char(key[0]) and start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                if _is_word_char(key[-1]) and end < len(text) and _is_word_char(text[end]):
+                    continue
+                matches.append((start, end, self._exact[key]))
+        return matches
+
+    def match(self, text: str) -> List[str]:
+        """返回文本中出现的实体名，优先取最长且不重叠的匹配，按出现顺序排列"""
+        # 从长到短贪心选取，与已选匹配重叠的跳过（“机器学习”优先于其中的“学习”）
+        matches = sorted(self.find_all(text), key=lambda m: (m[0] - m[1], m[0]))
+        taken = set()
+        chosen = []
+        for start, end, name in matches:
+            span = range(start, end)
+            if any(pos in taken for pos in span):
+                continue
+            taken.update(span)
+            chosen.append((start, name))
+        chosen.sort()
+        return list(dict.fromkeys(name for _, name in chosen))
+
+    def extract_entities(self, query: str, fuzzy_threshold: float = QUERY_FUZZY_THRESHOLD) -> List[str]:
+        """在本地从查询中识别图谱实体，不调用 LLM
+
+        先用自动机取出查询中完整出现的实体名，再对分词后未被覆盖的词做精确/模糊匹配
+        （用于错字、简写等情况）。返回空列表时调用方再考虑用 LLM 提取。
+        """
+        entities = self.match(query)
+        covered = normalize_entity_name(" ".join(entities))
+        for word in segment(query):
+            key = normalize_entity_name(word)
+            if len(key) < 2 or key in _QUERY_STOPWORDS or key in covered:
+                continue
+            node = self.resolve(key, threshold=fuzzy_threshold)
+            if node is not None:
+                entities.append(node)
+        return list(dict.fromkeys(entities))
+
+    # --- 精确 / 模糊 ---
+
+    def lookup(self, name: str) -> Optional[str]:
+        """精确查找，返回图中的节点名"""
+        return self._exact.get(normalize_entity_name(name))
+
+    def fuzzy(self, name: str, limit: int = 5, threshold: float = FUZZY_THRESHOLD) -> List[Tuple[str, float]]:
+        """按字符 n-gram 的 Dice 系数模糊匹配，返回 [(节点名, 相似度)]，相似度从高到低"""
+        key = normalize_entity_name(name)
+        grams = set(_ngrams(key, padded=True))
+        if not grams:
+            return []
+        overlap: Counter = Counter()
+        for gram in grams:
+            for i in self._grams.get(gram, ()):
+                overlap[i] += 1
+        scored = []
+        for i, shared in overlap.items():
+            score = 2 * shared / (len(grams) + self._gram_counts[i])
+            if score >= threshold:
+                scored.append((self._exact[self._keys[i]], score))
+        scored.sort(key=lambda item: -item[1])
+        return scored[:limit]
+
+    def resolve(self, name: str, threshold: float = FUZZY_THRESHOLD) -> Optional[str]:
+        """把实体名解析为图中的节点名：先精确匹配，再取最相近的模糊匹配"""
+        exact = self.lookup(name)
+        if exact is not None:
+            return exact
+        candidates = self.fuzzy(name, limit=1, threshold=threshold)
+        return candidates[0][0] if candidates else None
+
+    def containing(self, term: str, limit: Optional[int] = None) -> List[str]:
+        """返回名称中包含 term 的节点名（用 n-gram 倒排缩小候选后再校验）"""
+        key = normalize_entity_name(term)
+        if not key:
+            return []
+        if len(key) < FUZZY_NGRAM:
+            # 单字符查询不在 bigram 倒排中，退回线性扫描
+            candidates = range(len(self._keys))
+        else:
+            candidates = None
+            for gram in sorted(set(_ngrams(key)), key=lambda g: len(self._grams.get(g, ()))):
+                ids = self._grams.get(gram)
+                if not ids:
+                    return []
+                candidates = set(ids) if candidates is None else candidates.intersection(ids)
+                if not candidates:
+                    return []
+        found = [self._exact[self._keys[i]] for i in sorted(candidates) if key in self._keys[i]]
+        return found[:limit] if limit else found
+
+
+_indexes: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_indexes_lock = threading.Lock()
+
+
+def get_entity_index(graph) -> EntityIndex:
+    """返回图的实体名索引
+
+    只读的 CSRGraph 按图对象缓存索引；可修改的 networkx 图每次重新构建。
+    """
+    from backend.rag.graph_store import CSRGraph
+
+    if not isinstance(graph, CSRGraph):
+        return EntityIndex(graph.nodes())
+    with _indexes_lock:
+        index = _indexes.get(graph)
+    if index is None:
+        index = EntityIndex(graph.nodes())
+        with _indexes_lock:
+            index = _indexes.setdefault(graph, index)
+        logger.info(f"已为知识图谱建立实体名索引: {len(index)} 个实体")
+    return index
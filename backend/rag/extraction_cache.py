@@ -0,0 +1,108 @@
+"""
+持久化实体/关系抽取缓存
+
+以 (抽取提示词模板的哈希, LLM模型名, 规范化文本的SHA-256) 为键，把文档块的抽取结果
+以 JSON 存入 SQLite。强制重建图谱、崩溃后重新构建、或同一份讲义用于多门课程时，
+未变化的文本块直接命中缓存，不再调用 LLM。
+
+- 修改提示词模板或更换模型后自然失效（键不同）
+- 总大小超过上限时按最近访问时间淘汰最旧的条目
+- stats() 返回命中/未命中次数、命中率和占用空间
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from backend.config.knowledge_base_config import KnowledgeBaseConfig
+from backend.rag.embedding_cache import text_hash
+from backend.rag.sqlite_store import LRU_TOUCH_INTERVAL, SQLiteLRUStore, SharedStore
+
+logger = logging.getLogger(__name__)
+
+EXTRACTION_CACHE_ENABLED = os.getenv("EXTRACTION_CACHE_ENABLED", "true").lower() != "false"
+EXTRACTION_CACHE_PATH = os.getenv(
+    "EXTRACTION_CACHE_PATH",
+    os.path.join(KnowledgeBaseConfig.UPLOADS_DIR, "cache", "extraction_cache.db")
+)
+EXTRACTION_CACHE_MAX_BYTES = int(float(os.getenv("EXTRACTION_CACHE_MAX_MB", "256")) * 1024 * 1024)
+
+Extraction = Tuple[List[Dict], List[Dict]]
+
+
+def prompt_hash(template: str) -> str:
+    """提示词模板的哈希，作为缓存键的一部分"""
+    return hashlib.sha256(template.encode("utf-8")).hexdigest()[:16]
+
+
+class ExtractionCache(SQLiteLRUStore):
+    """基于 SQLite 的抽取结果缓存，线程安全，可被多个进程共享"""
+
+    TABLE = "extractions"
+    COLUMNS = (
+        ("prompt_hash", "TEXT NOT NULL"),
+        ("model", "TEXT NOT NULL"),
+        ("text_hash", "TEXT NOT NULL"),
+        ("result", "TEXT NOT NULL"),
+    )
+    KEY_COLUMNS = ("prompt_hash", "model", "text_hash")
+    SIZE_EXPR = "LENGTH(CAST(result AS BLOB))"
+    NAME = "抽取缓存"
+
+    def __init__(self, path: str = EXTRACTION_CACHE_PATH, max_bytes: int = EXTRACTION_CACHE_MAX_BYTES):
+        super().__init__(path, max_bytes)
+
+    def get_many(self, prompt_keys: Union[str, Sequence[str]], model: str,
+                 texts: Sequence[str]) -> List[Optional[Extraction]]:
+        """批量查询，未命中的位置返回 None
+
+        prompt_keys 可以给出多个提示词哈希（如单块和批量两种模板），按顺序优先使用。
+        """
+        if isinstance(prompt_keys, str):
+            prompt_keys = [prompt_keys]
+        priority = {key: i for i, key in enumerate(prompt_keys)}
+        hashes = [text_hash(text) for text in texts]
+        found: Dict[str, Tuple[int, Extraction]] = {}
+        stale = []
+        now = int(time.time())
+
+        key_placeholders = ",".join("?" * len(priority))
+        rows = self._select(
+            "prompt_hash, text_hash, result, last_access",
+            f"prompt_hash IN ({key_placeholders}) AND model = ?", [*priority, model], hashes
+        )
+        for prompt_key, key, result, last_access in rows:
+            rank = priority[prompt_key]
+            if key in found and found[key][0] <= rank:
+                continue
+            try:
+                data = json.loads(result)
+                found[key] = (rank, (data.get("entities", []), data.get("relationships", [])))
+            except (ValueError, AttributeError):
+                continue
+            if now - last_access > LRU_TOUCH_INTERVAL:
+                stale.append((prompt_key, model, key))
+        self._touch(stale, now)
+
+        results = [found[key][1] if key in found else None for key in hashes]
+        self._record(sum(1 for result in results if result is not None), len(results))
+        return results
+
+    def put(self, prompt_key: str, model: str, text: str, entities: List[Dict], relationships: List[Dict]):
+        """写入一个文档块的抽取结果"""
+        result = json.dumps({"entities": entities, "relationships": relationships}, ensure_ascii=False)
+        self._insert(
+            [(prompt_key, model, text_hash(text), result, int(time.time()))],
+            [len(result.encode("utf-8"))]
+        )
+
+
+_shared = SharedStore(ExtractionCache, f"抽取缓存 {EXTRACTION_CACHE_PATH}", EXTRACTION_CACHE_ENABLED)
+
+
+def get_extraction_cache() -> Optional[ExtractionCache]:
+    """返回进程级共享的抽取缓存，禁用或无法打开时返回 None"""
+    return _shared.get()
@@ -0,0 +1,168 @@
+"""
+知识图谱抽取调度器
+
+代替按批次等待的抽取循环：
+- 滑动窗口：始终保持 concurrency 个请求在途，任一完成后立即补上下一个文档块
+- 并发和限流：给出 LLM 网关的服务商时，与对话、评分、出题等调用共用该服务商的并发名额、
+  请求速率和 token 速率令牌桶，429 和 Retry-After 让所有调用方一起退避；
+  否则同一进程内所有图谱构建共享 GRAPH_CONCURRENCY 个请求名额
+- 单个文档块失败时按指数退避重试，不影响其他文档块
+- 结果按完成顺序回调，调用方可以边抽取边合并进图
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Tuple
+
+from backend.rag.rate_limiter import TokenBucket, rate_limit_info
+
+logger = logging.getLogger(__name__)
+
+# 进程内同时在途的抽取请求数
+GRAPH_CONCURRENCY = int(os.getenv("GRAPH_CONCURRENCY", "8"))
+# 单个文档块的重试次数
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "3"))
+# 退避参数（秒）
+GRAPH_BACKOFF_BASE = 1.0
+GRAPH_BACKOFF_CAP = 30.0
+
+# 不可重试的状态码（请求本身有问题）
+NON_RETRYABLE_STATUS = {400, 401, 403, 404, 422}
+
+
+class _GlobalSlots:
+    """进程级并发名额，可在不同线程的事件循环之间共享"""
+
+    def __init__(self, limit: int):
+        self._semaphore = threading.BoundedSemaphore(max(1, limit))
+
+    async def acquire(self):
+        while not self._semaphore.acquire(blocking=False):
+            await asyncio.sleep(0.05)
+
+    def release(self):
+        self._semaphore.release()
+
+
+_global_slots = _GlobalSlots(GRAPH_CONCURRENCY)
+
+
+class ExtractionScheduler:
+    """以滑动窗口调度抽取请求
+
+    extract(item) 为协程函数；run() 对每个 item 回调 on_result(item, result, error)，
+    重试用尽时 result 为 None、error 为最后一次的异常。回调中可以调用 requeue()
+    追加新的 item（如批量请求解析失败后改为逐个请求）。
+
+    provider 为 LLM 网关的服务商（get_llm_client(...).provider），给出时每个请求通过它的
+    acquire_async / release 占用并发名额和令牌，cost(item) 为预计消耗的 token 数，
+    429 反馈给它的请求速率令牌桶；limiter 只在没有 provider 时使用。
+    """
+
+    def __init__(self, extract: Callable[[Any], Awaitable[Any]],
+                 limiter: Optional[TokenBucket] = None,
+                 concurrency: int = GRAPH_CONCURRENCY,
+                 max_retries: int = GRAPH_MAX_RETRIES,
+                 provider: Optional[Any] = None,
+                 cost: Optional[Callable[[Any], int]] = None):
+        self.extract = extract
+        self.provider = provider
+        self.cost = cost
+        self.limiter = provider.requests if provider is not None else limiter
+        self.concurrency = max(1, concurrency)
+        self.max_retries = max(0, max_retries)
+        self.requests = 0
+        self.retries = 0
+        self.failed = 0
+        self._requeued = deque()
+
+    def requeue(self, item):
+        """追加一个 item，优先于尚未开始的 item 调度"""
+        self._requeued.append(item)
+
+    async def _acquire(self, item):
+        if self.provider is not None:
+            await self.provider.acquire_async(self.cost(item) if self.cost is not None else 0)
+            return
+        if self.limiter is not None:
+            await self.limiter.acquire_async()
+        await _global_slots.acquire()
+
+    def _release(self):
+        if self.provider is not None:
+            self.provider.release()
+        else:
+            _global_slots.release()
+
+    async def _run_one(self, item) -> Tuple[Any, Any, Optional[Exception]]:
+        for attempt in range(self.max_retries + 1):
+            await self._acquire(item)
+            try:
+                self.requests += 1
+                result = await self.extract(item)
+            except Exception as e:
+                error = e
+            else:
+                if self.limiter is not None:
+                    self.limiter.on_success()
+                return item, result, None
+            finally:
+                self._release()
+
+            status, retry_after = rate_limit_info(error)
+            if status == 429 and self.limiter is not None:
+                self.limiter.on_rate_limited(retry_after)
+            if status in NON_RETRYABLE_STATUS or attempt >= self.max_retries:
+                break
+            # 指数退避 + 全抖动，服务端给出 Retry-After 时至少等待该时长
+            self.retries += 1
+            backoff = random.uniform(0, min(GRAPH_BACKOFF_CAP, GRAPH_BACKOFF_BASE * (2 ** attempt)))
+            wait_time = max(backoff, retry_after or 0.0)
+            logger.warning(f"抽取失败 (尝试 {attempt + 1}/{self.max_retries + 1}): {error}，{wait_time:.1f} 秒后重试")
+            await asyncio.sleep(wait_time)
+
+        self.failed += 1
+        return item, None, error
+
+    async def run(self, items: Iterable[Any],
+                  on_result: Optional[Callable[[Any, Any, Optional[Exception]], None]] = None) -> List[Tuple[Any, Any, Optional[Exception]]]:
+        """调度所有 item，返回按完成顺序排列的 (item, result, error)"""
+        items = iter(items)
+        in_flight = set()
+        finished = []
+        started = time.monotonic()
+
+        def fill():
+            while len(in_flight) < self.concurrency:
+                item = self._requeued.popleft() if self._requeued else next(items, _DONE)
+                if item is _DONE:
+                    return
+                in_flight.add(asyncio.ensure_future(self._run_one(item)))
+
+        fill()
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                in_flight.discard(task)
+                outcome = task.result()
+                finished.append(outcome)
+                if on_result is not None:
+                    try:
+                        on_result(*outcome)
+                    except Exception as e:
+                        logger.error(f"处理抽取结果时出错: {e}")
+            fill()
+
+        logger.info(
+            f"抽取完成: {len(finished)} 项, {self.requests} 次请求, {self.retries} 次重试, "
+            f"{self.failed} 项失败, 用时 {time.monotonic() - started:.1f} 秒"
+        )
+        return finished
+
+
+_DONE = object()
@@ -0,0 +1,227 @@
+"""
+知识图谱分析结果
+
+保存图谱时一并计算，写入课程目录下的 graph_analytics.json，查询和生成时直接读取：
+- 每个节点的度数、PageRank、所属社区和来源文本块数
+- 社区划分（Louvain，大图用标签传播，失败时退回连通分量）及每个社区的摘要：核心实体、主要类型、常见关系
+- 课程核心概念：按 PageRank 排序的前若干个实体
+- 文本块 -> 实体的倒排索引
+
+文件记录生成时图谱文件的签名，图谱被其他进程更新后旧的分析结果自动视为过期。
+查询时 get_node_centrality 提供归一化的 PageRank，图谱邻域扩展用它给相关度相近的节点排序。
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, List
+
+import networkx as nx
+
+from backend.rag.course_lock import KNOWLEDGE_BASE_ROOT
+from backend.rag.graph_store import course_graph_signature
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_FILENAME = "graph_analytics.json"
+# 保存的核心概念数
+KEY_CONCEPTS_LIMIT = int(os.getenv("GRAPH_KEY_CONCEPTS_LIMIT", "50"))
+# 超过该边数时社区划分改用标签传播
+LOUVAIN_MAX_EDGES = int(os.getenv("GRAPH_LOUVAIN_MAX_EDGES", "20000"))
+# 每个社区摘要中列出的实体数
+COMMUNITY_TOP_ENTITIES = 10
+
+_ANALYTICS_VERSION = 1
+
+
+def pagerank(graph: nx.Graph, alpha: float = 0.85, max_iter: int = 100, tol: float = 1.0e-6) -> Dict[str, float]:
+    """幂迭代计算 PageRank（nx.pagerank 依赖 scipy，这里不引入额外依赖）"""
+    n = graph.number_of_nodes()
+    if not n:
+        return {}
+    rank = dict.fromkeys(graph, 1.0 / n)
+    degree = dict(graph.degree())
+    for _ in range(max_iter):
+        # 孤立节点的分数均匀分配给所有节点
+        dangling = alpha * sum(rank[node] for node in graph if not degree[node]) / n
+        new_rank = {}
+        for node in graph:
+            incoming = sum(rank[neighbor] / degree[neighbor] for neighbor in graph.neighbors(node))
+            new_rank[node] = (1 - alpha) / n + dangling + alpha * incoming
+        delta = sum(abs(new_rank[node] - rank[node]) for node in graph)
+        rank = new_rank
+        if delta < n * tol:
+            break
+    return rank
+
+
+def detect_communities(graph: nx.Graph) -> List[List[str]]:
+    """社区划分，按社区大小从大到小排列
+
+    边数不超过 LOUVAIN_MAX_EDGES 时用 Louvain，更大的图用近线性的标签传播，控制保存耗时。
+    """
+    try:
+        if graph.number_of_edges() <= LOUVAIN_MAX_EDGES:
+            communities = nx.community.louvain_communities(graph, seed=42)
+        else:
+            communities = nx.community.label_propagation_communities(graph)
+    except Exception as e:
+        logger.warning(f"社区划分失败，改用连通分量: {e}")
+        communities = nx.connected_components(graph)
+    return sorted((sorted(c) for c in communities), key=lambda c: (-len(c), c[0] if c else ""))
+
+
+def compute_graph_analytics(graph: nx.Graph) -> Dict[str, Any]:
+    """计算图谱的分析结果"""
+    ranks = pagerank(graph)
+    communities = detect_communities(graph)
+    membership = {node: cid for cid, members in enumerate(communities) for node in members}
+
+    nodes = {}
+    chunk_entities: Dict[str, List[str]] = {}
+    for node, data in graph.nodes(data=True):
+        chunks = list(dict.fromkeys(data.get('source_chunks', []) or []))
+        nodes[node] = {
+            "type": data.get('type', 'Unknown'),
+            "degree": graph.degree(node),
+            "pagerank": ranks.get(node, 0.0),
+            "community": membership.get(node),
+            "chunk_count": len(chunks),
+        }
+        for chunk_id in chunks:
+            chunk_entities.setdefault(chunk_id, []).append(node)
+
+    # 文本块内的实体按 PageRank 排序，取前几个即为该块最重要的概念
+    for chunk_id, entities in chunk_entities.items():
+        entities.sort(key=lambda name: -ranks.get(name, 0.0))
+
+    summaries = []
+    for cid, members in enumerate(communities):
+        top = sorted(members, key=lambda name: -ranks.get(name, 0.0))[:COMMUNITY_TOP_ENTITIES]
+        types = Counter(nodes[name]["type"] for name in members)
+        labels = Counter(
+            data.get('label', '') for _, _, data in graph.subgraph(members).edges(data=True) if data.get('label')
+        )
+        summary = f"核心实体: {'、'.join(top)}"
+        if types:
+            summary += f"；主要类型: {'、'.join(f'{t}({c})' for t, c in types.most_common(3))}"
+        if labels:
+            summary += f"；常见关系: {'、'.join(label for label, _ in labels.most_common(3))}"
+        summaries.append({
+            "id": cid,
+            "size": len(members),
+            "entities": top,
+            "summary": summary,
+        })
+
+    key_concepts = [
+        {"name": name, **nodes[name]}
+        for name in sorted(nodes, key=lambda name: -nodes[name]["pagerank"])[:KEY_CONCEPTS_LIMIT]
+    ]
+
+    return {
+        "version": _ANALYTICS_VERSION,
+        "node_count": graph.number_of_nodes(),
+        "edge_count": graph.number_of_edges(),
+        "key_concepts": key_concepts,
+        "communities": summaries,
+        "nodes": nodes,
+        "chunk_entities": chunk_entities,
+    }
+
+
+def analytics_path(course_id: str) -> str:
+    return os.path.join(KNOWLEDGE_BASE_ROOT, str(course_id), ANALYTICS_FILENAME)
+
+
+def save_graph_analytics(course_id: str, graph: nx.Graph, signature=None):
+    """计算并保存课程图谱的分析结果，应在图谱文件保存之后调用
+
+    signature 为保存 graph 时的 course_graph_signature，可在课程写锁之外计算：计算期间图谱又被保存时
+    不再写入，已写入的结果也会因签名不符被读取方视为过期。不给出时取当前签名。
+    """
+    started = time.time()
+    if signature is None:
+        signature = course_graph_signature(course_id)
+    analytics = compute_graph_analytics(graph)
+    if course_graph_signature(course_id) != signature:
+        logger.info("计算分析结果期间知识图谱已被修改，丢弃本次结果")
+        return
+    analytics["course_id"] = str(course_id)
+    analytics["generated_at"] = int(time.time())
+    analytics["graph_signature"] = list(signature) if signature else None
+
+    path = analytics_path(course_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(analytics, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    logger.info(f"已保存知识图谱分析结果: {len(analytics['communities'])} 个社区，用时 {time.time() - started:.1f} 秒")
+
+
+_cache: Dict[str, tuple] = {}
+_cache_lock = threading.Lock()
+
+
+def load_graph_analytics(course_id: str) -> Dict[str, Any]:
+    """读取课程图谱的分析结果，按文件修改时间缓存；不存在或已过期时返回空字典"""
+    path = analytics_path(course_id)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    signature = course_graph_signature(course_id)
+    with _cache_lock:
+        cached = _cache.get(path)
+    if cached is None or cached[0] != mtime:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                analytics = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"读取知识图谱分析结果失败: {e}")
+            return {}
+        cached = (mtime, analytics)
+        with _cache_lock:
+            _cache[path] = cached
+    analytics = cached[1]
+    if analytics.get("graph_signature") != (list(signature) if signature else None):
+        return {}
+    return analytics
+
+
+def get_key_concepts(course_id: str, limit: int = 20) -> List[Dict[str, Any]]:
+    """课程核心概念（按 PageRank 排序）"""
+    return load_graph_analytics(course_id).get("key_concepts", [])[:limit]
+
+
+def get_node_centrality(course_id: str) -> Dict[str, float]:
+    """节点的 PageRank 按最大值归一化到 [0, 1]，供查询时排序使用；没有分析结果时返回空字典"""
+    analytics = load_graph_analytics(course_id)
+    if not analytics:
+        return {}
+    centrality = analytics.get("_centrality")
+    if centrality is None:
+        ranks = {node: stats.get("pagerank", 0.0) for node, stats in analytics.get("nodes", {}).items()}
+        top = max(ranks.values(), default=0.0)
+        centrality = {node: rank / top for node, rank in ranks.items()} if top > 0 else {}
+        # 缓存在已加载的分析结果上，文件更新后随之失效
+        analytics["_centrality"] = centrality
+    return centrality
+
+
+def format_key_concepts(course_id: str, limit: int = 20) -> str:
+    """核心概念的文本形式，用于拼接提示词；没有分析结果时返回空字符串"""
+    return "、".join(concept["name"] for concept in get_key_concepts(course_id, limit))
+
+
+def remove_graph_analytics(course_id: str):
+    """删除课程的图谱分析结果"""
+    path = analytics_path(course_id)
+    if os.path.exists(path):
+        os.remove(path)
+    with _cache_lock:
+        _cache.pop(path, None)
@@ -0,0 +1,216 @@
+"""
+知识图谱邻域扩展
+
+查询实体在图中的邻域按预算扩展，而不是收集全部 1~2 跳邻居：
+- 个性化 PageRank（局部 push 近似）：从查询实体出发传播分数，每次按度数均分，
+  枢纽概念的邻居只分到很少的分数，不会把上千个节点带进上下文
+- 只在 max_depth 跳以内传播，push 次数有上限，耗时与图的总规模无关
+- 给出预计算的全局 PageRank（graph_analytics）时，局部得分按课程中心度加权，
+  相关度相近的节点中优先保留课程的核心概念
+- 返回得分最高的 max_nodes 个节点；上下文文本按 token 预算截断，只描述选中节点之间的边
+- 实体对之间的最短路径最多取 max_paths 条
+- 对只读的 CSRGraph，扩展结果按 (实体集合, 深度, 节点预算) 缓存
+"""
+
+import os
+import heapq
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from backend.rag.embedding_engine import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# 扩展后最多保留的节点数
+GRAPH_CONTEXT_MAX_NODES = int(os.getenv("GRAPH_CONTEXT_MAX_NODES", "30"))
+# 图谱上下文文本的 token 预算
+GRAPH_CONTEXT_MAX_TOKENS = int(os.getenv("GRAPH_CONTEXT_MAX_TOKENS", "1500"))
+# 每对实体之间最多取的最短路径数
+GRAPH_MAX_PATHS_PER_PAIR = int(os.getenv("GRAPH_MAX_PATHS_PER_PAIR", "3"))
+# 图谱检索最多带出的文本块数
+GRAPH_CONTEXT_MAX_CHUNKS = int(os.getenv("GRAPH_CONTEXT_MAX_CHUNKS", "10"))
+# 全局 PageRank（归一化到 [0, 1]）对局部得分的加权系数，0 表示不使用
+GRAPH_CENTRALITY_WEIGHT = float(os.getenv("GRAPH_CENTRALITY_WEIGHT", "0.5"))
+# 每个图对象缓存的扩展结果数
+GRAPH_EXPANSION_CACHE_SIZE = int(os.getenv("GRAPH_EXPANSION_CACHE_SIZE", "256"))
+
+# 个性化 PageRank 的回跳概率和 push 阈值
+PPR_ALPHA = 0.15
+PPR_EPSILON = 1e-4
+# push 次数上限，决定单次扩展的最大工作量
+PPR_MAX_PUSHES = 2000
+
+
+def personalized_pagerank(graph, seeds: Sequence[str], max_depth: int = 2,
+                          alpha: float = PPR_ALPHA, epsilon: float = PPR_EPSILON,
+                          max_pushes: int = PPR_MAX_PUSHES) -> Dict[str, float]:
+    """局部 push 近似的个性化 PageRank，只在种子节点 max_depth 跳以内传播
+
+    残差按度数均分给邻居，残差/度数低于 epsilon 的节点不再 push。
+    """
+    seeds = [seed for seed in dict.fromkeys(seeds) if seed in graph]
+    if not seeds:
+        return {}
+    residual = {seed: 1.0 / len(seeds) for seed in seeds}
+    depth = {seed: 0 for seed in seeds}
+    scores: Dict[str, float] = {}
+    # 最大堆：先 push 残差最大的节点
+    heap = [(-residual[seed], seed) for seed in seeds]
+    heapq.heapify(heap)
+    pushes = 0
+
+    while heap and pushes < max_pushes:
+        _, node = heapq.heappop(heap)
+        r = residual.get(node, 0.0)
+        if r <= 0:
+            continue
+        degree = graph.degree(node)
+        if degree and r / degree < epsilon and pushes:
+            continue
+        residual[node] = 0.0
+        scores[node] = scores.get(node, 0.0) + alpha * r
+        pushes += 1
+        # 最外层节点或孤立节点只累积分数，不再向外传播
+        if not degree or depth[node] >= max_depth:
+            continue
+        share = (1 - alpha) * r / degree
+        for neighbor in graph.neighbors(node):
+            if neighbor not in depth:
+                depth[neighbor] = depth[node] + 1
+            residual[neighbor] = residual.get(neighbor, 0.0) + share
+            heapq.heappush(heap, (-residual[neighbor], neighbor))
+
+    # 未 push 的残差也计入分数，避免只差一步的节点被忽略
+    for node, r in residual.items():
+        if r > 0:
+            scores[node] = scores.get(node, 0.0) + alpha * r
+    return scores
+
+
+_caches: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def _centrality_boost(centrality: Optional[Dict[str, float]], node: str) -> float:
+    if not centrality:
+        return 1.0
+    return 1.0 + GRAPH_CENTRALITY_WEIGHT * centrality.get(node, 0.0)
+
+
+def expand_entities(graph, seeds: Iterable[str], max_depth: int = 2,
+                    max_nodes: int = GRAPH_CONTEXT_MAX_NODES,
+                    centrality: Optional[Dict[str, float]] = None) -> List[str]:
+    """从查询实体出发按预算扩展邻域，返回按相关度排序的节点（查询实体在前）
+
+    centrality 为 graph_analytics.get_node_centrality 的结果，给出时按课程中心度加权。
+    """
+    from backend.rag.graph_store import CSRGraph
+
+    seeds = [seed for seed in dict.fromkeys(seeds) if seed in graph]
+    if not seeds:
+        return []
+    key = (frozenset(seeds), max_depth, max_nodes, bool(centrality))
+    cacheable = isinstance(graph, CSRGraph)
+    if cacheable:
+        with _caches_lock:
+            cache = _caches.get(graph)
+            if cache is not None and key in cache:
+                cache.move_to_end(key)
+                return list(cache[key])
+
+    scores = personalized_pagerank(graph, seeds, max_depth)
+    seed_set = set(seeds)
+    others = sorted(
+        (node for node in scores if node not in seed_set),
+        key=lambda node: -scores[node] * _centrality_boost(centrality, node)
+    )
+    nodes = (seeds + others)[:max(max_nodes, len(seeds))]
+
+    if cacheable:
+        with _caches_lock:
+            cache = _caches.setdefault(graph, OrderedDict())
+            cache[key] = tuple(nodes)
+            while len(cache) > GRAPH_EXPANSION_CACHE_SIZE:
+                cache.popitem(last=False)
+    return nodes
+
+
+def format_subgraph_context(graph, nodes: Sequence[str], max_tokens: int = GRAPH_CONTEXT_MAX_TOKENS) -> str:
+    """按节点顺序生成子图描述，只列出选中节点之间的边，超出 token 预算即停止"""
+    selected = set(nodes)
+    parts = []
+    used = 0
+    for node in nodes:
+        if node not in graph:
+            continue
+        node_type = graph.nodes[node].get('type', 'Unknown')
+        edges = []
+        for neighbor in graph.neighbors(node):
+            if neighbor in selected:
+                edge_label = graph.edges[node, neighbor].get('label', '')
+                edges.append(f"{node} --{edge_label}--> {neighbor}")
+        node_desc = f"实体: {node} (类型: {node_type})"
+        if edges:
+            node_desc += f"\n关系: {'; '.join(edges)}"
+        cost = estimate_tokens(node_desc)
+        if parts and used + cost > max_tokens:
+            break
+        parts.append(node_desc)
+        used += cost
+    return "\n\n".join(parts)
+
+
+def bounded_shortest_paths(graph, source: str, target: str, max_paths: int = GRAPH_MAX_PATHS_PER_PAIR,
+                           max_length: int = 4) -> List[List[str]]:
+    """两个实体之间最多 max_paths 条最短路径
+
+    按层 BFS 只搜索到 max_length 跳（找到目标所在的层即停止），再沿前驱回溯枚举路径，
+    不会像 nx.all_shortest_paths 那样遍历整张图或枚举全部路径。
+    """
+    if source not in graph or target not in graph:
+        return []
+    if source == target:
+        return [[source]]
+    preds: Dict[str, List[str]] = {source: []}
+    frontier = [source]
+    for _ in range(max_length):
+        level: Dict[str, List[str]] = {}
+        for node in frontier:
+            for neighbor in graph.neighbors(node):
+                if neighbor not in preds:
+                    level.setdefault(neighbor, []).append(node)
+        if not level:
+            return []
+        preds.update(level)
+        if target in level:
+            break
+        frontier = list(level)
+    else:
+        return []
+
+    paths: List[List[str]] = []
+    stack = [(target, [target])]
+    while stack and len(paths) < max_paths:
+        node, path = stack.pop()
+        if node == source:
+            paths.append(path[::-1])
+            continue
+        for pred in preds[node]:
+            stack.append((pred, path + [pred]))
+    return paths
+
+
+def rank_chunks(graph, nodes: Sequence[str], max_chunks: int = GRAPH_CONTEXT_MAX_CHUNKS) -> List[str]:
+    """按被多少个选中节点引用、以及节点排名给文本块排序，最多返回 max_chunks 个"""
+    weights: Dict[str, float] = {}
+    for rank, node in enumerate(nodes):
+        if node not in graph:
+            continue
+        weight = 1.0 / (rank + 1)
+        for chunk_id in dict.fromkeys(graph.nodes[node].get('source_chunks', [])):
+            weights[chunk_id] = weights.get(chunk_id, 0.0) + weight
+    ranked: List[Tuple[str, float]] = sorted(weights.items(), key=lambda item: -item[1])
+    return [chunk_id for chunk_id, _ in ranked[:max_chunks]]
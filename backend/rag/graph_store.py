@@ -0,0 +1,858 @@
+"""
+知识图谱二进制存储
+
+用紧凑的二进制格式代替 GML 保存课程知识图谱，查询时通过 mmap 直接打开，
+不再每次检索都重新解析整个 GML 文本文件：
+
+- 节点名、实体类型、关系标签和文本块ID统一放入字符串表（相同字符串只存一次）
+- 节点按名称的 UTF-8 字节序排序，节点编号即其名称在字符串表中的编号，按名称查找用二分
+- 邻接关系按 CSR 布局存储（offsets + targets），每个节点的邻居按编号有序
+- 节点和边的来源（source_chunks 与平行的 source_files，即 (文件, 文本块) 对）
+  以 offsets + 字符串编号的倒排形式打包
+- 来源倒排索引：文本块ID或文件名 -> 引用它的节点和边，撤回单个文件时只访问该文件涉及的部分
+- 其他不常见的属性以 JSON 形式附加，只在访问时解码
+
+load_graph 返回只读的 CSRGraph，提供与 networkx.Graph 兼容的常用接口；需要修改图时
+调用 to_networkx() 得到普通的 nx.Graph。GML 导入导出保留用于调试。
+
+课程图谱每次保存都写入新的带版本号的文件（knowledge_graph.<版本>.bin），再原子地替换
+指针文件 knowledge_graph.current 指向它。Windows 上无法替换或删除仍被映射的文件，
+因此从不覆盖已有的图谱文件；旧版本在不再被映射后于下次保存或删除时清理。
+"""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import networkx as nx
+
+from backend.rag.course_lock import KNOWLEDGE_BASE_ROOT
+
+logger = logging.getLogger(__name__)
+
+# 旧版（无版本号）的图谱文件名，没有指针文件时读取
+GRAPH_FILENAME = "knowledge_graph.bin"
+GRAPH_POINTER_FILENAME = "knowledge_graph.current"
+LEGACY_GML_FILENAME = "knowledge_graph.gml"
+# 保存二进制图谱时是否同时导出 GML，便于调试
+GRAPH_EXPORT_GML = os.getenv("GRAPH_EXPORT_GML", "0") == "1"
+
+_MAGIC = b"EKG1"
+_VERSION = 3
+# 缺失的类型/标签
+_NONE = 0xFFFFFFFF
+
+# 各段按固定顺序存放，头部之后的段表记录每段的 (偏移, 字节数)
+_SECTIONS = (
+    "str_offsets",      # 字符串 i 在 str_blob 中的 [offsets[i], offsets[i+1])
+    "str_blob",
+    "node_type",        # 节点 -> 类型字符串编号
+    "adj_offsets",      # CSR: 节点 i 的邻居为 adj_targets[adj_offsets[i]:adj_offsets[i+1]]
+    "adj_targets",
+    "adj_edges",        # 与 adj_targets 对应的边编号
+    "edge_u",
+    "edge_v",
+    "edge_label",
+    "node_post_offsets",
+    "node_post",        # 来源文本块的字符串编号
+    "node_post_files",  # 与 node_post 对应的来源文件
+    "edge_post_offsets",
+    "edge_post",
+    "edge_post_files",
+    "index_keys",       # 来源倒排索引：按 UTF-8 字节序排序的文本块ID/文件名字符串编号
+    "index_node_offsets",
+    "index_nodes",
+    "index_edge_offsets",
+    "index_edges",
+    "extras",           # JSON: {"nodes": {编号: 属性}, "edges": {编号: 属性}}
+)
+# magic, 版本, 保留, 节点数, 边数, 字符串数, 段数
+_HEADER = struct.Struct("<4sHHIIII")
+_SECTION_ENTRY = struct.Struct("<QQ")
+_ALIGN = 8
+
+_NODE_NATIVE = ("type", "source_chunks", "source_files")
+_EDGE_NATIVE = ("label", "source_chunks", "source_files")
+
+
+def _as_chunk_list(value) -> List[str]:
+    """source_chunks 统一为字符串列表（GML 会把单元素列表读成字符串）"""
+    if value is None:
+        return []
+    if isinstance(value, (str, bytes)):
+        return [value.decode("utf-8") if isinstance(value, bytes) else value]
+    return [str(v) for v in value]
+
+
+def _provenance(data: Dict[str, Any]) -> Tuple[List[str], List[Optional[str]]]:
+    """返回 (来源文本块, 对应来源文件)，没有 source_files 的旧图文件记为 None"""
+    chunks = _as_chunk_list(data.get("source_chunks"))
+    if "source_files" not in data:
+        return chunks, [None] * len(chunks)
+    files = _as_chunk_list(data.get("source_files"))[:len(chunks)]
+    return chunks, files + [""] * (len(chunks) - len(files))
+
+
+def _u32(values=()) -> array:
+    return array("I", values)
+
+
+def pack_graph(graph: nx.Graph) -> bytes:
+    """把 networkx 图打包为二进制格式"""
+    if graph.is_directed() or graph.is_multigraph():
+        raise ValueError("只支持无向简单图")
+
+    names = sorted({str(n) for n in graph.nodes()}, key=lambda s: s.encode("utf-8"))
+    if len(names) != graph.number_of_nodes():
+        raise ValueError("节点名称转换为字符串后出现重复")
+    node_index = {name: i for i, name in enumerate(names)}
+
+    # 字符串表：前 len(names) 项为节点名
+    strings: List[str] = list(names)
+    interned: Dict[str, int] = dict(node_index)
+
+    def intern(value) -> int:
+        if value is None:
+            return _NONE
+        value = str(value)
+        sid = interned.get(value)
+        if sid is None:
+            sid = interned[value] = len(strings)
+            strings.append(value)
+        return sid
+
+    node_type = _u32([_NONE]) * len(names)
+    node_post_offsets = _u32([0])
+    node_post, node_post_files = _u32(), _u32()
+    extras: Dict[str, Dict[str, Any]] = {"nodes": {}, "edges": {}}
+
+    node_data = {str(n): d for n, d in graph.nodes(data=True)}
+    for i, name in enumerate(names):
+        data = node_data[name]
+        node_type[i] = intern(data.get("type"))
+        chunks, files = _provenance(data)
+        node_post.extend(intern(c) for c in chunks)
+        node_post_files.extend(intern(f) for f in files)
+        node_post_offsets.append(len(node_post))
+        other = {k: v for k, v in data.items() if k not in _NODE_NATIVE}
+        if other:
+            extras["nodes"][str(i)] = other
+
+    edges = sorted(
+        (min(u, v), max(u, v), d)
+        for u, v, d in ((node_index[str(a)], node_index[str(b)], d) for a, b, d in graph.edges(data=True))
+    ) if graph.number_of_edges() else []
+    edge_u, edge_v, edge_label = _u32(), _u32(), _u32()
+    edge_post_offsets = _u32([0])
+    edge_post, edge_post_files = _u32(), _u32()
+    adjacency: List[List[Tuple[int, int]]] = [[] for _ in names]
+    for e, (u, v, data) in enumerate(edges):
+        edge_u.append(u)
+        edge_v.append(v)
+        edge_label.append(intern(data.get("label")))
+        chunks, files = _provenance(data)
+        edge_post.extend(intern(c) for c in chunks)
+        edge_post_files.extend(intern(f) for f in files)
+        edge_post_offsets.append(len(edge_post))
+        other = {k: val for k, val in data.items() if k not in _EDGE_NATIVE}
+        if other:
+            extras["edges"][str(e)] = other
+        adjacency[u].append((v, e))
+        if u != v:
+            adjacency[v].append((u, e))
+
+    adj_offsets, adj_targets, adj_edges = _u32([0]), _u32(), _u32()
+    for neighbors in adjacency:
+        neighbors.sort()
+        adj_targets.extend(t for t, _ in neighbors)
+        adj_edges.extend(e for _, e in neighbors)
+        adj_offsets.append(len(adj_targets))
+
+    # 来源倒排索引：来源字符串 -> 节点/边编号
+    index_nodes: Dict[int, List[int]] = {}
+    index_edges: Dict[int, List[int]] = {}
+    for offsets, postings, files, target in (
+        (node_post_offsets, node_post, node_post_files, index_nodes),
+        (edge_post_offsets, edge_post, edge_post_files, index_edges),
+    ):
+        for item in range(len(offsets) - 1):
+            for k in range(offsets[item], offsets[item + 1]):
+                for sid in (postings[k], files[k]):
+                    if sid != _NONE:
+                        refs = target.setdefault(sid, [])
+                        if not refs or refs[-1] != item:
+                            refs.append(item)
+
+    encoded = [s.encode("utf-8") for s in strings]
+    index_keys = _u32(sorted(set(index_nodes) | set(index_edges), key=lambda sid: encoded[sid]))
+    index_node_offsets, index_node_items = _u32([0]), _u32()
+    index_edge_offsets, index_edge_items = _u32([0]), _u32()
+    for sid in index_keys:
+        index_node_items.extend(index_nodes.get(sid, ()))
+        index_node_offsets.append(len(index_node_items))
+        index_edge_items.extend(index_edges.get(sid, ()))
+        index_edge_offsets.append(len(index_edge_items))
+
+    str_offsets = _u32([0])
+    total = 0
+    for b in encoded:
+        total += len(b)
+        str_offsets.append(total)
+    if total >= _NONE:
+        raise ValueError("字符串表超过4GB")
+
+    sections = {
+        "str_offsets": str_offsets,
+        "str_blob": b"".join(encoded),
+        "node_type": node_type,
+        "adj_offsets": adj_offsets,
+        "adj_targets": adj_targets,
+        "adj_edges": adj_edges,
+        "edge_u": edge_u,
+        "edge_v": edge_v,
+        "edge_label": edge_label,
+        "node_post_offsets": node_post_offsets,
+        "node_post": node_post,
+        "node_post_files": node_post_files,
+        "edge_post_offsets": edge_post_offsets,
+        "edge_post": edge_post,
+        "edge_post_files": edge_post_files,
+        "index_keys": index_keys,
+        "index_node_offsets": index_node_offsets,
+        "index_nodes": index_node_items,
+        "index_edge_offsets": index_edge_offsets,
+        "index_edges": index_edge_items,
+        "extras": json.dumps(extras, ensure_ascii=False).encode("utf-8")
+                  if extras["nodes"] or extras["edges"] else b"",
+    }
+
+    body = bytearray()
+    layout = []
+    offset = _HEADER.size + _SECTION_ENTRY.size * len(_SECTIONS)
+    for name in _SECTIONS:
+        data = sections[name]
+        if isinstance(data, array):
+            if sys.byteorder == "big":
+                data = array("I", data)
+                data.byteswap()
+            data = data.tobytes()
+        pad = (-offset) % _ALIGN
+        body += b"\0" * pad
+        offset += pad
+        layout.extend((offset, len(data)))
+        body += data
+        offset += len(data)
+
+    header = _HEADER.pack(_MAGIC, _VERSION, 0, len(names), len(edges), len(strings), len(_SECTIONS))
+    table = b"".join(_SECTION_ENTRY.pack(layout[2 * i], layout[2 * i + 1]) for i in range(len(_SECTIONS)))
+    return header + table + bytes(body)
+
+
+class _NodeView:
+    """graph.nodes 的只读视图，支持 nodes()、nodes(data=True) 和 nodes[name]"""
+
+    def __init__(self, graph: "CSRGraph"):
+        self._graph = graph
+
+    def __call__(self, data: bool = False):
+        if data:
+            return ((name, self._graph._node_attrs(i)) for i, name in enumerate(self._graph._iter_names()))
+        return self
+
+    def __iter__(self) -> Iterator[str]:
+        return self._graph._iter_names()
+
+    def __len__(self) -> int:
+        return self._graph.number_of_nodes()
+
+    def __contains__(self, node) -> bool:
+        return node in self._graph
+
+    def __getitem__(self, node) -> Dict[str, Any]:
+        return self._graph._node_attrs(self._graph._require(node))
+
+    def items(self):
+        return self(data=True)
+
+    def data(self):
+        return self(data=True)
+
+
+class _EdgeView:
+    """graph.edges 的只读视图，支持 edges()、edges(data=True) 和 edges[u, v]"""
+
+    def __init__(self, graph: "CSRGraph"):
+        self._graph = graph
+
+    def __call__(self, nbunch=None, data: bool = False):
+        graph = self._graph
+        if nbunch is None:
+            edge_ids = range(graph.number_of_edges())
+        else:
+            nodes = [nbunch] if nbunch in graph else list(nbunch)
+            edge_ids = sorted({e for n in nodes if n in graph for e in graph._edge_ids_of(graph._index(n))})
+        for e in edge_ids:
+            u, v = graph._name(graph._edge_u[e]), graph._name(graph._edge_v[e])
+            yield (u, v, graph._edge_attrs(e)) if data else (u, v)
+
+    def __iter__(self):
+        return self()
+
+    def __len__(self) -> int:
+        return self._graph.number_of_edges()
+
+    def __contains__(self, edge) -> bool:
+        return self._graph.has_edge(*edge)
+
+    def __getitem__(self, edge) -> Dict[str, Any]:
+        u, v = edge
+        e = self._graph._edge_id(u, v)
+        if e is None:
+            raise KeyError(edge)
+        return self._graph._edge_attrs(e)
+
+
+class _AdjacencyView:
+    """graph[node] 的只读视图：邻居 -> 边属性"""
+
+    def __init__(self, graph: "CSRGraph", index: int):
+        self._graph = graph
+        self._index = index
+
+    def __iter__(self):
+        return (self._graph._name(t) for t in self._graph._adj_targets_of(self._index))
+
+    def __len__(self) -> int:
+        lo, hi = self._graph._adj_range(self._index)
+        return hi - lo
+
+    def __contains__(self, node) -> bool:
+        return self._graph._edge_id_by_index(self._index, self._graph._index(node)) is not None
+
+    def __getitem__(self, node) -> Dict[str, Any]:
+        e = self._graph._edge_id_by_index(self._index, self._graph._index(node))
+        if e is None:
+            raise KeyError(node)
+        return self._graph._edge_attrs(e)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        graph = self._graph
+        lo, hi = graph._adj_range(self._index)
+        return ((graph._name(graph._adj_targets[k]), graph._edge_attrs(graph._adj_edges[k])) for k in range(lo, hi))
+
+
+class CSRGraph:
+    """只读、按需解码的知识图谱，接口与 networkx.Graph 的常用部分兼容
+
+    节点和边的属性字典每次访问时新建，修改它们不会写回图中。
+    """
+
+    def __init__(self, buffer, source: Optional[str] = None):
+        self._buffer = buffer
+        self.source = source
+        view = memoryview(buffer)
+        magic, version, _flags, n_nodes, n_edges, n_strings, n_sections = _HEADER.unpack_from(view, 0)
+        if magic != _MAGIC:
+            raise ValueError("不是知识图谱二进制文件")
+        if version != _VERSION or n_sections != len(_SECTIONS):
+            raise ValueError(f"不支持的知识图谱格式版本: {version}")
+        self._n_nodes = n_nodes
+        self._n_edges = n_edges
+        self._n_strings = n_strings
+
+        sections = {}
+        for i, name in enumerate(_SECTIONS):
+            offset, length = _SECTION_ENTRY.unpack_from(view, _HEADER.size + i * _SECTION_ENTRY.size)
+            sections[name] = view[offset:offset + length]
+        self._blob = sections.pop("str_blob")
+        extras = sections.pop("extras")
+        self._extras_raw = bytes(extras) if len(extras) else b""
+        self._extras: Optional[Dict[str, Dict[str, Any]]] = None
+        for name, data in sections.items():
+            setattr(self, "_" + name, self._u32_view(data))
+
+        self._strings: Dict[int, str] = {}
+        self.nodes = _NodeView(self)
+        self.edges = _EdgeView(self)
+        self.graph: Dict[str, Any] = {}
+
+    @staticmethod
+    def _u32_view(data: memoryview):
+        if sys.byteorder == "big":
+            values = array("I", bytes(data))
+            values.byteswap()
+            return values
+        return data.cast("I")
+
+    @classmethod
+    def from_networkx(cls, graph: nx.Graph) -> "CSRGraph":
+        """在内存中把 networkx 图转换为 CSRGraph"""
+        return cls(pack_graph(graph))
+
+    # --- 内部访问 ---
+
+    def _raw_string(self, sid: int) -> bytes:
+        return bytes(self._blob[self._str_offsets[sid]:self._str_offsets[sid + 1]])
+
+    def _string(self, sid: int) -> Optional[str]:
+        if sid == _NONE:
+            return None
+        value = self._strings.get(sid)
+        if value is None:
+            value = self._strings[sid] = str(self._raw_string(sid), "utf-8")
+        return value
+
+    def _name(self, index: int) -> str:
+        return self._string(index)
+
+    def _iter_names(self) -> Iterator[str]:
+        return (self._name(i) for i in range(self._n_nodes))
+
+    def _index(self, node) -> Optional[int]:
+        """按名称二分查找节点编号，不存在时返回 None"""
+        if not isinstance(node, str):
+            return None
+        key = node.encode("utf-8")
+        lo, hi = 0, self._n_nodes
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw_string(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n_nodes and self._raw_string(lo) == key:
+            return lo
+        return None
+
+    def _require(self, node) -> int:
+        index = self._index(node)
+        if index is None:
+            raise KeyError(node)
+        return index
+
+    def _adj_range(self, index: int) -> Tuple[int, int]:
+        return self._adj_offsets[index], self._adj_offsets[index + 1]
+
+    def _adj_targets_of(self, index: int):
+        lo, hi = self._adj_range(index)
+        return self._adj_targets[lo:hi]
+
+    def _edge_ids_of(self, index: int):
+        lo, hi = self._adj_range(index)
+        return self._adj_edges[lo:hi]
+
+    def _degree(self, index: int) -> int:
+        lo, hi = self._adj_range(index)
+        # 与 networkx 一致，自环在邻接表中只出现一次，但度数计两次
+        return hi - lo + (self._edge_id_by_index(index, index) is not None)
+
+    def _edge_id_by_index(self, u: Optional[int], v: Optional[int]) -> Optional[int]:
+        if u is None or v is None:
+            return None
+        lo, hi = self._adj_range(u)
+        k = bisect_left(self._adj_targets, v, lo, hi)
+        if k < hi and self._adj_targets[k] == v:
+            return self._adj_edges[k]
+        return None
+
+    def _edge_id(self, u, v) -> Optional[int]:
+        return self._edge_id_by_index(self._index(u), self._index(v))
+
+    def _postings(self, offsets, postings, index: int) -> List[str]:
+        return [self._string(sid) for sid in postings[offsets[index]:offsets[index + 1]]]
+
+    def _extra(self, kind: str, index: int) -> Dict[str, Any]:
+        if not self._extras_raw:
+            return {}
+        if self._extras is None:
+            self._extras = json.loads(self._extras_raw.decode("utf-8"))
+        return self._extras[kind].get(str(index), {})
+
+    def _node_attrs(self, index: int) -> Dict[str, Any]:
+        attrs = dict(self._extra("nodes", index))
+        node_type = self._string(self._node_type[index])
+        if node_type is not None:
+            attrs["type"] = node_type
+        attrs["source_chunks"] = self._postings(self._node_post_offsets, self._node_post, index)
+        files = self._postings(self._node_post_offsets, self._node_post_files, index)
+        if any(f is not None for f in files):
+            attrs["source_files"] = [f or "" for f in files]
+        return attrs
+
+    def _edge_attrs(self, e: int) -> Dict[str, Any]:
+        attrs = dict(self._extra("edges", e))
+        label = self._string(self._edge_label[e])
+        if label is not None:
+            attrs["label"] = label
+        chunks = self._postings(self._edge_post_offsets, self._edge_post, e)
+        if chunks:
+            attrs["source_chunks"] = chunks
+            files = self._postings(self._edge_post_offsets, self._edge_post_files, e)
+            if any(f is not None for f in files):
+                attrs["source_files"] = [f or "" for f in files]
+        return attrs
+
+    def _index_position(self, key: str) -> Optional[int]:
+        """在来源倒排索引中二分查找 key 的位置"""
+        raw = key.encode("utf-8")
+        lo, hi = 0, len(self._index_keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw_string(self._index_keys[mid]) < raw:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._index_keys) and self._raw_string(self._index_keys[lo]) == raw:
+            return lo
+        return None
+
+    # --- 来源查询 ---
+
+    def nodes_with_provenance(self, keys) -> List[str]:
+        """返回来源中包含任一文本块ID或文件名的节点"""
+        found = set()
+        for key in keys:
+            pos = self._index_position(str(key))
+            if pos is not None:
+                found.update(self._index_nodes[self._index_node_offsets[pos]:self._index_node_offsets[pos + 1]])
+        return [self._name(i) for i in sorted(found)]
+
+    def edges_with_provenance(self, keys) -> List[Tuple[str, str]]:
+        """返回来源中包含任一文本块ID或文件名的边"""
+        found = set()
+        for key in keys:
+            pos = self._index_position(str(key))
+            if pos is not None:
+                found.update(self._index_edges[self._index_edge_offsets[pos]:self._index_edge_offsets[pos + 1]])
+        return [(self._name(self._edge_u[e]), self._name(self._edge_v[e])) for e in sorted(found)]
+
+    # --- networkx 兼容接口 ---
+
+    def __contains__(self, node) -> bool:
+        return self._index(node) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return self._iter_names()
+
+    def __len__(self) -> int:
+        return self._n_nodes
+
+    def __getitem__(self, node) -> _AdjacencyView:
+        return _AdjacencyView(self, self._require(node))
+
+    @property
+    def adj(self):
+        return {name: self[name] for name in self}
+
+    def is_directed(self) -> bool:
+        return False
+
+    def is_multigraph(self) -> bool:
+        return False
+
+    def has_node(self, node) -> bool:
+        return node in self
+
+    def has_edge(self, u, v) -> bool:
+        return self._edge_id(u, v) is not None
+
+    def get_edge_data(self, u, v, default=None):
+        e = self._edge_id(u, v)
+        return default if e is None else self._edge_attrs(e)
+
+    def neighbors(self, node) -> Iterator[str]:
+        return (self._name(t) for t in self._adj_targets_of(self._require(node)))
+
+    def degree(self, node=None):
+        if node is not None and node in self:
+            return self._degree(self._index(node))
+        if node is not None:
+            raise KeyError(node)
+        return ((name, self._degree(i)) for i, name in enumerate(self._iter_names()))
+
+    def number_of_nodes(self) -> int:
+        return self._n_nodes
+
+    def number_of_edges(self) -> int:
+        return self._n_edges
+
+    def order(self) -> int:
+        return self._n_nodes
+
+    def size(self) -> int:
+        return self._n_edges
+
+    def subgraph(self, nodes) -> nx.Graph:
+        """返回给定节点的诱导子图（networkx.Graph 副本）"""
+        indices = sorted({i for i in (self._index(n) for n in nodes) if i is not None})
+        selected = set(indices)
+        sub = nx.Graph()
+        for i in indices:
+            sub.add_node(self._name(i), **self._node_attrs(i))
+        for i in indices:
+            lo, hi = self._adj_range(i)
+            for k in range(lo, hi):
+                t = self._adj_targets[k]
+                if t in selected and t >= i:
+                    sub.add_edge(self._name(i), self._name(t), **self._edge_attrs(self._adj_edges[k]))
+        return sub
+
+    def to_networkx(self) -> nx.Graph:
+        """解码为可修改的 networkx.Graph"""
+        graph = nx.Graph()
+        for i, name in enumerate(self._iter_names()):
+            graph.add_node(name, **self._node_attrs(i))
+        for e in range(self._n_edges):
+            graph.add_edge(self._name(self._edge_u[e]), self._name(self._edge_v[e]), **self._edge_attrs(e))
+        return graph
+
+    def copy(self) -> nx.Graph:
+        return self.to_networkx()
+
+
+def empty_graph() -> CSRGraph:
+    """返回空的只读图"""
+    return CSRGraph.from_networkx(nx.Graph())
+
+
+def save_graph(graph, path: str, export_gml: bool = GRAPH_EXPORT_GML):
+    """原子地写入二进制图谱文件（先写临时文件再替换）
+
+    Windows 上目标文件正被映射时无法替换，课程图谱应使用 save_course_graph 写入新版本文件。
+    """
+    if isinstance(graph, CSRGraph):
+        graph = graph.to_networkx()
+    data = pack_graph(graph)
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    if export_gml:
+        export_gml_file(graph, os.path.join(directory, LEGACY_GML_FILENAME))
+
+
+def load_graph(path: str) -> CSRGraph:
+    """通过 mmap 打开二进制图谱文件"""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            raise ValueError(f"知识图谱文件为空: {path}")
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return CSRGraph(buffer, source=path)
+
+
+def export_gml_file(graph, gml_path: str):
+    """导出为 GML（调试用）"""
+    if isinstance(graph, CSRGraph):
+        graph = graph.to_networkx()
+    nx.write_gml(graph, gml_path)
+
+
+def import_gml_file(gml_path: str, path: Optional[str] = None) -> CSRGraph:
+    """读取 GML 并转换为二进制格式；给出 path 时同时写入文件"""
+    graph = nx.read_gml(gml_path)
+    if path:
+        save_graph(graph, path, export_gml=False)
+        return load_graph(path)
+    return CSRGraph.from_networkx(graph)
+
+
+# --- 按课程访问 ---
+
+_cache: Dict[str, Tuple[Tuple[int, int, int], CSRGraph]] = {}
+_cache_lock = threading.Lock()
+# Windows 上替换正被其他进程读取的指针文件会失败，短暂重试
+_POINTER_RETRIES = 5
+
+
+def _course_dir(course_id: str) -> str:
+    return os.path.join(KNOWLEDGE_BASE_ROOT, str(course_id))
+
+
+def _pointer_path(course_id: str) -> str:
+    return os.path.join(_course_dir(course_id), GRAPH_POINTER_FILENAME)
+
+
+def _legacy_gml_path(course_id: str) -> str:
+    return os.path.join(_course_dir(course_id), LEGACY_GML_FILENAME)
+
+
+def _version_files(course_id: str) -> List[str]:
+    """课程目录下所有图谱数据文件（带版本号的和旧版的）"""
+    directory = _course_dir(course_id)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    prefix, suffix = os.path.splitext(GRAPH_FILENAME)
+    return [
+        os.path.join(directory, name) for name in names
+        if name == GRAPH_FILENAME or (name.startswith(prefix + ".") and name.endswith(suffix))
+    ]
+
+
+def course_graph_path(course_id: str) -> str:
+    """课程当前的图谱数据文件：指针文件指向的版本，没有指针文件时为旧版文件名"""
+    try:
+        with open(_pointer_path(course_id), "r", encoding="utf-8") as f:
+            name = f.read().strip()
+        if name:
+            return os.path.join(_course_dir(course_id), os.path.basename(name))
+    except OSError:
+        pass
+    return os.path.join(_course_dir(course_id), GRAPH_FILENAME)
+
+
+def course_graph_signature(course_id: str) -> Optional[Tuple[int, int, int]]:
+    """返回课程当前图谱文件的 (inode, 修改时间, 大小)，文件不存在时返回 None"""
+    try:
+        st = os.stat(course_graph_path(course_id))
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _evict(course_id: str):
+    """从缓存中移除课程的图谱映射
+
+    缓存持有的是唯一的长期引用，移除后映射在最后一个使用者（如进行中的查询）释放时关闭。
+    """
+    directory = os.path.normpath(_course_dir(course_id))
+    with _cache_lock:
+        for path in [p for p in _cache if os.path.dirname(os.path.normpath(p)) == directory]:
+            del _cache[path]
+
+
+def _remove_stale_versions(course_id: str, keep: Optional[str] = None):
+    """删除非当前版本的图谱文件；仍被映射（Windows）的文件留到下次清理"""
+    for path in _version_files(course_id):
+        if keep is not None and os.path.normpath(path) == os.path.normpath(keep):
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.debug(f"旧版本图谱文件仍在使用，稍后清理: {path} ({e})")
+
+
+def _write_pointer(course_id: str, name: str):
+    pointer = _pointer_path(course_id)
+    tmp_path = f"{pointer}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(name)
+            f.flush()
+            os.fsync(f.fileno())
+        for attempt in range(_POINTER_RETRIES):
+            try:
+                os.replace(tmp_path, pointer)
+                break
+            except PermissionError:
+                if attempt == _POINTER_RETRIES - 1:
+                    raise
+                time.sleep(0.05 * (attempt + 1))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _load_cached(path: str) -> CSRGraph:
+    st = os.stat(path)
+    signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _cache_lock:
+        cached = _cache.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    graph = load_graph(path)
+    with _cache_lock:
+        _cache[path] = (signature, graph)
+    return graph
+
+
+def load_course_graph(course_id: str) -> CSRGraph:
+    """加载课程的知识图谱
+
+    当前版本的文件按 (inode, 修改时间, 大小) 缓存映射，保存新版本后自动打开新文件；
+    只有旧版 GML 文件时转换一次。不存在或读取失败时返回空图。
+    """
+    try:
+        path = course_graph_path(course_id)
+        if not os.path.exists(path):
+            gml_path = _legacy_gml_path(course_id)
+            if not os.path.exists(gml_path):
+                return empty_graph()
+            logger.info(f"将旧版 GML 知识图谱转换为二进制格式: {gml_path}")
+            save_course_graph(course_id, nx.read_gml(gml_path), export_gml=False)
+            path = course_graph_path(course_id)
+
+        try:
+            return _load_cached(path)
+        except FileNotFoundError:
+            # 读取指针后该版本已被其他进程的保存清理，按新的指针重新打开
+            return _load_cached(course_graph_path(course_id))
+    except Exception as e:
+        logger.error(f"加载知识图谱失败: {e}")
+        return empty_graph()
+
+
+def save_course_graph(course_id: str, graph, export_gml: bool = GRAPH_EXPORT_GML):
+    """保存课程的知识图谱：写入新版本文件，切换指针，再清理旧版本，返回写入的文件路径"""
+    name = f"{os.path.splitext(GRAPH_FILENAME)[0]}.{time.time_ns():x}{os.getpid():x}.bin"
+    path = os.path.join(_course_dir(course_id), name)
+    save_graph(graph, path, export_gml=export_gml)
+    _write_pointer(course_id, name)
+    _evict(course_id)
+    _remove_stale_versions(course_id, keep=path)
+    return path
+
+
+def remove_course_graph(course_id: str):
+    """删除课程的知识图谱文件（包括旧版 GML）"""
+    _evict(course_id)
+    for path in (_pointer_path(course_id), _legacy_gml_path(course_id)):
+        if os.path.exists(path):
+            os.remove(path)
+    _remove_stale_versions(course_id)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="知识图谱二进制文件与 GML 互相转换（调试用）")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("--course_id", required=True)
+    parser.add_argument("--gml", help="GML 文件路径，默认为课程目录下的 knowledge_graph.gml")
+    args = parser.parse_args()
+
+    gml_path = args.gml or _legacy_gml_path(args.course_id)
+    if args.command == "export":
+        graph = load_course_graph(args.course_id)
+        export_gml_file(graph, gml_path)
+        print(f"已导出 {graph.number_of_nodes()} 个节点、{graph.number_of_edges()} 条边到 {gml_path}")
+    else:
+        save_course_graph(args.course_id, nx.read_gml(gml_path), export_gml=False)
+        graph = load_course_graph(args.course_id)
+        print(f"已导入 {graph.number_of_nodes()} 个节点、{graph.number_of_edges()} 条边")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+"""
+共享HTTP连接池
+
+embedding、重排序等发往同一API服务的请求复用同一个 requests.Session，
+避免每次请求都重新建立 TCP/TLS 连接。
+"""
+
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# 每个主机保持的最大连接数，应不小于并发请求数
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """返回进程级共享的 requests.Session（带连接池）"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
@@ -5,7 +5,6 @@ import networkx as nx
 import logging
 import asyncio
 from typing import List, Dict, Any, Optional, Tuple
-import requests
 from pathlib import Path
 import time
 
@@ -15,16 +14,311 @@ sys.path.insert(0, backend_dir)
 
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.exceptions import OutputParserException
 from langchain_openai import ChatOpenAI
 from langchain_core.documents import Document
 
+from backend.rag.graph_store import (
+    CSRGraph, course_graph_signature, load_course_graph, save_course_graph
+)
+from backend.rag.course_lock import course_write_lock
+from backend.rag.extraction_scheduler import ExtractionScheduler
+from backend.rag.llm_gateway import get_llm_client
+from backend.rag.extraction_cache import get_extraction_cache, prompt_hash
+from backend.rag.embedding_engine import estimate_tokens
+from backend.rag.entity_index import get_entity_index, normalize_entity_name
+from backend.rag.graph_analytics import get_node_centrality, save_graph_analytics
+from backend.rag.graph_expansion import (
+    GRAPH_CONTEXT_MAX_NODES, GRAPH_CONTEXT_MAX_TOKENS, expand_entities, format_subgraph_context
+)
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# 配置参数
-GRAPH_BATCH_SIZE = int(os.getenv("GRAPH_BATCH_SIZE", "5"))
-GRAPH_DELAY = float(os.getenv("GRAPH_DELAY", "0.1"))
-GRAPH_CONCURRENCY = int(os.getenv("GRAPH_CONCURRENCY", "8"))
+# 实体和关系提取提示词，其哈希是抽取缓存键的一部分，修改后旧缓存自然失效
+EXTRACTION_PROMPT_TEMPLATE = '''
+从以下文本中提取关键实体和它们之间的关系。
+
+文本：
+---
+{text}
+---
+
+请以JSON格式返回结果，包含两个字段：
+1. "entities": 实体列表，每个实体包含 "name"（实体名称）和 "type"（实体类型，如概念、技术、人物等）
+2. "relationships": 关系列表，每个关系包含 "source"（源实体）、"target"（目标实体）和 "label"（关系描述）
+
+返回格式示例：
+{{
+  "entities": [
+    {{"name": "Python", "type": "编程语言"}},
+    {{"name": "机器学习", "type": "技术领域"}}
+  ],
+  "relationships": [
+    {{"source": "Python", "target": "机器学习", "label": "用于"}}
+  ]
+}}
+
+只返回JSON格式的结果，不要包含其他文字。
+'''
+
+# 批量提取提示词：多个文档块以批内序号标记，按序号返回各自的结果
+BATCH_EXTRACTION_PROMPT_TEMPLATE = '''
+分别从以下每个文本片段中提取关键实体和它们之间的关系。每个片段以 <片段 id="编号"> 开始、以 </片段> 结束。
+
+{chunks}
+
+请以JSON对象返回结果，键为片段编号，值包含两个字段：
+1. "entities": 实体列表，每个实体包含 "name"（实体名称）和 "type"（实体类型，如概念、技术、人物等）
+2. "relationships": 关系列表，每个关系包含 "source"（源实体）、"target"（目标实体）和 "label"（关系描述）
+
+每个片段单独提取，关系只连接同一片段中的实体；没有实体的片段返回空列表，不要遗漏任何编号。
+
+返回格式示例：
+{{
+  "1": {{
+    "entities": [
+      {{"name": "Python", "type": "编程语言"}},
+      {{"name": "机器学习", "type": "技术领域"}}
+    ],
+    "relationships": [
+      {{"source": "Python", "target": "机器学习", "label": "用于"}}
+    ]
+  }},
+  "2": {{"entities": [], "relationships": []}}
+}}
+
+只返回JSON格式的结果，不要包含其他文字。
+'''
+
+# 单次抽取请求最多打包的文档块数，1 表示关闭批量抽取
+GRAPH_BATCH_CHUNKS = int(os.getenv("GRAPH_BATCH_CHUNKS", "8"))
+# 抽取模型的上下文长度（token），0 表示按模型名推断
+GRAPH_MODEL_CONTEXT = int(os.getenv("GRAPH_MODEL_CONTEXT", "0"))
+# 单次抽取请求预期的最大输出 token 数
+GRAPH_MAX_OUTPUT_TOKENS = int(os.getenv("GRAPH_MAX_OUTPUT_TOKENS", "4096"))
+# 抽取结果的 token 数约为输入文本的倍数
+GRAPH_OUTPUT_RATIO = 1.5
+
+# 常见模型的上下文长度（按模型名中的关键字匹配）
+MODEL_CONTEXT_SIZES = {
+    "qwen3": 32768,
+    "qwen2.5": 32768,
+    "deepseek": 65536,
+    "glm-4": 128000,
+    "gpt-4o": 128000,
+    "gpt-3.5": 16385,
+}
+DEFAULT_MODEL_CONTEXT = 8192
+
+
+def model_context_size(model_name: str) -> int:
+    """按模型名推断上下文长度"""
+    name = (model_name or "").lower()
+    for keyword, size in MODEL_CONTEXT_SIZES.items():
+        if keyword in name:
+            return size
+    return DEFAULT_MODEL_CONTEXT
+
+# 窗口大小和重试参数见 extraction_scheduler（GRAPH_CONCURRENCY / GRAPH_MAX_RETRIES），
+# 并发上限和限流与其他 LLM 调用共用 llm_gateway 的服务商（LLM_MAX_CONCURRENCY / LLM_RATE_LIMIT / LLM_TOKENS_PER_MINUTE）
+
+def chunk_source_file(chunk: Document) -> str:
+    """文档块所属的文件名，作为图中来源记录的文件键"""
+    source = chunk.metadata.get('source') or ''
+    return os.path.basename(str(source))
+
+
+def add_provenance(attrs: Dict[str, Any], source_file: str, chunk_id: str) -> bool:
+    """在节点或边的属性中记录来源 (文件, 文本块)，已存在时返回 False
+
+    source_chunks 与 source_files 为平行列表；旧图中没有 source_files 的记录以空字符串补齐。
+    """
+    chunks = attrs.get('source_chunks')
+    if chunks is None:
+        chunks = attrs['source_chunks'] = []
+    elif isinstance(chunks, str):
+        chunks = attrs['source_chunks'] = [chunks]
+    files = attrs.get('source_files')
+    if files is None:
+        files = attrs['source_files'] = []
+    elif isinstance(files, str):
+        files = attrs['source_files'] = [files]
+    if len(files) < len(chunks):
+        files.extend([''] * (len(chunks) - len(files)))
+
+    for existing_chunk, existing_file in zip(chunks, files):
+        if existing_chunk == chunk_id and existing_file == source_file:
+            return False
+    chunks.append(chunk_id)
+    files.append(source_file)
+    return True
+
+
+def _as_list(value) -> List[str]:
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value]
+    return list(value)
+
+
+def retract_files(graph: nx.Graph, files, chunk_ids=(), nodes=None, edges=None) -> Tuple[int, int]:
+    """撤回指定文件的来源记录，只删除引用计数归零的节点和边
+
+    节点或边对某个文件的引用计数即其来源记录中该文件的 (文件, 文本块) 对数，
+    撤回时删除这些记录，剩余记录为空的节点和边被删除。
+
+    nodes / edges 为可能受影响的候选（通常来自 CSRGraph 的来源倒排索引），
+    不给出时扫描全图。chunk_ids 用于匹配旧图中没有文件信息的来源记录。
+    返回 (删除的节点数, 删除的边数)。没有任何来源记录的节点保持不变。
+    """
+    files = set(files)
+    chunk_ids = set(chunk_ids)
+    if not files and not chunk_ids:
+        return 0, 0
+
+    def retract(attrs: Dict[str, Any]) -> bool:
+        """递减引用计数，返回是否已无来源"""
+        chunks = _as_list(attrs.get('source_chunks'))
+        source_files = _as_list(attrs.get('source_files'))
+        source_files += [''] * (len(chunks) - len(source_files))
+        kept = [(c, f) for c, f in zip(chunks, source_files)
+                if f not in files and not (not f and c in chunk_ids)]
+        if len(kept) == len(chunks):
+            return False
+        attrs['source_chunks'] = [c for c, _ in kept]
+        attrs['source_files'] = [f for _, f in kept]
+        return not kept
+
+    if edges is None:
+        edges = list(graph.edges())
+    if nodes is None:
+        nodes = list(graph.nodes())
+    orphan_edges = [(u, v) for u, v in edges if graph.has_edge(u, v) and retract(graph.edges[u, v])]
+    graph.remove_edges_from(orphan_edges)
+    orphan_nodes = [n for n in nodes if graph.has_node(n) and retract(graph.nodes[n])]
+    graph.remove_nodes_from(orphan_nodes)
+    return len(orphan_nodes), len(orphan_edges)
+
+
+def retract_document_from_graph(course_id: str, filename: str, chunk_ids=()) -> Tuple[int, int]:
+    """从课程知识图谱中撤回一个文件的来源记录并保存，返回 (删除的节点数, 删除的边数)
+
+    通过来源倒排索引只定位该文件涉及的节点和边，其他文件仍引用的共享概念会保留。
+    """
+    with course_write_lock(course_id):
+        index = load_course_graph(course_id)
+        keys = [filename, *chunk_ids]
+        nodes = index.nodes_with_provenance(keys)
+        edges = index.edges_with_provenance(keys)
+        if not nodes and not edges:
+            return 0, 0
+        graph = index.to_networkx()
+        removed = retract_files(graph, {filename}, chunk_ids, nodes, edges)
+        save_course_graph(course_id, graph)
+        signature = course_graph_signature(course_id)
+    _save_analytics(course_id, graph, signature)
+    return removed
+
+
+def _save_analytics(course_id: str, graph: nx.Graph, signature=None):
+    """保存图谱后重新计算分析结果，失败时只记录日志（读取方会把旧结果视为过期）
+
+    社区发现和 PageRank 耗时较长，应在释放课程写锁之后调用，signature 为锁内保存后的图谱签名。
+    """
+    try:
+        save_graph_analytics(course_id, graph, signature)
+    except Exception as e:
+        logging.error(f"计算知识图谱分析结果时出错: {e}")
+
+
+def merge_extraction(graph: nx.Graph, source_file: str, chunk_id: str,
+                     entities: List[Dict], relationships: List[Dict]) -> Tuple[int, int]:
+    """把单个文档块的提取结果合并进图中，返回 (新增实体数, 新增关系数)"""
+    entity_count = 0
+    relationship_count = 0
+
+    def ensure_node(name: str, entity_type: str = "Unknown"):
+        nonlocal entity_count
+        if not graph.has_node(name):
+            graph.add_node(name, type=entity_type, source_chunks=[], source_files=[])
+            entity_count += 1
+        elif entity_type != "Unknown" and graph.nodes[name].get('type', 'Unknown') == "Unknown":
+            graph.nodes[name]['type'] = entity_type
+        # 记录来源块
+        add_provenance(graph.nodes[name], source_file, chunk_id)
+
+    # 添加实体到图中
+    for entity in entities:
+        if not isinstance(entity, dict):
+            continue
+        name = normalize_entity_name(entity.get("name", ""))
+        if name and len(name) > 1:  # 过滤掉太短的实体
+            ensure_node(name, entity.get("type") or "Unknown")
+
+    # 添加关系到图中
+    for rel in relationships:
+        if not isinstance(rel, dict):
+            continue
+        source = normalize_entity_name(rel.get("source", ""))
+        target = normalize_entity_name(rel.get("target", ""))
+        if source and target and source != target:
+            # 确保两个实体都存在
+            ensure_node(source)
+            ensure_node(target)
+
+            # 添加边
+            if not graph.has_edge(source, target):
+                graph.add_edge(source, target, label=rel.get("label", ""), source_chunks=[], source_files=[])
+                relationship_count += 1
+            add_provenance(graph.edges[source, target], source_file, chunk_id)
+
+    return entity_count, relationship_count
+
+
+def retract_chunk_files(graph: nx.Graph, chunks: List[Document], index: Optional[CSRGraph] = None) -> Tuple[int, int]:
+    """撤回这些文档块所属文件此前的来源记录（文件被修改后重新入库）
+
+    index 为 graph 解码前的 CSRGraph 时，通过其来源倒排索引定位需要撤回的节点和边。
+    """
+    files = {f for f in (chunk_source_file(chunk) for chunk in chunks) if f}
+    nodes = edges = None
+    if index is not None:
+        nodes = index.nodes_with_provenance(files)
+        edges = index.edges_with_provenance(files)
+    removed_nodes, removed_edges = retract_files(graph, files, nodes=nodes, edges=edges)
+    if removed_nodes or removed_edges:
+        logging.info(f"撤回旧来源: 删除 {removed_nodes} 个节点, {removed_edges} 个关系")
+    return removed_nodes, removed_edges
+
+
+def merge_chunk_results(graph: nx.Graph, chunks: List[Document],
+                        results: List[Tuple[str, List[Dict], List[Dict]]],
+                        index: Optional[CSRGraph] = None, retract_existing: bool = True) -> nx.Graph:
+    """把一批文档块的提取结果合并进图中
+
+    retract_existing 为真时先撤回这些文档块所属文件此前的来源记录，因此同一文件重复合并不会残留旧内容产生的节点；
+    同一文件分多批合并时，只有调用方事先撤回旧来源后才能传 False。
+    """
+    if retract_existing:
+        retract_chunk_files(graph, chunks, index)
+    chunk_files = {chunk.metadata.get('chunk_id', 'unknown'): chunk_source_file(chunk) for chunk in chunks}
+
+    entity_count = 0
+    relationship_count = 0
+    for chunk_id, entities, relationships in results:
+        added_entities, added_relationships = merge_extraction(
+            graph, chunk_files.get(chunk_id, ''), chunk_id, entities, relationships
+        )
+        entity_count += added_entities
+        relationship_count += added_relationships
+
+    logging.info(
+        f"知识图谱合并完成: 新增 {entity_count} 个实体, {relationship_count} 个关系, "
+        f"当前共 {graph.number_of_nodes()} 个节点, {graph.number_of_edges()} 条边"
+    )
+    return graph
 
 class KnowledgeGraphBuilder:
     """知识图谱构建器"""
@@ -36,18 +330,13 @@ class KnowledgeGraphBuilder:
         self.api_base = os.getenv("LLM_API_BASE", "https://api.siliconflow.cn/v1")
         self.model_name = os.getenv("LLM_MODEL", "Qwen/Qwen3-32B")
         
-        # 初始化LLM
-        self.llm = ChatOpenAI(
-            openai_api_key=self.api_key,
-            openai_api_base=self.api_base,
-            model_name=self.model_name,
-            temperature=0,
-            max_retries=3
-        )
+        # 初始化LLM：复用 LLM 网关的连接池，并发和限流与其他 LLM 调用共用同一服务商
+        self.llm_client = get_llm_client(self.api_key, self.api_base, self.model_name) if self.api_key else None
+        self.llm = self._create_llm()
+        self._loop = None
         
         # 设置路径
         self.kb_dir = os.path.join("uploads/knowledge_base", course_id)
-        self.graph_path = os.path.join(self.kb_dir, 'knowledge_graph.gml')
         self.metadata_path = os.path.join(self.kb_dir, 'graph_metadata.json')
         
         # 确保目录存在
@@ -58,147 +347,283 @@ class KnowledgeGraphBuilder:
         
         # 创建提取链
         self.extraction_chain = self._create_extraction_chain()
+        self.batch_extraction_chain = self._create_batch_extraction_chain()
+        self.prompt_key = prompt_hash(EXTRACTION_PROMPT_TEMPLATE)
+        self.batch_prompt_key = prompt_hash(BATCH_EXTRACTION_PROMPT_TEMPLATE)
         
+    def _create_llm(self, http_async_client=None) -> ChatOpenAI:
+        return ChatOpenAI(
+            openai_api_key=self.api_key,
+            openai_api_base=self.api_base,
+            model_name=self.model_name,
+            temperature=0,
+            # 重试由 ExtractionScheduler 负责，429 需要反馈给服务商的令牌桶
+            max_retries=0,
+            http_client=self.llm_client.http_client if self.llm_client else None,
+            http_async_client=http_async_client
+        )
+    
+    def _bind_event_loop(self):
+        """在当前事件循环上改用 LLM 网关的异步连接池并重建提取链（异步连接池按事件循环创建）"""
+        loop = asyncio.get_running_loop()
+        if self.llm_client is None or self._loop is loop:
+            return
+        self.llm = self._create_llm(self.llm_client.async_http_client())
+        self.extraction_chain = self._create_extraction_chain()
+        self.batch_extraction_chain = self._create_batch_extraction_chain()
+        self._loop = loop
+    
     def _create_extraction_chain(self):
         """创建实体和关系提取链"""
-        prompt = ChatPromptTemplate.from_template('''
-从以下文本中提取关键实体和它们之间的关系。
-
-文本：
----
-{text}
----
-
-请以JSON格式返回结果，包含两个字段：
-1. "entities": 实体列表，每个实体包含 "name"（实体名称）和 "type"（实体类型，如概念、技术、人物等）
-2. "relationships": 关系列表，每个关系包含 "source"（源实体）、"target"（目标实体）和 "label"（关系描述）
-
-返回格式示例：
-{{
-  "entities": [
-    {{"name": "Python", "type": "编程语言"}},
-    {{"name": "机器学习", "type": "技术领域"}}
-  ],
-  "relationships": [
-    {{"source": "Python", "target": "机器学习", "label": "用于"}}
-  ]
-}}
-
-只返回JSON格式的结果，不要包含其他文字。
-''')
-        
+        prompt = ChatPromptTemplate.from_template(EXTRACTION_PROMPT_TEMPLATE)
         return prompt | self.llm | JsonOutputParser()
     
+    def _create_batch_extraction_chain(self):
+        """创建一次提取多个文档块的提取链
+
+        plan_batches 按输出预算打包，这里把同一预算作为 max_tokens 发送，
+        截断位置不再取决于服务端的默认上限。
+        """
+        prompt = ChatPromptTemplate.from_template(BATCH_EXTRACTION_PROMPT_TEMPLATE)
+        _, output_budget = self._batch_limit_tokens()
+        return prompt | self.llm.bind(max_tokens=output_budget) | JsonOutputParser()
+    
+    async def _extract_raw(self, text: str) -> Tuple[List[Dict], List[Dict]]:
+        """调用提取链，异常（包括429）直接抛出，由调度器决定是否重试"""
+        result = await self.extraction_chain.ainvoke({"text": text})
+        if not isinstance(result, dict):
+            raise ValueError(f"提取结果不是JSON对象: {type(result).__name__}")
+        return result.get("entities", []) or [], result.get("relationships", []) or []
+    
     async def extract_entities_and_relationships_async(self, text: str) -> Tuple[List[Dict], List[Dict]]:
         """异步从文本中提取实体和关系"""
+        self._bind_event_loop()
         try:
-            result = await self.extraction_chain.ainvoke({"text": text})
-            entities = result.get("entities", [])
-            relationships = result.get("relationships", [])
-            return entities, relationships
+            return await self._extract_raw(text)
         except Exception as e:
             logging.error(f"提取实体和关系时出错: {e}")
             return [], []
     
-    async def process_chunk_batch(self, chunks: List[Document]) -> List[Tuple[str, List[Dict], List[Dict]]]:
-        """批量处理文档块"""
-        semaphore = asyncio.Semaphore(GRAPH_CONCURRENCY)
-        
-        async def process_single_chunk(chunk):
-            async with semaphore:
-                chunk_id = chunk.metadata.get('chunk_id', 'unknown')
-                entities, relationships = await self.extract_entities_and_relationships_async(chunk.page_content)
-                await asyncio.sleep(GRAPH_DELAY)  # 减少延迟
-                return chunk_id, entities, relationships
-        
-        # 并发处理所有块
-        tasks = [process_single_chunk(chunk) for chunk in chunks]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        # 处理结果
-        processed_results = []
-        for result in results:
-            if isinstance(result, Exception):
-                logging.error(f"处理块时出错: {result}")
+    def _batch_limit_tokens(self) -> Tuple[int, int]:
+        """返回 (单个请求的输入 token 预算, 输出 token 预算)"""
+        context = GRAPH_MODEL_CONTEXT or model_context_size(self.model_name)
+        # 提示词模板、JSON 包装和估算误差各留余量，输入和输出各占上下文的一部分
+        input_budget = int(context * 0.4) - estimate_tokens(BATCH_EXTRACTION_PROMPT_TEMPLATE)
+        return max(0, input_budget), min(GRAPH_MAX_OUTPUT_TOKENS, int(context * 0.4))
+    
+    def plan_batches(self, chunks: List[Document]) -> List[List[Document]]:
+        """按模型上下文把文档块依次打包，每批最多 GRAPH_BATCH_CHUNKS 个"""
+        if GRAPH_BATCH_CHUNKS <= 1:
+            return [[chunk] for chunk in chunks]
+        input_budget, output_budget = self._batch_limit_tokens()
+        batches: List[List[Document]] = []
+        batch: List[Document] = []
+        input_tokens = output_tokens = 0
+        for chunk in chunks:
+            tokens = estimate_tokens(chunk.page_content) + 16
+            expected_output = int(tokens * GRAPH_OUTPUT_RATIO)
+            if batch and (len(batch) >= GRAPH_BATCH_CHUNKS
+                          or input_tokens + tokens > input_budget
+                          or output_tokens + expected_output > output_budget):
+                batches.append(batch)
+                batch, input_tokens, output_tokens = [], 0, 0
+            batch.append(chunk)
+            input_tokens += tokens
+            output_tokens += expected_output
+        if batch:
+            batches.append(batch)
+        return batches
+    
+    def _request_tokens(self, batch: List[Document]) -> int:
+        """一次抽取请求预计消耗的 token 数（提示词 + 预期输出），用于服务商的 token 速率令牌桶"""
+        template = BATCH_EXTRACTION_PROMPT_TEMPLATE if len(batch) > 1 else EXTRACTION_PROMPT_TEMPLATE
+        tokens = sum(estimate_tokens(chunk.page_content) + 16 for chunk in batch)
+        return estimate_tokens(template) + tokens + int(tokens * GRAPH_OUTPUT_RATIO)
+    
+    async def _extract_batch_raw(self, batch: List[Document]) -> Dict[int, Tuple[List[Dict], List[Dict]]]:
+        """一次请求提取多个文档块，返回 {批内序号: (entities, relationships)}
+
+        文档块在提示词中以批内序号 1..K 标记（比完整的 chunk_id 更不容易被模型抄错）。
+        响应无法解析时返回空字典，缺失的文档块由调用方改为逐个请求；网络错误和 429 照常抛出。
+        """
+        if len(batch) == 1:
+            return {0: await self._extract_raw(batch[0].page_content)}
+        chunks_text = "\n\n".join(
+            f'<片段 id="{i + 1}">\n{chunk.page_content}\n</片段>' for i, chunk in enumerate(batch)
+        )
+        try:
+            result = await self.batch_extraction_chain.ainvoke({"chunks": chunks_text})
+        except OutputParserException as e:
+            logging.warning(f"批量抽取结果解析失败，改为逐个请求: {e}")
+            return {}
+        if not isinstance(result, dict):
+            return {}
+        parsed = {}
+        for key, value in result.items():
+            try:
+                index = int(str(key).strip()) - 1
+            except ValueError:
                 continue
-            processed_results.append(result)
-        
-        return processed_results
+            if 0 <= index < len(batch) and isinstance(value, dict):
+                entities = value.get("entities", []) or []
+                relationships = value.get("relationships", []) or []
+                if isinstance(entities, list) and isinstance(relationships, list):
+                    parsed[index] = (entities, relationships)
+        return parsed
     
-    async def build_graph_from_chunks_async(self, chunks: List[Document]) -> nx.Graph:
-        """异步从文档块构建知识图谱"""
-        logging.info(f"开始构建知识图谱，处理 {len(chunks)} 个文档块...")
-        
-        graph = nx.Graph()
-        entity_count = 0
-        relationship_count = 0
+    async def extract_from_chunks_async(self, chunks: List[Document], on_result=None) -> List[Tuple[str, List[Dict], List[Dict]]]:
+        """异步对文档块做实体和关系提取，返回 [(chunk_id, entities, relationships)]
+
+        文档块按模型上下文打包为批量请求，由 ExtractionScheduler 以滑动窗口调度；
+        批量响应中缺失或无法解析的文档块改为单独请求。每完成一个文档块就调用
+        on_result(chunk, entities, relationships)，重试用尽的文档块被跳过。
+        """
+        logging.info(f"开始提取实体和关系，处理 {len(chunks)} 个文档块...")
+        self._bind_event_loop()
+        results = []
+        finished = 0
+        cache = get_extraction_cache()
         
-        # 分批处理
-        for i in range(0, len(chunks), GRAPH_BATCH_SIZE):
-            batch = chunks[i:i + GRAPH_BATCH_SIZE]
-            logging.info(f"处理批次 {i//GRAPH_BATCH_SIZE + 1}/{(len(chunks) + GRAPH_BATCH_SIZE - 1)//GRAPH_BATCH_SIZE}")
-            
+        def handle(chunk, result, error):
+            nonlocal finished
+            finished += 1
+            chunk_id = chunk.metadata.get('chunk_id', 'unknown')
+            if error is not None:
+                logging.error(f"处理块 {chunk_id} 时出错: {error}")
+            else:
+                entities, relationships = result
+                results.append((chunk_id, entities, relationships))
+                if on_result:
+                    on_result(chunk, entities, relationships)
             # 更新进度
             if self.progress_callback:
-                progress = (i / len(chunks)) * 100
-                self.progress_callback(progress)
-            
-            # 批量处理
-            batch_results = await self.process_chunk_batch(batch)
-            
-            # 处理结果
-            for chunk_id, entities, relationships in batch_results:
-                # 添加实体到图中
-                for entity in entities:
-                    name = entity.get("name", "").strip().upper()
-                    entity_type = entity.get("type", "Unknown")
-                    
-                    if name and len(name) > 1:  # 过滤掉太短的实体
-                        if not graph.has_node(name):
-                            graph.add_node(name, type=entity_type, source_chunks=[])
-                            entity_count += 1
-                        
-                        # 记录来源块
-                        if chunk_id not in graph.nodes[name]['source_chunks']:
-                            graph.nodes[name]['source_chunks'].append(chunk_id)
-                
-                # 添加关系到图中
-                for rel in relationships:
-                    source = rel.get("source", "").strip().upper()
-                    target = rel.get("target", "").strip().upper()
-                    label = rel.get("label", "")
-                    
-                    if source and target and source != target:
-                        # 确保两个实体都存在
-                        if not graph.has_node(source):
-                            graph.add_node(source, type="Unknown", source_chunks=[])
-                            entity_count += 1
-                        if not graph.has_node(target):
-                            graph.add_node(target, type="Unknown", source_chunks=[])
-                            entity_count += 1
-                        
-                        # 添加边
-                        if not graph.has_edge(source, target):
-                            graph.add_edge(source, target, label=label)
-                            relationship_count += 1
+                self.progress_callback(finished / len(chunks) * 100)
+        
+        # 先查抽取缓存，命中的文档块不再调用LLM
+        pending = chunks
+        if cache and chunks:
+            try:
+                cached = cache.get_many([self.batch_prompt_key, self.prompt_key], self.model_name,
+                                        [chunk.page_content for chunk in chunks])
+            except Exception as e:
+                logging.error(f"查询抽取缓存失败: {e}")
+                cached = [None] * len(chunks)
+            pending = []
+            for chunk, result in zip(chunks, cached):
+                if result is None:
+                    pending.append(chunk)
+                else:
+                    handle(chunk, result, None)
+            logging.info(f"抽取缓存命中 {len(chunks) - len(pending)}/{len(chunks)} 个文档块")
+        
+        async def extract(batch):
+            parsed = await self._extract_batch_raw(batch)
+            if cache:
+                prompt_key = self.prompt_key if len(batch) == 1 else self.batch_prompt_key
+                try:
+                    for index, (entities, relationships) in parsed.items():
+                        cache.put(prompt_key, self.model_name, batch[index].page_content, entities, relationships)
+                except Exception as e:
+                    logging.error(f"写入抽取缓存失败: {e}")
+            return parsed
+        
+        def handle_batch(batch, parsed, error):
+            if error is not None and len(batch) == 1:
+                handle(batch[0], None, error)
+                return
+            missing = 0
+            for index, chunk in enumerate(batch):
+                if parsed and index in parsed:
+                    handle(chunk, parsed[index], None)
+                elif len(batch) == 1:
+                    handle(chunk, None, ValueError("抽取结果无法解析"))
+                else:
+                    # 批量请求失败或缺少该文档块，改为单独请求
+                    scheduler.requeue([chunk])
+                    missing += 1
+            if missing:
+                logging.warning(f"批量抽取缺少 {missing}/{len(batch)} 个文档块的结果，改为逐个请求")
+        
+        batches = self.plan_batches(pending)
+        if pending:
+            logging.info(f"{len(pending)} 个文档块打包为 {len(batches)} 个抽取请求")
+        scheduler = ExtractionScheduler(
+            extract,
+            provider=self.llm_client.provider if self.llm_client else None,
+            cost=self._request_tokens
+        )
+        await scheduler.run(batches, handle_batch)
+        if cache:
+            stats = cache.stats()
+            logging.info(f"抽取缓存: 命中率 {stats['hit_rate']:.1%}, {stats['entries']} 条, "
+                         f"{stats['bytes'] / 1024 / 1024:.1f} MB")
         
         # 完成进度
         if self.progress_callback:
             self.progress_callback(100.0)
+        return results
+    
+    async def _build_async(self, chunks: List[Document], graph: nx.Graph, index: Optional[CSRGraph] = None,
+                           retract_existing: bool = True):
+        """边抽取边合并：先撤回这些文档块所属文件的旧来源（retract_existing 为真时），再把每个完成的结果立即合并进图"""
+        if retract_existing:
+            retract_chunk_files(graph, chunks, index)
+        
+        def merge(chunk, entities, relationships):
+            merge_extraction(graph, chunk_source_file(chunk), chunk.metadata.get('chunk_id', 'unknown'),
+                             entities, relationships)
         
-        logging.info(f"知识图谱构建完成: {entity_count} 个实体, {relationship_count} 个关系")
+        results = await self.extract_from_chunks_async(chunks, on_result=merge)
+        logging.info(f"知识图谱当前共 {graph.number_of_nodes()} 个节点, {graph.number_of_edges()} 条边")
+        return graph, results
+    
+    async def build_graph_from_chunks_async(self, chunks: List[Document], base_graph: Optional[nx.Graph] = None) -> nx.Graph:
+        """异步从文档块构建知识图谱
+
+        给出 base_graph 时把新提取的实体和关系合并进去，这些文档块所属文件的旧来源会先被撤回。
+        """
+        graph, _ = await self._build_async(chunks, base_graph if base_graph is not None else nx.Graph())
         return graph
     
-    def build_graph_from_chunks(self, chunks: List[Document]) -> nx.Graph:
+    def build_graph_from_chunks(self, chunks: List[Document], base_graph: Optional[nx.Graph] = None) -> nx.Graph:
         """从文档块构建知识图谱（同步接口）"""
         # 运行异步函数
-        return asyncio.run(self.build_graph_from_chunks_async(chunks))
+        return asyncio.run(self.build_graph_from_chunks_async(chunks, base_graph))
+    
+    def update_graph_from_chunks(self, chunks: List[Document], retract_existing: bool = True) -> nx.Graph:
+        """增量更新已保存的知识图谱：只对给定文档块调用LLM提取，边抽取边合并进现有图并保存
+
+        retract_existing 为假时不撤回这些文档块所属文件的旧来源，用于把同一文件的文档块分批合并
+        （调用方在第一批之前已用 retract_document_from_graph 撤回）。
+        """
+        signature = course_graph_signature(self.course_id)
+        index = load_course_graph(self.course_id)
+        graph, results = asyncio.run(self._build_async(chunks, index.to_networkx(), index, retract_existing))
+        # 抽取耗时较长，放在锁外；保存在锁内完成，抽取期间图谱被其他写入者修改时在最新的图上重新合并
+        with course_write_lock(self.course_id):
+            if course_graph_signature(self.course_id) != signature:
+                logging.info("知识图谱在抽取期间被修改，在最新版本上重新合并")
+                index = load_course_graph(self.course_id)
+                graph = index.to_networkx()
+                merge_chunk_results(graph, chunks, results, index, retract_existing)
+            signature = self.save_graph(graph, analytics=False)
+        # 分析结果同样在锁外计算，不阻塞该课程的其他写入
+        if signature:
+            _save_analytics(self.course_id, graph, signature)
+        return graph
     
-    def save_graph(self, graph: nx.Graph):
-        """保存知识图谱"""
+    def save_graph(self, graph: nx.Graph, analytics: bool = True):
+        """保存知识图谱，返回保存后的图谱签名，失败时返回 None
+
+        analytics 为假时不计算分析结果，由调用方在释放课程写锁后用返回的签名调用 _save_analytics。
+        """
         try:
-            # 保存GML格式
-            nx.write_gml(graph, self.graph_path)
+            # 保存为可 mmap 的二进制格式（GRAPH_EXPORT_GML=1 时同时导出 GML）
+            path = save_course_graph(self.course_id, graph)
+            signature = course_graph_signature(self.course_id)
+            # 度数、PageRank、社区摘要和文本块->实体索引
+            if analytics:
+                _save_analytics(self.course_id, graph, signature)
             
             # 保存元数据
             metadata = {
@@ -212,21 +637,19 @@ class KnowledgeGraphBuilder:
             with open(self.metadata_path, 'w', encoding='utf-8') as f:
                 json.dump(metadata, f, indent=2, ensure_ascii=False)
             
-            logging.info(f"知识图谱已保存到: {self.graph_path}")
+            logging.info(f"知识图谱已保存到: {path}")
+            return signature
             
         except Exception as e:
             logging.error(f"保存知识图谱时出错: {e}")
+            return None
     
     def load_graph(self) -> nx.Graph:
-        """加载知识图谱"""
+        """加载知识图谱（可修改的 networkx 副本）"""
         try:
-            if os.path.exists(self.graph_path):
-                graph = nx.read_gml(self.graph_path)
-                logging.info(f"已加载知识图谱: {graph.number_of_nodes()} 个节点, {graph.number_of_edges()} 条边")
-                return graph
-            else:
-                logging.warning("知识图谱文件不存在")
-                return nx.Graph()
+            graph = load_course_graph(self.course_id).to_networkx()
+            logging.info(f"已加载知识图谱: {graph.number_of_nodes()} 个节点, {graph.number_of_edges()} 条边")
+            return graph
         except Exception as e:
             logging.error(f"加载知识图谱时出错: {e}")
             return nx.Graph()
@@ -247,32 +670,35 @@ class KnowledgeGraphRetriever:
             openai_api_base=self.api_base,
             model_name=self.model_name,
             temperature=0.7,
-            max_retries=3
+            max_retries=3,
+            # 复用 LLM 网关的连接池
+            http_client=get_llm_client(self.api_key, self.api_base).http_client if self.api_key else None
         )
         
         # 设置路径
         self.kb_dir = os.path.join("uploads/knowledge_base", course_id)
-        self.graph_path = os.path.join(self.kb_dir, 'knowledge_graph.gml')
         
-        # 加载图
+        # 加载图，并取得（按图缓存的）实体名索引
         self.graph = self.load_graph()
+        self.entity_index = get_entity_index(self.graph)
         
-    def load_graph(self) -> nx.Graph:
-        """加载知识图谱"""
-        try:
-            if os.path.exists(self.graph_path):
-                graph = nx.read_gml(self.graph_path)
-                logging.info(f"已加载知识图谱: {graph.number_of_nodes()} 个节点, {graph.number_of_edges()} 条边")
-                return graph
-            else:
-                logging.warning("知识图谱文件不存在")
-                return nx.Graph()
-        except Exception as e:
-            logging.error(f"加载知识图谱时出错: {e}")
-            return nx.Graph()
+    def load_graph(self) -> CSRGraph:
+        """加载知识图谱（只读的 mmap 视图）"""
+        graph = load_course_graph(self.course_id)
+        if not graph.number_of_nodes():
+            logging.warning("知识图谱文件不存在或为空")
+        return graph
     
-    def extract_query_entities(self, query: str) -> List[str]:
-        """从查询中提取实体"""
+    def match_query_entities(self, query: str) -> List[str]:
+        """在本地识别查询中的图谱实体（实体名索引 + 分词模糊匹配），不调用 LLM"""
+        return self.entity_index.extract_entities(query)
+
+    def extract_query_entities(self, query: str, use_llm: bool = True) -> List[str]:
+        """从查询中提取实体：先在本地匹配图谱词表，匹配不到且 use_llm 为真时再调用 LLM"""
+        entities = self.match_query_entities(query)
+        if entities or not use_llm:
+            return entities
+        logging.info("本地未识别出查询实体，使用 LLM 提取")
         try:
             prompt = ChatPromptTemplate.from_template('''
 从以下问题中提取关键实体名称。
@@ -303,55 +729,20 @@ class KnowledgeGraphRetriever:
             logging.error(f"提取查询实体时出错: {e}")
             return []
     
-    def find_related_nodes(self, entities: List[str], max_depth: int = 2) -> List[str]:
-        """查找与查询实体相关的节点"""
-        related_nodes = set()
-        
-        for entity in entities:
-            if entity in self.graph:
-                # 添加实体本身
-                related_nodes.add(entity)
-                
-                # 查找邻居节点
-                neighbors = list(self.graph.neighbors(entity))
-                related_nodes.update(neighbors)
-                
-                # 查找更深层的相关节点
-                if max_depth > 1:
-                    for neighbor in neighbors:
-                        if neighbor in self.graph:
-                            second_neighbors = list(self.graph.neighbors(neighbor))
-                            related_nodes.update(second_neighbors)
-        
-        return list(related_nodes)
+    def find_related_nodes(self, entities: List[str], max_depth: int = 2,
+                           max_nodes: int = GRAPH_CONTEXT_MAX_NODES) -> List[str]:
+        """查找与查询实体相关的节点：个性化 PageRank 按预算扩展，按相关度和课程中心度排序"""
+        # 精确匹配不到时用 n-gram 模糊匹配最相近的实体名
+        seeds = [self.entity_index.resolve(name) for name in entities]
+        return expand_entities(self.graph, [seed for seed in seeds if seed is not None],
+                               max_depth=max_depth, max_nodes=max_nodes,
+                               centrality=get_node_centrality(self.course_id))
     
-    def get_subgraph_context(self, nodes: List[str]) -> str:
-        """获取子图的上下文信息"""
+    def get_subgraph_context(self, nodes: List[str], max_tokens: int = GRAPH_CONTEXT_MAX_TOKENS) -> str:
+        """获取子图的上下文信息（只描述选中节点之间的关系，不超过 token 预算）"""
         if not nodes:
             return ""
-        
-        context_parts = []
-        
-        for node in nodes:
-            if node in self.graph:
-                node_data = self.graph.nodes[node]
-                node_type = node_data.get('type', 'Unknown')
-                
-                # 获取与该节点相关的边
-                edges = []
-                for neighbor in self.graph.neighbors(node):
-                    edge_data = self.graph.edges[node, neighbor]
-                    edge_label = edge_data.get('label', '')
-                    edges.append(f"{node} --{edge_label}--> {neighbor}")
-                
-                # 构建节点描述
-                node_desc = f"实体: {node} (类型: {node_type})"
-                if edges:
-                    node_desc += f"\n关系: {'; '.join(edges)}"
-                
-                context_parts.append(node_desc)
-        
-        return "\n\n".join(context_parts)
+        return format_subgraph_context(self.graph, nodes, max_tokens)
     
     def query_with_graph_context_stream(self, query: str, max_depth: int = 2):
         """使用知识图谱上下文进行流式查询"""
@@ -389,60 +780,28 @@ class KnowledgeGraphRetriever:
 
 回答："""
             
-            # 发送流式请求
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "model": self.model_name,
-                "messages": [
-                    {"role": "user", "content": prompt}
-                ],
-                "max_tokens": 2000,
-                "temperature": 0.7,
-                "stream": True
-            }
-            
-            response = requests.post(
-                f"{self.api_base}/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=60,
-                stream=True
-            )
-            
-            if response.status_code == 200:
-                for line in response.iter_lines():
-                    if line:
-                        line = line.decode('utf-8')
-                        if line.startswith('data: '):
-                            data_str = line[6:]
-                            if data_str == '[DONE]':
-                                break
-                            try:
-                                data_json = json.loads(data_str)
-                                if 'choices' in data_json and len(data_json['choices']) > 0:
-                                    delta = data_json['choices'][0].get('delta', {})
-                                    if 'content' in delta and delta['content'] is not None:
-                                        yield delta['content']
-                            except json.JSONDecodeError:
-                                continue
-            else:
-                logging.error(f"LLM请求失败: {response.status_code} - {response.text}")
-                yield f"抱歉，处理请求时出现错误：{response.text}"
+            # 发送流式请求（共享连接池，统一限流和重试）
+            for content in get_llm_client(self.api_key, self.api_base).stream(
+                [{"role": "user", "content": prompt}],
+                model=self.model_name,
+                max_tokens=2000,
+                temperature=0.7
+            ):
+                yield content
                 
         except Exception as e:
             logging.error(f"知识图谱查询时出错: {e}")
             yield f"抱歉，查询过程中出现错误：{str(e)}"
 
-def build_knowledge_graph(course_id: str, chunks: List[Document], progress_callback=None) -> bool:
-    """构建知识图谱的主函数"""
+def build_knowledge_graph(course_id: str, chunks: List[Document], progress_callback=None,
+                          retract_existing: bool = True) -> bool:
+    """构建知识图谱的主函数：把文档块的实体和关系增量合并进课程已有的知识图谱
+
+    retract_existing 见 KnowledgeGraphBuilder.update_graph_from_chunks。
+    """
     try:
         builder = KnowledgeGraphBuilder(course_id, progress_callback)
-        graph = builder.build_graph_from_chunks(chunks)
-        builder.save_graph(graph)
+        builder.update_graph_from_chunks(chunks, retract_existing)
         return True
     except Exception as e:
         logging.error(f"构建知识图谱失败: {e}")
@@ -0,0 +1,442 @@
+"""
+LLM 调用网关
+
+对话、评分、出题、备课和查询扩展共用的 LLM 客户端层：
+- 按 (API 地址, API 密钥) 复用 openai 客户端，底层 httpx 连接池保持长连接，不再每次请求都做 TLS 握手
+- 同步（complete / stream）和异步（acomplete / astream）接口，流式接口直接产出文本增量
+- 每个服务商（API 地址）一个全局并发上限，并共享请求速率和 token 速率两个令牌桶；
+  收到 429 时令牌桶降速并按 Retry-After 暂停，所有调用方一起退避，避免限流风暴
+- 统一的超时和重试策略：429、5xx、超时和连接错误按指数退避重试，流式请求只在产出第一个增量前重试
+- 按 (服务商, 模型) 统计调用次数、失败次数、延迟 p50/p95、首字延迟和 token 用量
+"""
+
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from collections import Counter, deque
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+import openai
+
+from backend.rag.embedding_engine import estimate_tokens
+from backend.rag.rate_limiter import TokenBucket, get_rate_limiter, rate_limit_info
+
+logger = logging.getLogger(__name__)
+
+# 每个服务商同时进行的请求数上限
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+# 每个服务商的请求速率（次/秒），0 表示不限速（仍然遵循 429 的 Retry-After）
+LLM_RATE_LIMIT = float(os.getenv("LLM_RATE_LIMIT", "0"))
+# 每个服务商的 token 速率（token/分钟），0 表示不限速
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+# 每个服务商保持的长连接数
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "16"))
+LLM_BACKOFF_BASE = 1.0
+LLM_BACKOFF_CAP = 20.0
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+DEFAULT_API_BASE = "https://api.openai.com/v1"
+# 计算延迟分位数使用的最近调用数
+_LATENCY_WINDOW = 200
+
+
+class LLMGatewayError(Exception):
+    """LLM 请求在重试后仍然失败"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class LLMTimeoutError(LLMGatewayError):
+    """LLM 请求超时"""
+
+
+def _retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    status, _ = rate_limit_info(error)
+    return status in RETRYABLE_STATUS
+
+
+def _backoff(attempt: int, retry_after: Optional[float]) -> float:
+    if retry_after is not None:
+        return min(retry_after, LLM_BACKOFF_CAP * 3)
+    return random.uniform(0, min(LLM_BACKOFF_CAP, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+def _wrap(error: Exception) -> LLMGatewayError:
+    status, _ = rate_limit_info(error)
+    if isinstance(error, openai.APITimeoutError):
+        return LLMTimeoutError(f"LLM 请求超时: {error}")
+    return LLMGatewayError(f"LLM 请求失败: {error}", status)
+
+
+def _prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(estimate_tokens(str(message.get("content") or "")) + 4 for message in messages)
+
+
+class _Metrics:
+    """按 (服务商, 模型) 统计的调用指标"""
+
+    def __init__(self):
+        self.counters = Counter()
+        self.latencies = deque(maxlen=_LATENCY_WINDOW)
+        self.first_token = deque(maxlen=_LATENCY_WINDOW)
+
+    @staticmethod
+    def _percentile(samples, q: float) -> Optional[float]:
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))] * 1000
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "latency_p50_ms": self._percentile(self.latencies, 0.5),
+            "latency_p95_ms": self._percentile(self.latencies, 0.95),
+            "first_token_p95_ms": self._percentile(self.first_token, 0.95),
+        }
+
+
+class _Provider:
+    """单个服务商的客户端、并发上限和令牌桶"""
+
+    def __init__(self, api_base: str, api_key: str):
+        self.api_base = api_base
+        self.api_key = api_key
+        self.slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
+        # 请求速率按服务商共享；429 的退避通过它通知所有调用方
+        self.requests: TokenBucket = get_rate_limiter(f"llm|{api_base}", LLM_RATE_LIMIT)
+        self.tokens: TokenBucket = get_rate_limiter(f"llm-tokens|{api_base}", LLM_TOKENS_PER_MINUTE / 60,
+                                                    capacity=max(1.0, LLM_TOKENS_PER_MINUTE))
+        timeout = httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+        limits = httpx.Limits(max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_POOL_SIZE)
+        self.http_client = httpx.Client(timeout=timeout, limits=limits)
+        # 重试由网关负责，429 需要反馈给令牌桶
+        self.client = openai.OpenAI(api_key=api_key, base_url=api_base, max_retries=0,
+                                    timeout=timeout, http_client=self.http_client)
+        # 异步客户端绑定事件循环，按循环分别创建
+        self._async_clients: Dict[int, Tuple[Any, openai.AsyncOpenAI, httpx.AsyncClient]] = {}
+        self._lock = threading.Lock()
+
+    def async_client(self) -> openai.AsyncOpenAI:
+        return self._async_entry()[1]
+
+    def async_http_client(self) -> httpx.AsyncClient:
+        return self._async_entry()[2]
+
+    def _async_entry(self) -> Tuple[Any, openai.AsyncOpenAI, httpx.AsyncClient]:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            entry = self._async_clients.get(id(loop))
+            if entry is None or entry[0] is not loop:
+                # 清理已关闭事件循环的客户端
+                self._async_clients = {
+                    key: value for key, value in self._async_clients.items() if not value[0].is_closed()
+                }
+                timeout = httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+                limits = httpx.Limits(max_connections=LLM_POOL_SIZE, max_keepalive_connections=LLM_POOL_SIZE)
+                http_client = httpx.AsyncClient(timeout=timeout, limits=limits)
+                client = openai.AsyncOpenAI(
+                    api_key=self.api_key, base_url=self.api_base, max_retries=0, timeout=timeout,
+                    http_client=http_client
+                )
+                entry = self._async_clients[id(loop)] = (loop, client, http_client)
+            return entry
+
+    def acquire(self, prompt_tokens: int):
+        self.slots.acquire()
+        self.requests.acquire()
+        self.tokens.acquire(prompt_tokens)
+
+    async def acquire_async(self, prompt_tokens: int):
+        # 与同步调用共享同一个并发上限，等待时不阻塞事件循环
+        delay = 0.01
+        while not self.slots.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        try:
+            await self.requests.acquire_async()
+            await self.tokens.acquire_async(prompt_tokens)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self):
+        self.slots.release()
+
+
+class LLMClient:
+    """绑定到某个服务商的 LLM 客户端（由 get_llm_client 返回，可在线程间共享）"""
+
+    def __init__(self, gateway: "LLMGateway", provider: _Provider, default_model: Optional[str]):
+        self.gateway = gateway
+        self.provider = provider
+        self.default_model = default_model
+
+    @property
+    def api_base(self) -> str:
+        return self.provider.api_base
+
+    @property
+    def http_client(self) -> httpx.Client:
+        """底层的同步 httpx 连接池，可传给 langchain 的 ChatOpenAI 复用"""
+        return self.provider.http_client
+
+    def async_http_client(self) -> httpx.AsyncClient:
+        """当前事件循环上的异步 httpx 连接池，可传给 ChatOpenAI 的 http_async_client（须在事件循环中调用）"""
+        return self.provider.async_http_client()
+
+    def _request(self, messages: List[Dict[str, Any]], model: Optional[str], kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        model = model or self.default_model
+        if not model:
+            raise ValueError("未指定 LLM 模型")
+        kwargs.pop("stream", None)
+        return {"model": model, "messages": messages, **kwargs}
+
+    def _on_error(self, error: Exception, attempt: int, metrics: _Metrics) -> float:
+        """记录失败；可重试时返回等待秒数，否则抛出 LLMGatewayError"""
+        status, retry_after = rate_limit_info(error)
+        if status == 429:
+            self.provider.requests.on_rate_limited(retry_after)
+        if attempt >= LLM_MAX_RETRIES or not _retryable(error):
+            with self.gateway.lock:
+                metrics.counters["errors"] += 1
+            raise _wrap(error) from error
+        with self.gateway.lock:
+            metrics.counters["retries"] += 1
+        delay = _backoff(attempt, retry_after)
+        logger.warning(f"LLM 请求失败（第 {attempt + 1} 次），{delay:.1f} 秒后重试: {error}")
+        return delay
+
+    def _on_success(self, metrics: _Metrics, started: float, prompt_tokens: int, completion_tokens: int,
+                    first_token: Optional[float] = None):
+        self.provider.requests.on_success()
+        # 预约时只按估算的提示词计数，回答的 token 在这里补扣
+        self.provider.tokens.reserve(completion_tokens)
+        with self.gateway.lock:
+            metrics.counters["calls"] += 1
+            metrics.counters["prompt_tokens"] += prompt_tokens
+            metrics.counters["completion_tokens"] += completion_tokens
+            metrics.latencies.append(time.monotonic() - started)
+            if first_token is not None:
+                metrics.first_token.append(first_token - started)
+
+    @staticmethod
+    def _usage(response, messages: List[Dict[str, Any]], text: str) -> Tuple[int, int]:
+        usage = getattr(response, "usage", None)
+        if usage is not None and getattr(usage, "prompt_tokens", None) is not None:
+            return usage.prompt_tokens, usage.completion_tokens or 0
+        return _prompt_tokens(messages), estimate_tokens(text) if text else 0
+
+    def complete(self, messages: List[Dict[str, Any]], model: Optional[str] = None, **kwargs):
+        """非流式调用，返回 openai 的 ChatCompletion 对象"""
+        request = self._request(messages, model, kwargs)
+        metrics = self.gateway.metrics(self.provider.api_base, request["model"])
+        estimate = _prompt_tokens(messages)
+        attempt = 0
+        while True:
+            self.provider.acquire(estimate)
+            started = time.monotonic()
+            try:
+                response = self.provider.client.chat.completions.create(**request)
+            except Exception as e:
+                delay = self._on_error(e, attempt, metrics)
+            else:
+                text = response.choices[0].message.content if response.choices else ""
+                self._on_success(metrics, started, *self._usage(response, messages, text or ""))
+                return response
+            finally:
+                self.provider.release()
+            time.sleep(delay)
+            attempt += 1
+
+    def chat(self, messages: List[Dict[str, Any]], model: Optional[str] = None, **kwargs) -> str:
+        """非流式调用，返回回答文本"""
+        response = self.complete(messages, model, **kwargs)
+        return (response.choices[0].message.content or "") if response.choices else ""
+
+    def stream(self, messages: List[Dict[str, Any]], model: Optional[str] = None, **kwargs) -> Iterator[str]:
+        """流式调用，逐个产出文本增量；只在产出第一个增量之前重试"""
+        request = self._request(messages, model, kwargs)
+        metrics = self.gateway.metrics(self.provider.api_base, request["model"])
+        estimate = _prompt_tokens(messages)
+        attempt = 0
+        while True:
+            self.provider.acquire(estimate)
+            started = time.monotonic()
+            first_token = None
+            parts: List[str] = []
+            usage = None
+            try:
+                response = self.provider.client.chat.completions.create(stream=True, **request)
+                try:
+                    for chunk in response:
+                        if getattr(chunk, "usage", None) is not None:
+                            usage = chunk
+                        if not chunk.choices:
+                            continue
+                        content = chunk.choices[0].delta.content
+                        if content:
+                            if first_token is None:
+                                first_token = time.monotonic()
+                            parts.append(content)
+                            yield content
+                finally:
+                    response.close()
+            except GeneratorExit:
+                raise
+            except Exception as e:
+                if first_token is not None:
+                    # 已经产出了部分内容，不能重试
+                    with self.gateway.lock:
+                        metrics.counters["errors"] += 1
+                    raise _wrap(e) from e
+                delay = self._on_error(e, attempt, metrics)
+            else:
+                self._on_success(metrics, started, *self._usage(usage, messages, "".join(parts)), first_token)
+                return
+            finally:
+                self.provider.release()
+            time.sleep(delay)
+            attempt += 1
+
+    async def acomplete(self, messages: List[Dict[str, Any]], model: Optional[str] = None, **kwargs):
+        """异步非流式调用，返回 openai 的 ChatCompletion 对象"""
+        request = self._request(messages, model, kwargs)
+        metrics = self.gateway.metrics(self.provider.api_base, request["model"])
+        estimate = _prompt_tokens(messages)
+        attempt = 0
+        while True:
+            await self.provider.acquire_async(estimate)
+            started = time.monotonic()
+            try:
+                response = await self.provider.async_client().chat.completions.create(**request)
+            except Exception as e:
+                delay = self._on_error(e, attempt, metrics)
+            else:
+                text = response.choices[0].message.content if response.choices else ""
+                self._on_success(metrics, started, *self._usage(response, messages, text or ""))
+                return response
+            finally:
+                self.provider.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def achat(self, messages: List[Dict[str, Any]], model: Optional[str] = None, **kwargs) -> str:
+        """异步非流式调用，返回回答文本"""
+        response = await self.acomplete(messages, model, **kwargs)
+        return (response.choices[0].message.content or "") if response.choices else ""
+
+    async def astream(self, messages: List[Dict[str, Any]], model: Optional[str] = None,
+                      **kwargs) -> AsyncIterator[str]:
+        """异步流式调用，逐个产出文本增量；只在产出第一个增量之前重试"""
+        request = self._request(messages, model, kwargs)
+        metrics = self.gateway.metrics(self.provider.api_base, request["model"])
+        estimate = _prompt_tokens(messages)
+        attempt = 0
+        while True:
+            await self.provider.acquire_async(estimate)
+            started = time.monotonic()
+            first_token = None
+            parts: List[str] = []
+            usage = None
+            try:
+                response = await self.provider.async_client().chat.completions.create(stream=True, **request)
+                try:
+                    async for chunk in response:
+                        if getattr(chunk, "usage", None) is not None:
+                            usage = chunk
+                        if not chunk.choices:
+                            continue
+                        content = chunk.choices[0].delta.content
+                        if content:
+                            if first_token is None:
+                                first_token = time.monotonic()
+                            parts.append(content)
+                            yield content
+                finally:
+                    await response.close()
+            except (GeneratorExit, asyncio.CancelledError):
+                raise
+            except Exception as e:
+                if first_token is not None:
+                    with self.gateway.lock:
+                        metrics.counters["errors"] += 1
+                    raise _wrap(e) from e
+                delay = self._on_error(e, attempt, metrics)
+            else:
+                self._on_success(metrics, started, *self._usage(usage, messages, "".join(parts)), first_token)
+                return
+            finally:
+                self.provider.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class LLMGateway:
+    """进程级的 LLM 网关：管理各服务商的客户端和调用指标"""
+
+    def __init__(self):
+        self._providers: Dict[Tuple[str, str], _Provider] = {}
+        self._metrics: Dict[Tuple[str, str], _Metrics] = {}
+        self.lock = threading.Lock()
+
+    def client(self, api_key: Optional[str] = None, api_base: Optional[str] = None,
+               model: Optional[str] = None) -> LLMClient:
+        """返回服务商的客户端，未指定的参数取 LLM_API_KEY / LLM_API_BASE / LLM_MODEL"""
+        api_key = api_key or os.getenv("LLM_API_KEY")
+        if not api_key:
+            raise ValueError("LLM_API_KEY 未配置")
+        api_base = (api_base or os.getenv("LLM_API_BASE") or DEFAULT_API_BASE).rstrip("/")
+        key = (api_base, api_key)
+        with self.lock:
+            provider = self._providers.get(key)
+            if provider is None:
+                provider = self._providers[key] = _Provider(api_base, api_key)
+        return LLMClient(self, provider, model or os.getenv("LLM_MODEL"))
+
+    def metrics(self, api_base: str, model: str) -> _Metrics:
+        with self.lock:
+            metrics = self._metrics.get((api_base, model))
+            if metrics is None:
+                metrics = self._metrics[(api_base, model)] = _Metrics()
+            return metrics
+
+    def stats(self) -> Dict[str, Any]:
+        """按 服务商|模型 汇总的调用指标，以及各服务商令牌桶的当前速率"""
+        with self.lock:
+            result = {f"{api_base}|{model}": metrics.snapshot()
+                      for (api_base, model), metrics in self._metrics.items()}
+            providers = list(self._providers.values())
+        for provider in providers:
+            result.setdefault(f"{provider.api_base}|*", {})["limiter"] = provider.requests.stats()
+        return result
+
+
+_gateway: Optional[LLMGateway] = None
+_gateway_lock = threading.Lock()
+
+
+def get_llm_gateway() -> LLMGateway:
+    """返回进程级共享的 LLM 网关"""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = LLMGateway()
+    return _gateway
+
+
+def get_llm_client(api_key: Optional[str] = None, api_base: Optional[str] = None,
+                   model: Optional[str] = None) -> LLMClient:
+    """返回共享连接池的 LLM 客户端"""
+    return get_llm_gateway().client(api_key, api_base, model)
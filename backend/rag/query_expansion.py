@@ -1,9 +1,10 @@
 import os
-import requests
 import logging
 from typing import Optional
 from dotenv import load_dotenv
 
+from backend.rag.llm_gateway import get_llm_client
+
 # 配置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -64,46 +65,25 @@ def expand_query(query: str, use_cache: bool = True) -> str:
         扩展查询:"""
         
         # 发送请求
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": model,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": 300,
-            "temperature": 0.3  # 低温度保持扩展的相关性
-        }
-        
         logger.info(f"扩展查询，使用模型: {model}")
-        response = requests.post(
-            f"{api_base}/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=60  # 增加超时时间到60秒
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            expanded_query = result["choices"][0]["message"]["content"].strip()
-            logger.info(f"原始查询: {query}")
-            logger.info(f"扩展查询: {expanded_query}")
-            
-            # 保存到缓存
-            if use_cache and expanded_query:
-                try:
-                    with open(cache_file, "w", encoding="utf-8") as f:
-                        f.write(expanded_query)
-                except Exception as e:
-                    logger.warning(f"写入缓存失败: {e}")
-                    
-            return expanded_query
-        else:
-            logger.error(f"查询扩展请求失败: {response.status_code} - {response.text}")
-            return query
+        expanded_query = get_llm_client(api_key, api_base).chat(
+            [{"role": "user", "content": prompt}],
+            model=model,
+            max_tokens=300,
+            temperature=0.3  # 低温度保持扩展的相关性
+        ).strip()
+        logger.info(f"原始查询: {query}")
+        logger.info(f"扩展查询: {expanded_query}")
+        
+        # 保存到缓存
+        if use_cache and expanded_query:
+            try:
+                with open(cache_file, "w", encoding="utf-8") as f:
+                    f.write(expanded_query)
+            except Exception as e:
+                logger.warning(f"写入缓存失败: {e}")
+                
+        return expanded_query or query
             
     except Exception as e:
         logger.error(f"查询扩展时出错: {e}")
@@ -147,32 +127,15 @@ def multi_query_expansion(query: str, num_variations: int = 3) -> list:
         """
         
         # 发送请求
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": model,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": 500,
-            "temperature": 0.5  # 稍高的温度以获得更多样化的变体
-        }
-        
         logger.info(f"生成多查询变体，使用模型: {model}")
-        response = requests.post(
-            f"{api_base}/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=60  # 增加超时时间到60秒
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            content = result["choices"][0]["message"]["content"].strip()
-            
+        content = get_llm_client(api_key, api_base).chat(
+            [{"role": "user", "content": prompt}],
+            model=model,
+            max_tokens=500,
+            temperature=0.5  # 稍高的温度以获得更多样化的变体
+        ).strip()
+        
+        if content:
             # 解析JSON响应
             import json
             try:
@@ -197,7 +160,7 @@ def multi_query_expansion(query: str, num_variations: int = 3) -> list:
                 logger.warning("JSON解析失败")
                 return [query]
         else:
-            logger.error(f"多查询扩展请求失败: {response.status_code}")
+            logger.error("多查询扩展返回为空")
             return [query]
             
     except Exception as e:
@@ -1,13 +1,11 @@
 import os
 import argparse
 from dotenv import load_dotenv
-import networkx as nx
 from typing import List, Dict, Any, Optional
 import random
 import time
 import openai
 import sys
-import json
 import logging
 import requests
 from pathlib import Path
@@ -88,60 +86,67 @@ from langchain_core.runnables import RunnablePassthrough
 from langchain_openai import ChatOpenAI
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings  # 导入Embeddings接口
-from backend.rag.embedding_util import get_embedding
+from backend.rag.embedding_engine import get_embedding_engine
+from backend.rag.resource_registry import get_course_resources
+from backend.rag.graph_store import CSRGraph, load_course_graph
+from backend.rag.entity_index import get_entity_index
+from backend.rag.graph_expansion import bounded_shortest_paths, rank_chunks
+from backend.rag.bm25_index import document_key, ensure_bm25_index, reciprocal_rank_fusion
+from backend.rag.reranker import get_rerank_service
+from backend.rag.context_packer import context_budget, count_tokens, pack_context
+from backend.rag.llm_gateway import LLMTimeoutError, get_llm_client
+
+# 混合检索：向量检索和 BM25 各取的候选数，以及融合后送去重排序的候选数
+HYBRID_VECTOR_K = int(os.getenv("HYBRID_VECTOR_K", "10"))
+HYBRID_LEXICAL_K = int(os.getenv("HYBRID_LEXICAL_K", "10"))
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "8"))
+# build_rag_context 检索并重排序的候选数，全部交给上下文打包按 token 预算挑选
+RAG_CONTEXT_CANDIDATES = int(os.getenv("RAG_CONTEXT_CANDIDATES", "20"))
+# 提示词模板本身占用的 token（预留给上下文以外的部分）
+PROMPT_OVERHEAD_TOKENS = 200
 
 # 导入自定义的EmbeddingFunction，避免从create_db导入
 class EmbeddingFunction(Embeddings):  # 实现Embeddings接口
-    """Custom embedding function for use with Chroma."""
+    """Custom embedding function for use with Chroma.
+
+    与入库端共用同一个向量化引擎：批量并发请求、复用连接池，
+    查询向量使用进程内 LRU 缓存，重复的问题不再请求API。
+    """
     def __init__(self):
-        self.get_embedding = get_embedding
+        self.engine = get_embedding_engine()
         
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Embed a list of documents."""
-        embeddings = []
-        for text in texts:
-            try:
-                result = self.get_embedding(text)
-                embeddings.append(result["data"][0]["embedding"])
-            except Exception as e:
-                print(f"Error embedding document: {e}")
-                # 返回1024维零向量作为后备
-                embeddings.append([0.0] * 1024)
-        return embeddings
+        try:
+            return self.engine.embed(texts, placeholder_on_error=True)
+        except Exception as e:
+            print(f"Error embedding documents: {e}")
+            # 返回1024维零向量作为后备
+            return [[0.0] * 1024 for _ in texts]
 
     def embed_query(self, text: str) -> List[float]:
         """Embed a single query."""
         try:
-            result = self.get_embedding(text)
-            return result["data"][0]["embedding"]
+            return self.engine.embed_query(text)
         except Exception as e:
             print(f"Error embedding query: {e}")
             # 返回1024维零向量作为后备
             return [0.0] * 1024
 
 # 添加缺失的函数
-def load_knowledge_graph(course_id: str) -> nx.Graph:
-    """加载知识图谱"""
-    try:
-        graph_path = os.path.join("uploads/knowledge_base", course_id, 'knowledge_graph.gml')
-        if os.path.exists(graph_path):
-            return nx.read_gml(graph_path)
-        else:
-            return nx.Graph()
-    except Exception as e:
-        print(f"加载知识图谱失败: {e}")
-        return nx.Graph()
+def load_knowledge_graph(course_id: str) -> CSRGraph:
+    """加载知识图谱（mmap 打开的只读图，文件未变化时复用同一映射）"""
+    return load_course_graph(str(course_id))
 
-def search_knowledge_graph(graph: nx.Graph, query: str, all_chunks: dict) -> List[Document]:
+def search_knowledge_graph(graph: CSRGraph, query: str, all_chunks: dict) -> List[Document]:
     """在知识图谱中搜索相关内容"""
     try:
-        # 简单的关键词搜索
-        query_upper = query.upper()
+        # 实体名索引：查询中出现的实体名 + 名称中包含查询词的实体
+        index = get_entity_index(graph)
         related_chunk_ids = set()
         
-        for node in graph.nodes():
-            if query_upper in node:
-                related_chunk_ids.update(graph.nodes[node].get('source_chunks', []))
+        for node in dict.fromkeys(index.match(query) + index.containing(query)):
+            related_chunk_ids.update(graph.nodes[node].get('source_chunks', []))
         
         # 返回相关文档
         return [all_chunks[chunk_id] for chunk_id in related_chunk_ids if chunk_id in all_chunks]
@@ -169,55 +174,59 @@ Question:
     """)
     return prompt | llm | JsonOutputParser()
 
-def get_graph_context(question: str, graph: nx.Graph, all_chunks: dict, llm) -> List[Document]:
+def get_graph_context(question: str, graph: CSRGraph, all_chunks: dict, llm) -> List[Document]:
     """
     Retrieves context from the knowledge graph by finding paths between entities in the query.
     """
     print("--- Identifying entities in query for graph search ---")
-    query_entities_chain = get_query_entities_chain(llm)
-    try:
-        entities = query_entities_chain.invoke({"question": question})
-        # Filter out any non-string or empty string results from the parser
-        entities = [e.strip().upper() for e in entities if isinstance(e, str) and e.strip()]
-        print(f"--- Found entities: {entities} ---")
-    except Exception:
-        print("--- Could not extract entities from query, skipping graph search. ---")
-        return []
+    # Match against the course graph's own vocabulary first; only ask the LLM when nothing is found
+    index = get_entity_index(graph)
+    entities = index.extract_entities(question)
+    if entities:
+        print(f"--- Found entities locally: {entities} ---")
+    else:
+        query_entities_chain = get_query_entities_chain(llm)
+        try:
+            entities = query_entities_chain.invoke({"question": question})
+            # Filter out any non-string or empty string results from the parser
+            entities = [e.strip().upper() for e in entities if isinstance(e, str) and e.strip()]
+            print(f"--- Found entities: {entities} ---")
+        except Exception:
+            print("--- Could not extract entities from query, skipping graph search. ---")
+            return []
+
+        # Map the extracted names onto graph nodes (exact first, then n-gram fuzzy match)
+        entities = list(dict.fromkeys(filter(None, (index.resolve(e) for e in entities))))
 
     if not entities:
         return []
 
-    related_chunk_ids = set()
     path_docs = []
-
-    # First, gather chunks directly related to each entity
-    for entity_name in entities:
-        if entity_name in graph:
-            related_chunk_ids.update(graph.nodes[entity_name].get('source_chunks', []))
-
-    # If multiple entities are found, find paths between them
-    if len(entities) > 1:
-        for i in range(len(entities)):
-            for j in range(i + 1, len(entities)):
-                source = entities[i]
-                target = entities[j]
-                if source in graph and target in graph:
-                    try:
-                        paths = list(nx.all_shortest_paths(graph, source=source, target=target))
-                        print(f"--- Found {len(paths)} shortest path(s) between {source} and {target} ---")
-                        for path in paths:
-                            path_str = " -> ".join(path)
-                            path_doc = Document(
-                                page_content=f"Found a reasoning path: {path_str}",
-                                metadata={"source": "knowledge_graph_path"}
-                            )
-                            path_docs.append(path_doc)
-                            # Add chunks from all nodes in the path
-                            for node_name in path:
-                                related_chunk_ids.update(graph.nodes[node_name].get('source_chunks', []))
-                    except nx.NetworkXNoPath:
-                        print(f"--- No path found between {source} and {target} ---")
-                        pass
+    # Entities first, then the nodes on the paths between them; chunks are ranked over this list
+    ranked_nodes = [entity_name for entity_name in entities if entity_name in graph]
+
+    # If multiple entities are found, find a bounded number of short paths between them
+    if len(ranked_nodes) > 1:
+        for i in range(len(ranked_nodes)):
+            for j in range(i + 1, len(ranked_nodes)):
+                source = ranked_nodes[i]
+                target = ranked_nodes[j]
+                paths = bounded_shortest_paths(graph, source, target)
+                if not paths:
+                    print(f"--- No path found between {source} and {target} ---")
+                    continue
+                print(f"--- Found {len(paths)} shortest path(s) between {source} and {target} ---")
+                for path in paths:
+                    path_str = " -> ".join(path)
+                    path_doc = Document(
+                        page_content=f"Found a reasoning path: {path_str}",
+                        metadata={"source": "knowledge_graph_path"}
+                    )
+                    path_docs.append(path_doc)
+                    ranked_nodes.extend(path)
+
+    # Hub concepts can reference hundreds of chunks; keep only the best-supported ones
+    related_chunk_ids = rank_chunks(graph, list(dict.fromkeys(ranked_nodes)))
 
     # Retrieve the unique documents from the collected chunk IDs
     graph_docs = [all_chunks[chunk_id] for chunk_id in related_chunk_ids if chunk_id in all_chunks]
@@ -229,7 +238,14 @@ def get_graph_context(question: str, graph: nx.Graph, all_chunks: dict, llm) ->
 
 # New function to initialize resources for external use
 def initialize_resources(course_id):
-    """Initialize and return resources for a specific course."""
+    """Initialize and return resources for a specific course.
+
+    资源由进程级注册表缓存，同一课程的多次查询复用同一个Chroma和LLM客户端。
+    """
+    return get_course_resources(str(course_id), _create_course_resources)
+
+def _create_course_resources(course_id):
+    """创建课程的LLM、向量存储和检索器（由资源注册表调用）"""
     # --- Load API Keys ---
     api_key = os.getenv("LLM_API_KEY")
     base_url = os.getenv("LLM_API_BASE", "https://api.siliconflow.cn/v1")
@@ -251,7 +267,9 @@ def initialize_resources(course_id):
         base_url=base_url,
         model=model_name,
         temperature=0,
-        max_retries=6
+        max_retries=6,
+        # 复用 LLM 网关的连接池
+        http_client=get_llm_client(api_key, base_url).http_client
     )
 
     # --- Load Vectorstore ---
@@ -323,21 +341,40 @@ def initialize_resources(course_id):
     
     return {
         'llm': llm,
-        'vector_retriever': vector_retriever
+        'vectorstore': vectorstore,
+        'vector_retriever': vector_retriever,
+        'persist_dir': persist_dir
     }
 
+def hybrid_search(query: str, course_id: str, vectorstore, k: int = HYBRID_CANDIDATES) -> List[Document]:
+    """向量检索 + BM25 全文检索，按倒数排名融合后返回前 k 个候选"""
+    vector_docs = vectorstore.similarity_search(query, k=max(k, HYBRID_VECTOR_K))
+    print(f"--- Retrieved {len(vector_docs)} chunks from vector search ---")
+
+    lexical_docs = []
+    index = ensure_bm25_index(str(course_id), vectorstore)
+    if index is not None:
+        try:
+            lexical_docs = [doc for doc, _ in index.search(query, k=max(k, HYBRID_LEXICAL_K))]
+            print(f"--- Retrieved {len(lexical_docs)} chunks from BM25 search ---")
+        except Exception as e:
+            print(f"BM25 检索失败，只使用向量检索结果: {e}")
+
+    if not lexical_docs:
+        return vector_docs[:k]
+    return reciprocal_rank_fusion([vector_docs, lexical_docs], limit=k)
+
 # Expose hybrid_retriever for external use
 def hybrid_retriever(query: str, course_id: str):
-    """Retrieves relevant documents using vector search and reranking for a given query and course."""
+    """Retrieves relevant documents using vector + BM25 search, RRF fusion and reranking."""
     resources = initialize_resources(course_id)
     
     # 完全跳过知识图谱检索
     # graph_docs = get_graph_context(query, resources['graph'], resources['all_chunks_map'], resources['llm'])
     
-    # 只使用向量检索
-    print("--- Performing vector search ---")
-    vector_docs = resources['vector_retriever'].invoke(query)
-    print(f"--- Retrieved {len(vector_docs)} chunks from vector search ---")
+    # 向量检索与全文检索融合，只把融合后的少量候选送去重排序
+    print("--- Performing hybrid search ---")
+    vector_docs = hybrid_search(query, course_id, resources['vectorstore'])
 
     # 如果找到足够的文档，执行重排序
     if len(vector_docs) > 1:
@@ -345,7 +382,7 @@ def hybrid_retriever(query: str, course_id: str):
         # 提取文档内容
         documents = [doc.page_content for doc in vector_docs]
         # 执行重排序
-        rerank_results = rerank_documents(query, documents)
+        rerank_results = rerank_documents(query, documents, doc_ids=[document_key(doc) for doc in vector_docs])
         
         if rerank_results:
             # 根据重排序结果重新排列文档
@@ -390,110 +427,62 @@ def upload_file_to_api(file_path: str, api_key: str) -> Optional[str]:
         print(f"上传文件时出错: {e}")
         return None
 
-def rerank_documents(query: str, documents: List[str], max_results: int = 5) -> List[Dict[str, Any]]:
+def rerank_documents(query: str, documents: List[str], max_results: int = 5,
+                     doc_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
     """
-    使用重排序API对文档列表进行重排序
+    对文档列表进行重排序（带结果缓存；远程API变慢或不可用时使用本地重排序）
     
     Args:
         query: 查询文本
         documents: 要重排序的文档列表
         max_results: 返回的最大结果数
+        doc_ids: 与 documents 对应的文本块ID，用作缓存键；不提供时使用内容哈希
         
     Returns:
         重排序后的结果列表，每个结果包含索引和相关性分数
     """
     try:
-        # 获取API配置
-        api_key = os.getenv("LLM_API_KEY")
-        api_base = os.getenv("LLM_API_BASE", "https://api.siliconflow.cn/v1")
-        rerank_model = os.getenv("RERANK_MODEL", "BAAI/bge-reranker-v2-m3")
-        
-        if not api_key or not documents:
-            print("未找到API密钥或文档列表为空，跳过重排序")
-            return []
-            
-        print(f"--- 使用模型 {rerank_model} 进行重排序，共 {len(documents)} 个文档 ---")
-        
-        # 构建重排序请求
-        url = f"{api_base}/rerank"
-        payload = {
-            "query": query,
-            "documents": documents,
-            "return_documents": False,  # 我们只需要索引和分数
-            "model": rerank_model
-        }
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # 发送重排序请求
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
-        
-        if response.status_code == 200:
-            rerank_result = response.json()
-            print(f"--- 重排序成功 ---")
-            
-            # 返回排序结果（限制数量）
-            results = rerank_result.get('results', [])[:max_results]
-            return results
-        else:
-            print(f"重排序API请求失败: {response.status_code} - {response.text}")
+        if not documents:
             return []
-            
+        print(f"--- 重排序 {len(documents)} 个文档 ---")
+        return get_rerank_service().rerank(query, documents, max_results, doc_ids)
     except Exception as e:
-        print(f"重排序请求失败: {e}")
+        print(f"重排序失败: {e}")
         return []
 
-def query_knowledge_base(query: str, course_id: str, max_results: int = 5) -> List[Dict[str, Any]]:
+def query_knowledge_base(query: str, course_id: str, max_results: int = 5,
+                         candidate_count: Optional[int] = None) -> List[Dict[str, Any]]:
     """
     查询知识库，返回相关文档片段
     使用向量搜索检索候选文档，然后使用重排序API优化结果
+    
+    candidate_count 为送去重排序的候选数，默认 max(max_results * 3, 15)
     """
     try:
-        # 检查多个可能的知识库路径
-        project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-        possible_paths = [
-            os.path.join(project_root, "uploads", "knowledge_base", str(course_id)),
-            os.path.join(project_root, "backend", "uploads", "knowledge_base", str(course_id))
-        ]
-        
-        persist_dir = None
-        for path in possible_paths:
-            vectordb_path = os.path.join(path, "vectordb")
-            if os.path.exists(vectordb_path):
-                print(f"找到向量数据库路径: {vectordb_path}")
-                persist_dir = vectordb_path
-                break
-        
-        if not persist_dir:
-            print(f"向量数据库不存在，检查了以下路径: {possible_paths}")
+        # 从资源注册表获取已打开的向量存储
+        try:
+            vectorstore = initialize_resources(str(course_id))['vectorstore']
+        except FileNotFoundError as e:
+            print(f"向量数据库不存在: {e}")
             return []
         
-        # 创建向量存储
-        embedding_function = EmbeddingFunction()
-        # 使用类型忽略注释来解决类型检查问题
-        vectorstore = Chroma(  # type: ignore
-            persist_directory=persist_dir,
-            embedding_function=embedding_function
-        )
-        
-        # 执行向量搜索 - 检索更多候选文档用于重排序
-        print("--- 执行向量搜索 ---")
-        candidate_count = max(max_results * 3, 15)  # 检索更多候选文档以供重排序
-        docs = vectorstore.similarity_search(query, k=candidate_count)
+        # 向量检索与 BM25 全文检索融合 - 检索更多候选文档用于重排序
+        print("--- 执行混合检索 ---")
+        if candidate_count is None:
+            candidate_count = max(max_results * 3, 15)  # 检索更多候选文档以供重排序
+        docs = hybrid_search(query, str(course_id), vectorstore, k=candidate_count)
         
         if not docs:
-            print("--- 向量搜索未找到结果 ---")
+            print("--- 混合检索未找到结果 ---")
             return []
             
-        print(f"--- 向量搜索找到 {len(docs)} 个候选文档 ---")
+        print(f"--- 混合检索找到 {len(docs)} 个候选文档 ---")
         
         # 提取文档内容用于重排序
         documents = [doc.page_content for doc in docs]
         
-        # 使用重排序API
-        rerank_results = rerank_documents(query, documents, max_results)
+        # 重排序（结果缓存，远程API不可用时使用本地重排序）
+        rerank_results = rerank_documents(query, documents, max_results, doc_ids=[document_key(doc) for doc in docs])
         
         if rerank_results:
             # 处理重排序结果
@@ -522,7 +511,7 @@ def query_knowledge_base(query: str, course_id: str, max_results: int = 5) -> Li
                 results.append({
                     'content': doc.page_content,
                     'metadata': doc.metadata,
-                    'score': 1.0 - (i * 0.1)  # 简单的相似度分数
+                    'score': 1.0 / (i + 1)  # 按排名给出的简单分数，保持为正数
                 })
             return results
         
@@ -530,35 +519,38 @@ def query_knowledge_base(query: str, course_id: str, max_results: int = 5) -> Li
         print(f"查询知识库时出错: {e}")
         return []
 
-def build_rag_context(query: str, course_id: str, max_tokens: int = 8000) -> str:
+def build_rag_context(query: str, course_id: str, max_tokens: int = 8000,
+                      model: Optional[str] = None, reserved_tokens: int = 0) -> str:
     """
-    构建RAG上下文，简化版本
+    构建RAG上下文
+    
+    检索并重排序 RAG_CONTEXT_CANDIDATES 个候选，按目标模型的分词器计数，在预算内选择总相关性
+    最高的文本块组合，去掉重复块并合并同一文件的相邻块。
+    
+    Args:
+        max_tokens: 上下文的 token 上限
+        model: 目标模型，用于选择分词器，默认 LLM_MODEL
+        reserved_tokens: 提示词其他部分和回答需要预留的 token，保证总量不超过模型窗口
     """
     try:
-        # 查询知识库
-        relevant_docs = query_knowledge_base(query, course_id, max_results=10)
+        # 查询知识库：所有重排序后的候选都交给打包器挑选
+        relevant_docs = query_knowledge_base(
+            query, course_id,
+            max_results=RAG_CONTEXT_CANDIDATES,
+            candidate_count=RAG_CONTEXT_CANDIDATES
+        )
         
         if not relevant_docs:
             print("未找到相关文档")
             return ""
         
-        # 构建上下文
-        context_parts = []
-        current_tokens = 0
-        
-        for doc in relevant_docs:
-            content = doc['content']
-            # 简单估算token数量（中文字符约等于token数）
-            estimated_tokens = len(content)
-            
-            if current_tokens + estimated_tokens > max_tokens:
-                break
-                
-            context_parts.append(f"文档片段:\n{content}\n")
-            current_tokens += estimated_tokens
+        budget = context_budget(max_tokens, reserved_tokens)
+        packed = pack_context(relevant_docs, budget, model=model)
+        context_parts = [f"文档片段:\n{part['content']}\n" for part in packed]
         
         context = "\n".join(context_parts)
-        print(f"--- 构建了包含 {len(context_parts)} 个文档片段的上下文 ---")
+        print(f"--- 构建了包含 {len(context_parts)} 个文档片段的上下文 "
+              f"({sum(part['tokens'] for part in packed)}/{budget} tokens) ---")
         return context
         
     except Exception as e:
@@ -591,42 +583,18 @@ def get_llm_response(query: str, context: str = "", max_tokens: int = 4000) -> s
             # 暂时截断上下文
             prompt = prompt[:32000] + "\n\n[上下文已截断]"
         
-        # 发送请求
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": model,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": max_tokens,
-            "temperature": 0.7
-        }
-        
+        # 发送请求（共享连接池，统一限流和重试）
         print(f"--- 发送LLM请求，模型: {model} ---")
-        response = requests.post(
-            f"{api_base}/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=120  # 增加超时时间到120秒
+        return get_llm_client(api_key, api_base).chat(
+            [{"role": "user", "content": prompt}],
+            model=model,
+            max_tokens=max_tokens,
+            temperature=0.7
         )
-        
-        if response.status_code == 200:
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        else:
-            print(f"LLM请求失败: {response.status_code} - {response.text}")
-            return f"抱歉，处理请求时出现错误：{response.text}"
             
-    except requests.exceptions.Timeout:
+    except LLMTimeoutError:
         print("LLM请求超时")
         return "抱歉，请求超时，请稍后重试。"
-    except requests.exceptions.ConnectionError:
-        print("LLM连接错误")
-        return "抱歉，网络连接错误，请检查网络连接。"
     except Exception as e:
         print(f"获取LLM响应时出错: {e}")
         return f"抱歉，处理请求时出现错误：{str(e)}"
@@ -640,7 +608,8 @@ def rag_query(query: str, course_id: str) -> str:
         
         # 构建RAG上下文
         print("--- 使用向量检索构建上下文 ---")
-        context = build_rag_context(query, course_id, max_tokens=6000)
+        context = build_rag_context(query, course_id, max_tokens=6000,
+                                    reserved_tokens=4000 + count_tokens(query) + PROMPT_OVERHEAD_TOKENS)
         
         if not context:
             return "抱歉，未找到相关的文档信息。"
@@ -664,7 +633,8 @@ def rag_query_stream(query: str, course_id: str):
         
         # 构建RAG上下文
         print("--- 使用向量检索构建上下文 ---")
-        context = build_rag_context(query, course_id, max_tokens=6000)
+        context = build_rag_context(query, course_id, max_tokens=6000,
+                                    reserved_tokens=4000 + count_tokens(query) + PROMPT_OVERHEAD_TOKENS)
         
         if not context:
             yield "抱歉，未找到相关的文档信息。"
@@ -713,57 +683,19 @@ def get_llm_response_stream(query: str, context: str = "", max_tokens: int = 400
             # 暂时截断上下文
             prompt = prompt[:32000] + "\n\n[上下文已截断]"
         
-        # 发送流式请求
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        data = {
-            "model": model,
-            "messages": [
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": max_tokens,
-            "temperature": 0.7,
-            "stream": True
-        }
-        
+        # 发送流式请求（共享连接池，统一限流和重试）
         print(f"--- 发送LLM请求，模型: {model} ---")
-        response = requests.post(
-            f"{api_base}/chat/completions",
-            headers=headers,
-            json=data,
-            timeout=120,
-            stream=True
-        )
-        
-        if response.status_code == 200:
-            for line in response.iter_lines():
-                if line:
-                    line = line.decode('utf-8')
-                    if line.startswith('data: '):
-                        data_str = line[6:]
-                        if data_str == '[DONE]':
-                            break
-                        try:
-                            data_json = json.loads(data_str)
-                            if 'choices' in data_json and len(data_json['choices']) > 0:
-                                delta = data_json['choices'][0].get('delta', {})
-                                if 'content' in delta and delta['content'] is not None:
-                                    yield delta['content']
-                        except json.JSONDecodeError:
-                            continue
-        else:
-            print(f"LLM请求失败: {response.status_code} - {response.text}")
-            yield f"抱歉，处理请求时出现错误：{response.text}"
+        for content in get_llm_client(api_key, api_base).stream(
+            [{"role": "user", "content": prompt}],
+            model=model,
+            max_tokens=max_tokens,
+            temperature=0.7
+        ):
+            yield content
             
-    except requests.exceptions.Timeout:
+    except LLMTimeoutError:
         print("LLM请求超时")
         yield "抱歉，请求超时，请稍后重试。"
-    except requests.exceptions.ConnectionError:
-        print("LLM连接错误")
-        yield "抱歉，网络连接错误，请检查网络连接。"
     except Exception as e:
         print(f"获取LLM响应时出错: {e}")
         yield f"抱歉，处理请求时出现错误：{str(e)}"
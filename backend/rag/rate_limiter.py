@@ -0,0 +1,121 @@
+"""
+自适应令牌桶限流器
+
+按服务商（API 地址 + 模型）共享一个令牌桶，同步线程和 asyncio 协程都可以使用：
+- 令牌按当前速率补充，请求前预约令牌，不足时等待
+- 收到 429 时速率减半，并按 Retry-After 暂停发放令牌
+- 连续成功后逐步恢复到配置的最大速率
+"""
+
+import time
+import asyncio
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """解析 Retry-After 头（只支持秒数形式）"""
+    if value is None or value == "":
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def rate_limit_info(error: Exception) -> Tuple[Optional[int], Optional[float]]:
+    """从 openai / httpx / requests 的异常中取出 (HTTP 状态码, Retry-After 秒数)"""
+    response = getattr(error, "response", None)
+    status = getattr(error, "status_code", None) or getattr(response, "status_code", None)
+    headers = getattr(response, "headers", None)
+    retry_after = None
+    if headers is not None:
+        try:
+            retry_after = parse_retry_after(headers.get("retry-after") or headers.get("Retry-After"))
+        except Exception:
+            retry_after = None
+    return status, retry_after
+
+
+class TokenBucket:
+    """线程安全的令牌桶，rate <= 0 表示不限速（仍然遵循 Retry-After 暂停）"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, min_rate: Optional[float] = None):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate if min_rate is not None else (rate / 16 if rate > 0 else 0)
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.rate_limited = 0
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """预约令牌，返回调用方需要等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            blocked = max(0.0, self._blocked_until - now)
+            if self.rate <= 0:
+                return blocked
+            self._refill(now)
+            self._tokens -= tokens
+            return blocked + max(0.0, -self._tokens / self.rate)
+
+    def acquire(self, tokens: float = 1.0):
+        """阻塞直到获得令牌"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: float = 1.0):
+        """在协程中等待直到获得令牌"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def on_rate_limited(self, retry_after: Optional[float] = None):
+        """服务端返回 429：速率减半，并在 Retry-After 期间暂停发放令牌"""
+        with self._lock:
+            now = time.monotonic()
+            self.rate_limited += 1
+            if self.rate > 0:
+                self._refill(now)
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            logger.warning(f"触发服务端限流，速率降为 {self.rate:.2f}/秒"
+                           + (f"，暂停 {retry_after:.1f} 秒" if retry_after else ""))
+
+    def on_success(self):
+        """请求成功后逐步恢复速率"""
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {"rate": self.rate, "max_rate": self.max_rate, "rate_limited": self.rate_limited}
+
+
+_limiters: Dict[str, TokenBucket] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(key: str, rate: float, capacity: Optional[float] = None) -> TokenBucket:
+    """返回进程内按 key（如 API 地址 + 模型）共享的令牌桶"""
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = TokenBucket(rate, capacity)
+        return limiter
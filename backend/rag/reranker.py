@@ -0,0 +1,286 @@
+"""
+重排序服务
+
+rerank_documents 的实现，在远程重排序 API 之外增加：
+- 结果缓存：按 (查询哈希, 有序的候选文本块ID, 模型) 缓存，LRU + TTL，重复问题不再请求 API
+- 可插拔的重排序器：远程 API（RemoteReranker）和本地 CPU 实现（默认 LexicalReranker，
+  按查询词在候选中的 BM25 得分排序），可通过 register_reranker 注册其他本地实现
+- 延迟预算：远程请求超时即为预算；最近请求的 p95 延迟超过预算或请求失败时，
+  在冷却期内直接使用本地重排序，冷却期后再试探远程 API
+"""
+
+import os
+import math
+import time
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from backend.rag.http_session import get_http_session
+from backend.rag.zh_tokenizer import index_terms
+
+logger = logging.getLogger(__name__)
+
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "1024"))
+RERANK_CACHE_TTL = float(os.getenv("RERANK_CACHE_TTL", "600"))
+# 远程重排序的延迟预算（毫秒），同时作为请求超时
+RERANK_LATENCY_BUDGET_MS = float(os.getenv("RERANK_LATENCY_BUDGET_MS", "1500"))
+# 远程 API 变慢或失败后，改用本地重排序的时长（秒）
+RERANK_COOLDOWN = float(os.getenv("RERANK_COOLDOWN", "60"))
+# 本地重排序器的名称
+RERANK_LOCAL = os.getenv("RERANK_LOCAL", "lexical")
+# 计算 p95 使用的最近请求数
+_LATENCY_WINDOW = 50
+# 样本数不足时不根据 p95 判断
+_MIN_LATENCY_SAMPLES = 5
+
+RerankResult = List[Dict[str, Any]]
+
+
+class Reranker(ABC):
+    """重排序器接口：返回 [{'index': 候选序号, 'relevance_score': 分数}]，按分数从高到低"""
+
+    name = "base"
+
+    @abstractmethod
+    def rerank(self, query: str, documents: Sequence[str], max_results: int) -> RerankResult:
+        """对候选文档重排序，最多返回 max_results 条"""
+        pass
+
+
+class RemoteReranker(Reranker):
+    """调用 OpenAI 兼容服务的 /rerank 接口"""
+
+    def __init__(self, api_base: str, api_key: str, model: str, timeout: float):
+        self.api_base = api_base
+        self.api_key = api_key
+        self.model = model
+        self.name = model
+        self.timeout = timeout
+
+    def rerank(self, query: str, documents: Sequence[str], max_results: int) -> RerankResult:
+        response = get_http_session().post(
+            f"{self.api_base}/rerank",
+            json={
+                "query": query,
+                "documents": list(documents),
+                "return_documents": False,  # 我们只需要索引和分数
+                "model": self.model
+            },
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+            timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json().get('results', [])[:max_results]
+
+
+class LexicalReranker(Reranker):
+    """本地重排序：在候选集合内按查询词计算 BM25，分数相同时保持原有顺序"""
+
+    name = "lexical"
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+    def rerank(self, query: str, documents: Sequence[str], max_results: int) -> RerankResult:
+        query_terms = set(index_terms(query))
+        doc_terms = [Counter(index_terms(doc)) for doc in documents]
+        n = len(documents)
+        avg_length = sum(sum(terms.values()) for terms in doc_terms) / max(n, 1) or 1.0
+        df = Counter(term for terms in doc_terms for term in query_terms if term in terms)
+
+        scores = []
+        for i, terms in enumerate(doc_terms):
+            length = sum(terms.values())
+            score = 0.0
+            for term in query_terms:
+                tf = terms.get(term, 0)
+                if tf:
+                    idf = math.log(1 + (n - df[term] + 0.5) / (df[term] + 0.5))
+                    score += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+            scores.append(score)
+
+        top = max(scores, default=0.0) or 1.0
+        # 原有顺序（向量/融合检索的排名）作为很小的先验，用于打破平局
+        results = [
+            {"index": i, "relevance_score": scores[i] / top + 0.01 / (i + 1)}
+            for i in range(n)
+        ]
+        results.sort(key=lambda item: -item["relevance_score"])
+        return results[:max_results]
+
+
+_local_factories: Dict[str, Callable[[], Reranker]] = {"lexical": LexicalReranker}
+
+
+def register_reranker(name: str, factory: Callable[[], Reranker]):
+    """注册本地重排序器（如基于 ONNX 的 cross-encoder），通过 RERANK_LOCAL 选用"""
+    _local_factories[name] = factory
+
+
+class RerankService:
+    """带缓存和延迟预算的重排序服务"""
+
+    def __init__(self, cache_size: int = RERANK_CACHE_SIZE, cache_ttl: float = RERANK_CACHE_TTL,
+                 budget_ms: float = RERANK_LATENCY_BUDGET_MS, cooldown: float = RERANK_COOLDOWN):
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.budget = budget_ms / 1000.0
+        self.cooldown = cooldown
+        self._cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._latencies = deque(maxlen=_LATENCY_WINDOW)
+        self._remote_disabled_until = 0.0
+        self._local: Optional[Reranker] = None
+        self._lock = threading.Lock()
+        self._counters = Counter()
+
+    def _remote(self) -> Optional[RemoteReranker]:
+        api_key = os.getenv("LLM_API_KEY")
+        if not api_key:
+            return None
+        return RemoteReranker(
+            api_base=os.getenv("LLM_API_BASE", "https://api.siliconflow.cn/v1"),
+            api_key=api_key,
+            model=os.getenv("RERANK_MODEL", "BAAI/bge-reranker-v2-m3"),
+            timeout=self.budget
+        )
+
+    def local(self) -> Reranker:
+        if self._local is None:
+            factory = _local_factories.get(RERANK_LOCAL)
+            if factory is None:
+                logger.warning(f"未知的本地重排序器 {RERANK_LOCAL}，使用 lexical")
+                factory = LexicalReranker
+            self._local = factory()
+        return self._local
+
+    @staticmethod
+    def cache_key(query: str, documents: Sequence[str], doc_ids: Optional[Sequence[str]],
+                  model: str, max_results: int) -> tuple:
+        """缓存键：查询哈希 + 有序的候选ID（没有ID时用内容哈希）+ 模型"""
+        query_hash = hashlib.sha256(query.encode("utf-8")).hexdigest()
+        if doc_ids is None or len(doc_ids) != len(documents) or not all(doc_ids):
+            doc_ids = [hashlib.sha256(doc.encode("utf-8")).hexdigest()[:16] for doc in documents]
+        return query_hash, tuple(doc_ids), model, max_results
+
+    def _cache_get(self, key: tuple) -> Optional[RerankResult]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            stored_at, results = entry
+            if time.monotonic() - stored_at > self.cache_ttl:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return [dict(item) for item in results]
+
+    def _cache_put(self, key: tuple, results: RerankResult):
+        with self._lock:
+            self._cache[key] = (time.monotonic(), [dict(item) for item in results])
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def p95_latency(self) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < _MIN_LATENCY_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def _remote_allowed(self) -> bool:
+        with self._lock:
+            if time.monotonic() < self._remote_disabled_until:
+                return False
+        p95 = self.p95_latency()
+        if p95 is not None and p95 > self.budget:
+            # 远程变慢：进入冷却期，清空样本以便冷却后重新试探
+            self._disable_remote(f"p95 延迟 {p95 * 1000:.0f}ms 超过预算")
+            return False
+        return True
+
+    def _disable_remote(self, reason: str):
+        with self._lock:
+            self._remote_disabled_until = time.monotonic() + self.cooldown
+            self._latencies.clear()
+        logger.warning(f"远程重排序暂停 {self.cooldown:.0f} 秒（{reason}），改用本地重排序")
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    def rerank(self, query: str, documents: Sequence[str], max_results: int = 5,
+               doc_ids: Optional[Sequence[str]] = None) -> RerankResult:
+        if not documents:
+            return []
+
+        remote = self._remote()
+        if remote is not None and self._remote_allowed():
+            key = self.cache_key(query, documents, doc_ids, remote.name, max_results)
+            cached = self._cache_get(key)
+            if cached is not None:
+                self._count("hits")
+                return cached
+            started = time.monotonic()
+            try:
+                results = remote.rerank(query, documents, max_results)
+                with self._lock:
+                    self._latencies.append(time.monotonic() - started)
+                self._count("misses")
+                self._count("remote_calls")
+                self._cache_put(key, results)
+                return results
+            except Exception as e:
+                self._count("remote_failures")
+                self._disable_remote(f"请求失败: {e}")
+
+        local = self.local()
+        key = self.cache_key(query, documents, doc_ids, local.name, max_results)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self._count("hits")
+            return cached
+        self._count("misses")
+        self._count("local_calls")
+        results = local.rerank(query, documents, max_results)
+        self._cache_put(key, results)
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存命中率、远程/本地调用次数和远程 p95 延迟"""
+        p95 = self.p95_latency()
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": self._counters["hits"] / lookups if lookups else 0.0,
+                "cache_entries": len(self._cache),
+                "remote_p95_ms": p95 * 1000 if p95 is not None else None,
+                "remote_paused": time.monotonic() < self._remote_disabled_until,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+_service: Optional[RerankService] = None
+_service_lock = threading.Lock()
+
+
+def get_rerank_service() -> RerankService:
+    """返回进程级共享的重排序服务"""
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = RerankService()
+    return _service
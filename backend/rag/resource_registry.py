@@ -0,0 +1,184 @@
+"""
+课程资源注册表
+
+在进程内按课程缓存已打开的向量存储、检索器和LLM客户端，避免每次对话都重新创建
+Chroma 和 ChatOpenAI 客户端。
+
+- 按 LRU 淘汰超出容量的课程，按空闲 TTL 淘汰长时间未使用的课程
+- 文档入库或删除后通过 invalidate_course_resources(course_id) 使该课程失效
+- 其他进程（如 process_queue.py）写入知识库时，通过 processed_files.json 的
+  修改时间检测变化并重建资源
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 最多同时缓存的课程数量
+REGISTRY_MAX_COURSES = int(os.getenv("RAG_REGISTRY_MAX_COURSES", "32"))
+# 课程资源空闲多久后被淘汰（秒）
+REGISTRY_IDLE_TTL = float(os.getenv("RAG_REGISTRY_IDLE_TTL", "1800"))
+
+
+def _course_signature(persist_dir: Optional[str]) -> Optional[int]:
+    """返回课程知识库的变更签名（processed_files.json 的修改时间）"""
+    if not persist_dir:
+        return None
+    kb_dir = persist_dir
+    if os.path.basename(os.path.normpath(persist_dir)) == "vectordb":
+        kb_dir = os.path.dirname(os.path.normpath(persist_dir))
+    try:
+        return os.stat(os.path.join(kb_dir, "processed_files.json")).st_mtime_ns
+    except OSError:
+        return None
+
+
+class _RegistryEntry:
+    """注册表中的单个课程条目"""
+
+    __slots__ = ("resources", "signature", "created_at", "last_used")
+
+    def __init__(self, resources: Dict[str, Any], signature: Optional[int]):
+        now = time.monotonic()
+        self.resources = resources
+        self.signature = signature
+        self.created_at = now
+        self.last_used = now
+
+
+class CourseResourceRegistry:
+    """线程安全的课程资源缓存，按 LRU 和空闲 TTL 淘汰"""
+
+    def __init__(self, max_courses: int = REGISTRY_MAX_COURSES, idle_ttl: float = REGISTRY_IDLE_TTL):
+        self.max_courses = max(1, max_courses)
+        self.idle_ttl = idle_ttl
+        self._entries: "OrderedDict[str, _RegistryEntry]" = OrderedDict()
+        self._build_locks: Dict[str, threading.Lock] = {}
+        self._generations: Dict[str, int] = {}
+        self._listeners: List[Callable[[str], None]] = []
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, course_id: str, factory: Callable[[str], Dict[str, Any]]) -> Dict[str, Any]:
+        """获取课程资源，不存在或已失效时调用 factory(course_id) 创建"""
+        key = str(course_id)
+
+        with self._lock:
+            self._evict_expired()
+            resources = self._lookup(key)
+            if resources is not None:
+                return resources
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        # 同一课程只构建一次，不同课程之间互不阻塞
+        with build_lock:
+            with self._lock:
+                resources = self._lookup(key)
+                if resources is not None:
+                    return resources
+                generation = self._generations.get(key, 0)
+                self._misses += 1
+
+            resources = factory(key)
+            signature = _course_signature(resources.get("persist_dir"))
+
+            with self._lock:
+                # 构建期间课程被失效，则不缓存这次的结果
+                if self._generations.get(key, 0) == generation:
+                    self._entries[key] = _RegistryEntry(resources, signature)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_courses:
+                        evicted_key, _ = self._entries.popitem(last=False)
+                        self._evictions += 1
+                        logger.info(f"课程资源按LRU淘汰: {evicted_key}")
+            return resources
+
+    def _lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """在持有锁的情况下查找有效条目"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.signature != _course_signature(entry.resources.get("persist_dir")):
+            # 知识库在其他进程中被修改
+            del self._entries[key]
+            logger.info(f"课程 {key} 的知识库已变化，重建资源")
+            return None
+        entry.last_used = time.monotonic()
+        self._entries.move_to_end(key)
+        self._hits += 1
+        return entry.resources
+
+    def _evict_expired(self):
+        """在持有锁的情况下淘汰空闲超时的条目"""
+        if self.idle_ttl <= 0:
+            return
+        deadline = time.monotonic() - self.idle_ttl
+        expired = [key for key, entry in self._entries.items() if entry.last_used < deadline]
+        for key in expired:
+            del self._entries[key]
+            self._evictions += 1
+            logger.info(f"课程资源空闲超时淘汰: {key}")
+
+    def invalidate(self, course_id: str):
+        """使指定课程的缓存资源失效，并通知监听者"""
+        key = str(course_id)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+            listeners = list(self._listeners)
+        for listener in listeners:
+            try:
+                listener(key)
+            except Exception as e:
+                logger.error(f"课程失效回调执行失败: {e}")
+
+    def add_invalidation_listener(self, listener: Callable[[str], None]):
+        """注册课程失效回调，用于清理依赖知识库内容的其他缓存"""
+        with self._lock:
+            if listener not in self._listeners:
+                self._listeners.append(listener)
+
+    def generation(self, course_id: str) -> int:
+        """返回课程在本进程内被失效的次数"""
+        with self._lock:
+            return self._generations.get(str(course_id), 0)
+
+    def clear(self):
+        """清空所有缓存的课程资源"""
+        with self._lock:
+            for key in self._entries:
+                self._generations[key] = self._generations.get(key, 0) + 1
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """返回缓存统计信息"""
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "courses": len(self._entries),
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "hit_rate": self._hits / total if total else 0.0,
+            }
+
+
+# 进程级全局注册表
+course_registry = CourseResourceRegistry()
+
+
+def get_course_resources(course_id: str, factory: Callable[[str], Dict[str, Any]]) -> Dict[str, Any]:
+    """从全局注册表获取课程资源"""
+    return course_registry.get(course_id, factory)
+
+
+def invalidate_course_resources(course_id: str):
+    """课程知识库发生变化后调用，使全局注册表中的课程资源失效"""
+    course_registry.invalidate(course_id)
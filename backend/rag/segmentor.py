@@ -1,7 +1,19 @@
+import os
+import bisect
+import logging
+import multiprocessing
+from concurrent.futures import Executor
+from functools import lru_cache
+
 import regex
 # Import Optional to fix the type hint error
 from typing import List, Dict, Any, Tuple, Optional
 
+# 长文档分片并行分割：启用并行的最小文本长度、每个分片的目标长度。
+# 分割器不自己创建进程池，由调用方传入入库工作池的进程池（executor 参数）
+SEGMENT_PARALLEL_MIN_CHARS = int(os.getenv("SEGMENT_PARALLEL_MIN_CHARS", "200000"))
+SEGMENT_SHARD_CHARS = int(os.getenv("SEGMENT_SHARD_CHARS", "100000"))
+
 # 默认配置
 DEFAULT_CONFIG = {
   "maxHeadingLength": 7,
@@ -76,43 +88,97 @@ def create_chunk_regex(config: Dict[str, Any]) -> Any:
     # 创建最终的正则表达式
     return regex.compile(f"({regex_str})", regex.MULTILINE | regex.UNICODE)
 
+@lru_cache(maxsize=16)
+def _cached_chunk_regex(config_items: Tuple[Tuple[str, Any], ...]) -> Any:
+    """按配置缓存编译好的正则（每个进程各自一份）"""
+    return create_chunk_regex(dict(config_items))
+
+def _match_length_bound(config: Dict[str, Any]) -> int:
+    """单次匹配尝试最多检查的字符数，分片需要携带这么长的后续上下文"""
+    return max(
+        config["maxHeadingContentLength"],
+        config["maxListItemLength"],
+        config["maxCodeBlockLength"],
+        config["maxTableCellLength"],
+        config["maxParagraphLength"],
+        config["maxSentenceLength"],
+    ) + 32
+
+def _scan_shard(shard: str, pos: int, limit: int, config_items: Tuple[Tuple[str, Any], ...]) -> List[Tuple[int, int]]:
+    """在子进程中扫描一个分片，返回起始位置小于 limit 的匹配区间（相对分片）"""
+    chunk_regex = _cached_chunk_regex(config_items)
+    spans = []
+    for match in chunk_regex.finditer(shard, pos):
+        if match.start() >= limit:
+            break
+        spans.append(match.span())
+    return spans
+
+def _usable_executor(executor: Optional[Executor]) -> Optional[Executor]:
+    """已经处于子进程中时不再向进程池嵌套提交"""
+    if executor is None or multiprocessing.parent_process() is not None:
+        return None
+    return executor
+
+def _shard_boundaries(text: str) -> List[int]:
+    """在段落边界（空行）处把文本切成约 SEGMENT_SHARD_CHARS 长的分片"""
+    boundaries = [0]
+    target = SEGMENT_SHARD_CHARS
+    while target < len(text):
+        boundary = text.find("\n\n", target)
+        if boundary < 0:
+            break
+        boundaries.append(boundary)
+        target = boundary + SEGMENT_SHARD_CHARS
+    boundaries.append(len(text))
+    return boundaries
+
+def _parallel_match_spans(text: str, segmenter: "Segmenter", pool: Executor) -> Optional[List[Tuple[int, int]]]:
+    """分片并行扫描，再拼接成与单进程 finditer 完全相同的匹配序列
+
+    每个分片多带一个字符的前文（保证 ^ 的判断一致）和足够长的后文（保证前瞻和跨分片的匹配一致）。
+    前一分片的最后一个匹配越过边界时，从它的结束位置顺序扫描，直到与后一分片的匹配重新对齐。
+    """
+    boundaries = _shard_boundaries(text)
+    if len(boundaries) < 3:
+        return None
+    
+    config_items = segmenter.config_items
+    bound = segmenter.match_bound
+    futures = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        offset = start - 1 if start > 0 else 0
+        shard = text[offset:min(len(text), end + bound)]
+        futures.append((offset, pool.submit(_scan_shard, shard, start - offset, end - offset, config_items)))
+    shard_spans = [[(s + offset, e + offset) for s, e in future.result()] for offset, future in futures]
+    
+    chunk_regex = segmenter.pattern
+    spans = list(shard_spans[0])
+    for k in range(1, len(shard_spans)):
+        worker_spans = shard_spans[k]
+        starts = [s for s, _ in worker_spans]
+        shard_end = boundaries[k + 1]
+        resume = spans[-1][1] if spans else 0
+        while True:
+            i = bisect.bisect_left(starts, resume)
+            if i == 0 or worker_spans[i - 1][1] <= resume:
+                # 已对齐：顺序扫描从 resume 开始找到的正是该分片的第 i 个匹配
+                spans.extend(worker_spans[i:])
+                break
+            # 该分片的第 i-1 个匹配跨过了 resume，需要顺序扫描一次
+            match = chunk_regex.search(text, resume)
+            if match is None or match.start() >= shard_end:
+                break
+            spans.append(match.span())
+            resume = match.end()
+    return spans
+
 def split_text_into_chunks(text: str, config: Optional[Dict[str, Any]] = None) -> List[str]:
     """
     将文本分割成语义块。
     使用复杂的正则表达式进行精确分割，失败时回退到简单分割
     """
-    try:
-        import logging
-        final_config = {**DEFAULT_CONFIG, **(config or {})}
-        
-        # 使用正则表达式分割文本
-        chunk_regex = create_chunk_regex(final_config)
-        matches = chunk_regex.findall(text)
-        
-        # 修复：findall可能返回元组，需要正确处理
-        chunks = []
-        for match in matches:
-            # 如果匹配结果是元组，取第一个元素
-            if isinstance(match, tuple):
-                chunk = match[0]
-            else:
-                chunk = match
-                
-            if chunk and chunk.strip():
-                chunks.append(chunk)
-        
-        if chunks:
-            logging.info(f"使用正则表达式成功分割文本为 {len(chunks)} 个块")
-            return chunks
-        else:
-            # 如果没有匹配到任何内容，回退到简单分割
-            logging.info("正则表达式没有匹配到内容，回退到简单分割")
-            return _simple_split_fallback(text, final_config["maxParagraphLength"])
-    except Exception as e:
-        import logging
-        logging.error(f"复杂正则表达式分割失败: {e}")
-        # 出错时回退到简单分割
-        return _simple_split_fallback(text, DEFAULT_CONFIG["maxParagraphLength"])
+    return _get_segmenter_for_config(tuple(sorted((config or {}).items()))).split(text)
 
 def _simple_split_fallback(text: str, max_length: int = 300) -> List[str]:
     """简单的分割方法，作为回退"""
@@ -154,11 +220,9 @@ def _simple_split_fallback(text: str, max_length: int = 300) -> List[str]:
     logging.info(f"简单分割方法产生了 {len(chunks)} 个块")
     return [chunk for chunk in chunks if chunk.strip()]
 
-def split_text_with_max_length(text: str, max_length: int) -> List[str]:
-    """
-    一个简化的文本分割函数，主要通过最大长度来配置分块行为。
-    """
-    config = {
+def _max_length_config(max_length: int) -> Dict[str, Any]:
+    """主要通过最大长度来配置分块行为"""
+    return {
         "maxSentenceLength": max_length,
         "maxParagraphLength": max_length,
         "maxStandaloneLineLength": max_length,
@@ -169,7 +233,12 @@ def split_text_with_max_length(text: str, max_length: int) -> List[str]:
         "maxQuotedTextLength": min(max_length, 300),
         "maxParentheticalContentLength": min(max_length, 200)
     }
-    return split_text_into_chunks(text, config)
+
+def split_text_with_max_length(text: str, max_length: int) -> List[str]:
+    """
+    一个简化的文本分割函数，主要通过最大长度来配置分块行为。
+    """
+    return get_segmenter(max_length).split(text)
 
 def min_concat_segments_optimized(strings: List[str], max_length: int) -> List[str]:
     """
@@ -244,21 +313,8 @@ def merge_chunks_by_length(chunks: List[str], max_length: int) -> List[str]:
         return merge_chunks_by_length_greedy(chunks, max_length)
 
 
-def segment_text(text: str, max_length: int = 300) -> List[str]:
-    """
-    主要的文本分割和合并函数。
-    首先使用复杂正则表达式分割，如果失败则回退到简单分割
-    """
-    try:
-        # 使用复杂正则表达式分割
-        split_result = split_text_with_max_length(text, max_length)
-        if split_result:
-            return merge_chunks_by_length(split_result, max_length)
-    except Exception as e:
-        import logging
-        logging.error(f"使用复杂分割器时出错: {e}")
-    
-    # 如果复杂分割失败，回退到简单分割
+def _paragraph_split_fallback(text: str, max_length: int) -> List[str]:
+    """复杂分割失败时按段落、句子、字符逐级分割"""
     chunks = []
     
     # 按段落分割
@@ -313,6 +369,142 @@ def segment_text(text: str, max_length: int = 300) -> List[str]:
     return [chunk for chunk in chunks if chunk.strip()]
 
 
+def segment_text(text: str, max_length: int = 300, executor: Optional[Executor] = None) -> List[str]:
+    """
+    主要的文本分割和合并函数。
+    首先使用复杂正则表达式分割，如果失败则回退到简单分割
+    """
+    return get_segmenter(max_length).segment(text, executor)
+
+
+def segment_many(texts: List[str], max_length: int = 300, executor: Optional[Executor] = None) -> List[List[str]]:
+    """批量分割多段文本，结果与逐个调用 segment_text 相同"""
+    return get_segmenter(max_length).segment_many(texts, executor)
+
+
+class Segmenter:
+    """
+    按配置预编译分块正则的分割器。
+    通过 get_segmenter(max_length) 获取按配置缓存的共享实例，避免重复构建配置和编译正则。
+    """
+
+    def __init__(self, config: Dict[str, Any], max_length: int):
+        self.config = {**DEFAULT_CONFIG, **config}
+        self.config_items = tuple(sorted(self.config.items()))
+        self.max_length = max_length
+        self.pattern = _cached_chunk_regex(self.config_items)
+        self.match_bound = _match_length_bound(self.config)
+
+    def _match_spans(self, text: str, executor: Optional[Executor] = None) -> List[Tuple[int, int]]:
+        """返回分块正则在整个文本上的全部匹配区间，给出进程池时长文本分片并行扫描"""
+        if len(text) >= SEGMENT_PARALLEL_MIN_CHARS:
+            try:
+                pool = _usable_executor(executor)
+                if pool is not None:
+                    spans = _parallel_match_spans(text, self, pool)
+                    if spans is not None:
+                        return spans
+            except Exception as e:
+                logging.warning(f"并行分割失败，改为单进程分割: {e}")
+        return [match.span() for match in self.pattern.finditer(text)]
+
+    def split(self, text: str, executor: Optional[Executor] = None) -> List[str]:
+        """用正则把文本分割成语义块，失败时回退到简单分割"""
+        try:
+            # 整个正则只有一个捕获组，匹配文本即捕获内容
+            chunks = []
+            for start, end in self._match_spans(text, executor):
+                chunk = text[start:end]
+                if chunk and chunk.strip():
+                    chunks.append(chunk)
+            
+            if chunks:
+                logging.info(f"使用正则表达式成功分割文本为 {len(chunks)} 个块")
+                return chunks
+            else:
+                # 如果没有匹配到任何内容，回退到简单分割
+                logging.info("正则表达式没有匹配到内容，回退到简单分割")
+                return _simple_split_fallback(text, self.config["maxParagraphLength"])
+        except Exception as e:
+            logging.error(f"复杂正则表达式分割失败: {e}")
+            # 出错时回退到简单分割
+            return _simple_split_fallback(text, DEFAULT_CONFIG["maxParagraphLength"])
+
+    def segment(self, text: str, executor: Optional[Executor] = None) -> List[str]:
+        """分割后按最大长度合并"""
+        try:
+            split_result = self.split(text, executor)
+            if split_result:
+                return merge_chunks_by_length(split_result, self.max_length)
+        except Exception as e:
+            logging.error(f"使用复杂分割器时出错: {e}")
+        return _paragraph_split_fallback(text, self.max_length)
+
+    def segment_many(self, texts: List[str], executor: Optional[Executor] = None) -> List[List[str]]:
+        """批量分割。给出进程池且总量较大时，把短文本打包交给进程池，长文本仍按分片并行"""
+        pool = None
+        if len(texts) > 1 and sum(len(text) for text in texts) >= SEGMENT_PARALLEL_MIN_CHARS:
+            pool = _usable_executor(executor)
+        if pool is None:
+            return [self.segment(text, executor) for text in texts]
+        
+        results: List[Optional[List[str]]] = [None] * len(texts)
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        batch_chars = 0
+        for i, text in enumerate(texts):
+            if len(text) >= SEGMENT_PARALLEL_MIN_CHARS:
+                continue
+            batch.append(i)
+            batch_chars += len(text)
+            if batch_chars >= SEGMENT_SHARD_CHARS:
+                batches.append(batch)
+                batch, batch_chars = [], 0
+        if batch:
+            batches.append(batch)
+        
+        try:
+            futures = [
+                (indices, pool.submit(_segment_batch, self.max_length, [texts[i] for i in indices]))
+                for indices in batches
+            ]
+        except Exception as e:
+            # 共享的进程池已损坏或关闭
+            logging.warning(f"批量分割失败，改为单进程分割: {e}")
+            return [self.segment(text) for text in texts]
+        # 长文本在当前进程中协调分片并行
+        for i, text in enumerate(texts):
+            if len(text) >= SEGMENT_PARALLEL_MIN_CHARS:
+                results[i] = self.segment(text, pool)
+        for indices, future in futures:
+            try:
+                segmented = future.result()
+            except Exception as e:
+                logging.warning(f"批量分割失败，改为单进程分割: {e}")
+                segmented = [self.segment(texts[i]) for i in indices]
+            for i, segments in zip(indices, segmented):
+                results[i] = segments
+        return results
+
+
+@lru_cache(maxsize=32)
+def get_segmenter(max_length: int = 300) -> Segmenter:
+    """按最大长度获取共享的分割器实例"""
+    return Segmenter(_max_length_config(max_length), max_length)
+
+
+@lru_cache(maxsize=32)
+def _get_segmenter_for_config(config_items: Tuple[Tuple[str, Any], ...]) -> Segmenter:
+    config = {**DEFAULT_CONFIG, **dict(config_items)}
+    return Segmenter(config, config["maxParagraphLength"])
+
+
+def _segment_batch(max_length: int, texts: List[str]) -> List[List[str]]:
+    """在子进程中分割一批短文本"""
+    segmenter = get_segmenter(max_length)
+    return [segmenter.segment(text) for text in texts]
+
+
 # --- 示例用法 ---
 # FIX: Ensured the multi-line string is properly terminated with """
 # if __name__ == '__main__':
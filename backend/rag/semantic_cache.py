@@ -0,0 +1,305 @@
+"""
+语义答案缓存
+
+同一门课程中大量学生会提出几乎相同的问题。回答按 (课程, 资料版本, 规范化问题的向量) 缓存在
+课程目录下的 answer_cache.db 中，新问题与已缓存问题的余弦相似度超过阈值时直接返回保存的
+回答和参考来源，不再检索、重排序和调用 LLM。
+
+- 资料版本由 processed_files.json 和图谱文件的签名计算，资料变化后旧回答自动失效；
+  本进程内通过 resource_registry 的失效回调直接清空该课程的缓存
+- 只缓存没有对话历史的单轮问题，多轮对话的回答依赖上下文
+- 按模型区分，更换模型后不会返回其他模型的回答
+- stats() 返回命中/未命中/跳过次数和命中率
+"""
+
+import os
+import json
+import time
+import array
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from backend.rag.course_lock import KNOWLEDGE_BASE_ROOT
+from backend.rag.embedding_cache import normalize_text
+from backend.rag.graph_store import course_graph_signature
+from backend.rag.resource_registry import course_registry
+from backend.rag.sqlite_store import ThreadLocalConnection
+
+logger = logging.getLogger(__name__)
+
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() != "false"
+# 命中所需的最低余弦相似度
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+# 每门课程最多缓存的回答数，超出时淘汰最久未命中的
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "2000"))
+# 缓存回答的有效期（秒）
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", str(7 * 24 * 3600)))
+ANSWER_CACHE_FILENAME = "answer_cache.db"
+
+
+def material_version(course_id: str) -> str:
+    """课程资料版本：processed_files.json 与图谱文件签名的哈希"""
+    kb_dir = os.path.join(KNOWLEDGE_BASE_ROOT, str(course_id))
+    try:
+        processed = os.stat(os.path.join(kb_dir, "processed_files.json")).st_mtime_ns
+    except OSError:
+        processed = None
+    signature = f"{processed}:{course_graph_signature(course_id)}"
+    return hashlib.sha256(signature.encode("utf-8")).hexdigest()[:16]
+
+
+def _normalize_question(question: str) -> str:
+    return normalize_text(question).lower()
+
+
+class AnswerCache:
+    """单门课程的语义答案缓存，线程安全，可被多个进程共享"""
+
+    def __init__(self, path: str, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, ttl: float = SEMANTIC_CACHE_TTL):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._conn = ThreadLocalConnection(path)
+        self._lock = threading.Lock()
+        # (版本, 模型) -> (数据变更计数, 条目ID列表, 单位化后的向量矩阵)
+        self._matrices: Dict[Tuple[str, str], Tuple[int, List[int], np.ndarray]] = {}
+
+        conn = self._conn()
+        conn.executescript('''
+        CREATE TABLE IF NOT EXISTS answers (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            version TEXT NOT NULL,
+            model TEXT NOT NULL,
+            question_hash TEXT NOT NULL,
+            question TEXT NOT NULL,
+            embedding BLOB NOT NULL,
+            answer TEXT NOT NULL,
+            sources TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            last_hit INTEGER NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_answers_lookup ON answers (version, model, question_hash);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        ''')
+        conn.commit()
+
+    def _bump(self, conn: sqlite3.Connection):
+        """条目增删时递增变更计数，其他进程据此重新加载向量矩阵"""
+        conn.execute(
+            "INSERT INTO meta VALUES ('changes', 1) ON CONFLICT(key) DO UPDATE SET value = value + 1"
+        )
+
+    def _changes(self, conn: sqlite3.Connection) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def _matrix(self, conn: sqlite3.Connection, version: str, model: str) -> Tuple[List[int], np.ndarray]:
+        changes = self._changes(conn)
+        key = (version, model)
+        with self._lock:
+            cached = self._matrices.get(key)
+        if cached is not None and cached[0] == changes:
+            return cached[1], cached[2]
+
+        deadline = int(time.time() - self.ttl)
+        rows = conn.execute(
+            "SELECT id, embedding FROM answers WHERE version = ? AND model = ? AND created_at >= ?",
+            (version, model, deadline)
+        ).fetchall()
+        ids = [row[0] for row in rows]
+        if rows:
+            matrix = np.stack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        with self._lock:
+            # 只保留当前版本的矩阵
+            self._matrices = {k: v for k, v in self._matrices.items() if k[0] == version}
+            self._matrices[key] = (changes, ids, matrix)
+        return ids, matrix
+
+    def lookup(self, question: str, embedding: Optional[List[float]], version: str,
+               model: str) -> Optional[Dict[str, Any]]:
+        """查找相似问题的回答，返回 {'answer', 'sources', 'question', 'similarity'}，未命中返回 None"""
+        conn = self._conn()
+        question_hash = hashlib.sha256(_normalize_question(question).encode("utf-8")).hexdigest()
+        deadline = int(time.time() - self.ttl)
+        row = conn.execute(
+            "SELECT id, question, answer, sources FROM answers "
+            "WHERE version = ? AND model = ? AND question_hash = ? AND created_at >= ? "
+            "ORDER BY id DESC LIMIT 1",
+            (version, model, question_hash, deadline)
+        ).fetchone()
+        similarity = 1.0
+
+        if row is None and embedding is not None:
+            ids, matrix = self._matrix(conn, version, model)
+            vector = _unit(embedding)
+            if not ids or matrix.shape[1] != vector.shape[0]:
+                return None
+            scores = matrix @ vector
+            best = int(np.argmax(scores))
+            similarity = float(scores[best])
+            if similarity < self.threshold:
+                return None
+            row = conn.execute(
+                "SELECT id, question, answer, sources FROM answers WHERE id = ?", (ids[best],)
+            ).fetchone()
+
+        if row is None:
+            return None
+        entry_id, cached_question, answer, sources = row
+        with conn:
+            conn.execute("UPDATE answers SET hits = hits + 1, last_hit = ? WHERE id = ?",
+                         (int(time.time()), entry_id))
+        return {
+            "answer": answer,
+            "sources": json.loads(sources),
+            "question": cached_question,
+            "similarity": similarity,
+        }
+
+    def store(self, question: str, embedding: List[float], version: str, model: str,
+              answer: str, sources: List[Dict[str, Any]]):
+        """保存回答，并淘汰过期、旧版本和超出容量的条目"""
+        now = int(time.time())
+        question_hash = hashlib.sha256(_normalize_question(question).encode("utf-8")).hexdigest()
+        blob = array.array("f", _unit(embedding).tolist()).tobytes()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "DELETE FROM answers WHERE version = ? AND model = ? AND question_hash = ?",
+                (version, model, question_hash)
+            )
+            conn.execute(
+                "INSERT INTO answers (version, model, question_hash, question, embedding, answer, sources, "
+                "created_at, last_hit) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (version, model, question_hash, question, blob, answer,
+                 json.dumps(sources, ensure_ascii=False), now, now)
+            )
+            conn.execute("DELETE FROM answers WHERE version != ? OR created_at < ?",
+                         (version, int(now - self.ttl)))
+            conn.execute(
+                "DELETE FROM answers WHERE id IN (SELECT id FROM answers ORDER BY last_hit DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._bump(conn)
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM answers")
+            self._bump(conn)
+        with self._lock:
+            self._matrices.clear()
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+class SemanticAnswerCache:
+    """按课程管理答案缓存，负责计算问题向量、资料版本和统计命中率"""
+
+    def __init__(self, enabled: bool = SEMANTIC_CACHE_ENABLED):
+        self.enabled = enabled
+        self._caches: Dict[str, AnswerCache] = {}
+        self._lock = threading.Lock()
+        self._counters = Counter()
+
+    def _cache(self, course_id: str) -> AnswerCache:
+        path = os.path.join(KNOWLEDGE_BASE_ROOT, str(course_id), ANSWER_CACHE_FILENAME)
+        with self._lock:
+            cache = self._caches.get(path)
+            if cache is None:
+                cache = self._caches[path] = AnswerCache(path)
+            return cache
+
+    def _count(self, name: str):
+        with self._lock:
+            self._counters[name] += 1
+
+    @staticmethod
+    def _embed(question: str) -> Optional[List[float]]:
+        """问题向量（与检索使用同一原始文本，命中 embedding 引擎的查询缓存，不会重复请求）；失败时只做精确匹配"""
+        from backend.rag.embedding_engine import get_embedding_engine
+
+        try:
+            return get_embedding_engine().embed_query(question)
+        except Exception as e:
+            logger.warning(f"答案缓存计算问题向量失败: {e}")
+            return None
+
+    def lookup(self, course_id: str, question: str, model: str) -> Optional[Dict[str, Any]]:
+        """查找缓存的回答；未启用、出错或未命中时返回 None"""
+        if not self.enabled or not course_id or not question:
+            return None
+        try:
+            result = self._cache(course_id).lookup(
+                question, self._embed(question), material_version(course_id), model
+            )
+        except Exception as e:
+            logger.error(f"读取答案缓存失败: {e}")
+            result = None
+        self._count("hits" if result is not None else "misses")
+        if result is not None:
+            logger.info(f"答案缓存命中: 课程 {course_id}，相似度 {result['similarity']:.3f}")
+        return result
+
+    def store(self, course_id: str, question: str, model: str, answer: str, sources: List[Dict[str, Any]]):
+        """保存回答，出错时只记录日志"""
+        if not self.enabled or not course_id or not question or not answer:
+            return
+        embedding = self._embed(question)
+        if embedding is None:
+            return
+        try:
+            self._cache(course_id).store(question, embedding, material_version(course_id), model, answer, sources)
+            self._count("stores")
+        except Exception as e:
+            logger.error(f"写入答案缓存失败: {e}")
+
+    def record_bypass(self):
+        """记录一次跳过缓存的请求（调用方关闭缓存或存在对话历史）"""
+        self._count("bypass")
+
+    def invalidate(self, course_id: str):
+        """清空课程的答案缓存"""
+        path = os.path.join(KNOWLEDGE_BASE_ROOT, str(course_id), ANSWER_CACHE_FILENAME)
+        if not os.path.exists(path):
+            return
+        try:
+            self._cache(course_id).clear()
+            self._count("invalidations")
+        except Exception as e:
+            logger.error(f"清空答案缓存失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                **self._counters,
+                "hit_rate": self._counters["hits"] / lookups if lookups else 0.0,
+                "threshold": SEMANTIC_CACHE_THRESHOLD,
+                "enabled": self.enabled,
+            }
+
+
+answer_cache = SemanticAnswerCache()
+course_registry.add_invalidation_listener(answer_cache.invalidate)
@@ -0,0 +1,205 @@
+"""
+SQLite 存储的公共部分
+
+- ThreadLocalConnection：每个线程一个连接，WAL + synchronous=NORMAL，多个进程可共享同一文件
+- SQLiteLRUStore：按最近访问时间淘汰的键值缓存基类，子类只负责键和值的编码
+- SharedStore：进程级共享实例，打开失败后不再重试
+"""
+
+import os
+import sqlite3
+import logging
+import threading
+from typing import Callable, Dict, Generic, Iterable, Optional, Sequence, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+# 淘汰时删除到上限的这个比例，避免每次写入都触发淘汰
+LRU_EVICT_TARGET = 0.9
+# 命中时只有访问时间早于该间隔才回写，减少写放大（秒）
+LRU_TOUCH_INTERVAL = 600
+# SQLite 默认最多 999 个参数，IN 查询按此分段
+SQL_IN_BATCH = 500
+
+
+class ThreadLocalConnection:
+    """每个线程使用独立的连接"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def __call__(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+
+class SQLiteLRUStore:
+    """基于 SQLite 的 LRU 缓存，线程安全，可被多个进程共享
+
+    子类给出表名、列定义、主键列和值大小的 SQL 表达式，last_access 列由基类添加。
+    """
+
+    TABLE = ""
+    # (列名, 类型) 列表，不含 last_access
+    COLUMNS: Tuple[Tuple[str, str], ...] = ()
+    KEY_COLUMNS: Tuple[str, ...] = ()
+    # 计算单个条目占用字节数的 SQL 表达式
+    SIZE_EXPR = ""
+    # 日志中的缓存名称
+    NAME = "缓存"
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._conn = ThreadLocalConnection(path)
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+        conn = self._conn()
+        columns = "".join(f"{name} {kind}, " for name, kind in self.COLUMNS)
+        conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.TABLE} ({columns}last_access INTEGER NOT NULL, "
+            f"PRIMARY KEY ({', '.join(self.KEY_COLUMNS)}))"
+        )
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{self.TABLE}_last_access ON {self.TABLE} (last_access)")
+        conn.commit()
+        self._total_bytes = self._size(conn)
+
+    def _size(self, conn: sqlite3.Connection) -> int:
+        return conn.execute(f"SELECT COALESCE(SUM({self.SIZE_EXPR}), 0) FROM {self.TABLE}").fetchone()[0]
+
+    def _select(self, columns: str, where: str, params: Sequence, hashes: Iterable[str],
+                hash_column: str = "text_hash"):
+        """按 hash_column IN (...) 分段查询，返回所有行"""
+        conn = self._conn()
+        unique = list(dict.fromkeys(hashes))
+        rows = []
+        for start in range(0, len(unique), SQL_IN_BATCH):
+            part = unique[start:start + SQL_IN_BATCH]
+            placeholders = ",".join("?" * len(part))
+            rows.extend(conn.execute(
+                f"SELECT {columns} FROM {self.TABLE} WHERE {where} AND {hash_column} IN ({placeholders})",
+                [*params, *part]
+            ).fetchall())
+        return rows
+
+    def _touch(self, keys: Sequence[Tuple], now: int):
+        """回写命中条目的访问时间，keys 为按 KEY_COLUMNS 顺序的键"""
+        if not keys:
+            return
+        where = " AND ".join(f"{column} = ?" for column in self.KEY_COLUMNS)
+        conn = self._conn()
+        conn.executemany(
+            f"UPDATE {self.TABLE} SET last_access = ? WHERE {where}", [(now, *key) for key in keys]
+        )
+        conn.commit()
+
+    def _record(self, hits: int, lookups: int):
+        with self._lock:
+            self._hits += hits
+            self._misses += lookups - hits
+
+    def _insert(self, rows: Sequence[Tuple], sizes: Sequence[int]):
+        """插入新条目（已存在的键忽略），rows 按 COLUMNS 顺序、末尾为 last_access，超出上限时淘汰"""
+        if not rows:
+            return
+        conn = self._conn()
+        columns = [name for name, _ in self.COLUMNS] + ["last_access"]
+        sql = (f"INSERT OR IGNORE INTO {self.TABLE} ({', '.join(columns)}) "
+               f"VALUES ({', '.join('?' * len(columns))})")
+        added = 0
+        for row, size in zip(rows, sizes):
+            if conn.execute(sql, row).rowcount:
+                added += size
+        conn.commit()
+
+        with self._lock:
+            self._total_bytes += added
+            over_limit = self._total_bytes > self.max_bytes
+        if over_limit:
+            self._evict()
+
+    def _evict(self):
+        """按最近访问时间淘汰，直到总大小降到上限的 90%"""
+        conn = self._conn()
+        total = self._size(conn)
+        target = int(self.max_bytes * LRU_EVICT_TARGET)
+        keys = ", ".join(self.KEY_COLUMNS)
+        where = " AND ".join(f"{column} = ?" for column in self.KEY_COLUMNS)
+        removed = 0
+        while total > target:
+            rows = conn.execute(
+                f"SELECT {keys}, {self.SIZE_EXPR} FROM {self.TABLE} ORDER BY last_access ASC LIMIT {SQL_IN_BATCH}"
+            ).fetchall()
+            if not rows:
+                break
+            victims = []
+            for row in rows:
+                victims.append(tuple(row[:-1]))
+                total -= row[-1]
+                removed += 1
+                if total <= target:
+                    break
+            conn.executemany(f"DELETE FROM {self.TABLE} WHERE {where}", victims)
+            conn.commit()
+        with self._lock:
+            self._total_bytes = max(0, total)
+        logger.info(f"{self.NAME}淘汰了 {removed} 个条目，当前大小 {total / 1024 / 1024:.1f} MB")
+
+    def stats(self) -> Dict[str, float]:
+        """返回缓存统计信息"""
+        entries = self._conn().execute(f"SELECT COUNT(*) FROM {self.TABLE}").fetchone()[0]
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def clear(self):
+        """清空缓存"""
+        conn = self._conn()
+        conn.execute(f"DELETE FROM {self.TABLE}")
+        conn.commit()
+        with self._lock:
+            self._total_bytes = 0
+
+
+T = TypeVar("T")
+
+
+class SharedStore(Generic[T]):
+    """进程级共享的存储实例，禁用或无法打开时返回 None，打开失败后不再重试"""
+
+    def __init__(self, factory: Callable[[], T], name: str, enabled: bool = True):
+        self.factory = factory
+        self.name = name
+        self.enabled = enabled
+        self._instance: Optional[T] = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[T]:
+        if not self.enabled or self._failed:
+            return None
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None and not self._failed:
+                    try:
+                        self._instance = self.factory()
+                    except Exception as e:
+                        logger.error(f"无法打开{self.name}: {e}")
+                        self._failed = True
+        return self._instance
@@ -0,0 +1,90 @@
+"""
+中文分词
+
+安装了 jieba 时用 jieba 分词；未安装时退回按字符类别切分（英文/数字成词，连续汉字成段），
+保证调用方在任何环境下都能得到可用的结果。
+
+- segment：查询实体识别等需要完整词语的场景
+- index_terms：全文检索的索引词，建索引和查询必须使用同一个函数
+"""
+
+import re
+import unicodedata
+import logging
+import threading
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+try:
+    import jieba
+    jieba.setLogLevel(logging.WARNING)
+except ImportError:  # 未安装 jieba 时使用简单切分
+    jieba = None
+
+_TOKEN_RE = re.compile(r"[A-Za-z0-9_][A-Za-z0-9_.+#\-]*|[一-鿿]+")
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def _ensure_jieba():
+    """jieba 首次分词会加载词典，加锁避免多线程重复加载"""
+    global _initialized
+    if not _initialized:
+        with _init_lock:
+            if not _initialized:
+                jieba.initialize()
+                _initialized = True
+
+
+def segment(text: str) -> List[str]:
+    """把文本切分为词，去掉空白和标点"""
+    if not text:
+        return []
+    if jieba is None:
+        return _TOKEN_RE.findall(text)
+    _ensure_jieba()
+    return [word for word in jieba.lcut(text) if _TOKEN_RE.match(word)]
+
+
+# 索引词中的英文/数字词保留 . _ - 连接的整体（函数名、版本号、章节号如 3.2）
+_INDEX_RE = re.compile(r"[a-z0-9_]+(?:[.\-][a-z0-9_]+)*|[一-鿿]+")
+# 常见虚词，不作为索引词
+_INDEX_STOPWORDS = {
+    "的", "了", "是", "在", "和", "与", "及", "或", "也", "就", "都", "而", "被", "把", "对",
+    "这", "那", "之", "其", "中", "为", "以", "于", "上", "下", "个", "一个", "我们", "什么",
+    "如何", "怎么", "哪些", "请问", "the", "a", "an", "of", "to", "in", "and", "or", "is", "are",
+}
+
+
+def tokenizer_name() -> str:
+    """当前索引分词方式的名称，索引中记录该值，分词方式变化后需要重建索引"""
+    return "jieba-search" if jieba is not None else "bigram"
+
+
+def _cjk_bigrams(run: str) -> List[str]:
+    if len(run) == 1:
+        return [run]
+    return [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def index_terms(text: str) -> List[str]:
+    """全文检索的索引词（保留重复，用于统计词频）
+
+    文本先做 NFKC 规范化并转小写。英文/数字按整词索引；中文在有 jieba 时用搜索引擎模式分词
+    （长词同时输出其中的短词），否则按相邻两字切分。
+    """
+    if not text:
+        return []
+    text = unicodedata.normalize("NFKC", text).lower()
+    terms = []
+    for match in _INDEX_RE.finditer(text):
+        token = match.group()
+        if not ("一" <= token[0] <= "鿿"):
+            terms.append(token)
+        elif jieba is not None:
+            _ensure_jieba()
+            terms.extend(word for word in jieba.lcut_for_search(token) if word.strip())
+        else:
+            terms.extend(_cjk_bigrams(token))
+    return [term for term in terms if term not in _INDEX_STOPWORDS]
@@ -8,11 +8,14 @@ parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
 
 # 导入main.py中的Flask应用
-from backend.main import app, create_tables
+from backend.main import app, create_tables, start_background_workers
 
 if __name__ == '__main__':
     # 初始化数据库
     create_tables()
     
+    # 启动知识库任务调度，接手重启前遗留的任务
+    start_background_workers(debug=True)
+    
     # 运行应用
     app.run(host='0.0.0.0', port=5001, debug=True)
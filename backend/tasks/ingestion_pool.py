@@ -0,0 +1,168 @@
+"""
+知识库入库工作池
+
+用固定数量的工作线程处理 KnowledgeBaseQueue 中的文件，取代每个文件一个线程或串行处理：
+
+- 加载在工作线程的生产阶段中逐页进行；分割是 CPU 密集型操作，逐页提交到进程池执行，
+  长文本由分割器按分片提交到同一个进程池（进程内只有这一个进程池）
+- 向量化走进程内共享的 embedding 引擎，所有文件的请求共用同一组并发连接
+- 同一课程的向量库写入由 course_write_lock 串行化
+- 按课程轮转调度，并限制单个课程同时占用的工作线程数，
+  一位老师批量上传几十个文件时不会让其他课程一直等待
+"""
+
+import os
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Deque, Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# 同时处理的文件数
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "4"))
+# 分割用的进程数，0 表示在工作线程中直接执行
+INGESTION_PROCESSES = int(os.getenv("INGESTION_PROCESSES", str(min(4, os.cpu_count() or 1))))
+# 单个课程最多同时占用的工作线程数
+INGESTION_MAX_PER_COURSE = int(os.getenv("INGESTION_MAX_PER_COURSE", "2"))
+
+
+class IngestionPool:
+    """有界的入库工作池，按课程公平调度
+
+    handler(queue_id, split_executor) 负责处理单个队列项，返回是否成功。
+    """
+
+    def __init__(self, handler: Callable[[int, Optional[ProcessPoolExecutor]], Any],
+                 workers: int = INGESTION_WORKERS, processes: int = INGESTION_PROCESSES,
+                 max_per_course: int = INGESTION_MAX_PER_COURSE):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.processes = max(0, processes)
+        self.max_per_course = max(1, max_per_course)
+        # 课程 -> 待处理队列项，字典顺序即轮转顺序
+        self._pending: "OrderedDict[str, Deque[int]]" = OrderedDict()
+        self._running: Dict[str, int] = {}
+        self._queued: Set[int] = set()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._split_executor: Optional[ProcessPoolExecutor] = None
+        self._shutdown = False
+        self._completed = 0
+        self._failed = 0
+
+    @property
+    def split_executor(self) -> Optional[ProcessPoolExecutor]:
+        """延迟创建分割用的进程池，无法创建时返回 None"""
+        if self.processes and self._split_executor is None:
+            with self._cond:
+                if self._split_executor is None:
+                    try:
+                        # 使用 spawn，避免在多线程的 Flask 进程中 fork
+                        self._split_executor = ProcessPoolExecutor(
+                            max_workers=self.processes,
+                            mp_context=multiprocessing.get_context("spawn")
+                        )
+                    except Exception as e:
+                        logger.warning(f"无法创建入库进程池，改为在工作线程中分割: {e}")
+                        self.processes = 0
+        return self._split_executor
+
+    def submit(self, queue_id: int, course_id: Any = None) -> bool:
+        """提交队列项，已在排队或处理中的队列项不会重复提交"""
+        course_key = str(course_id)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError("入库工作池已关闭")
+            if queue_id in self._queued:
+                return False
+            self._queued.add(queue_id)
+            self._pending.setdefault(course_key, deque()).append(queue_id)
+            self._ensure_workers()
+            self._cond.notify()
+        return True
+
+    def _ensure_workers(self):
+        """在持有锁的情况下按需启动工作线程"""
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker, name=f"ingestion-{len(self._threads)}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self):
+        """在持有锁的情况下按课程轮转取出下一个可执行的队列项"""
+        for course_key in list(self._pending):
+            if self._running.get(course_key, 0) >= self.max_per_course:
+                continue
+            jobs = self._pending[course_key]
+            queue_id = jobs.popleft()
+            if jobs:
+                # 本课程排到队尾，下一次优先其他课程
+                self._pending.move_to_end(course_key)
+            else:
+                del self._pending[course_key]
+            self._running[course_key] = self._running.get(course_key, 0) + 1
+            return course_key, queue_id
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    if self._shutdown:
+                        return
+                    self._cond.wait()
+                    job = self._next_job()
+            course_key, queue_id = job
+
+            success = False
+            try:
+                logger.info(f"开始处理队列项 {queue_id}（课程 {course_key}）")
+                success = bool(self.handler(queue_id, self.split_executor))
+            except Exception as e:
+                logger.error(f"处理队列项 {queue_id} 时出错: {e}")
+            finally:
+                with self._cond:
+                    self._running[course_key] -= 1
+                    if not self._running[course_key]:
+                        del self._running[course_key]
+                    self._queued.discard(queue_id)
+                    if success:
+                        self._completed += 1
+                    else:
+                        self._failed += 1
+                    # 唤醒等待本课程名额的工作线程和 join()
+                    self._cond.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """等待所有已提交的队列项处理完成"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queued, timeout=timeout)
+
+    def shutdown(self, wait: bool = True):
+        """停止接收新任务，处理完已排队的任务后退出"""
+        if wait:
+            self.join()
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+            executor, self._split_executor = self._split_executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回工作池状态"""
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "processes": self.processes,
+                "pending": sum(len(jobs) for jobs in self._pending.values()),
+                "running": sum(self._running.values()),
+                "courses_waiting": len(self._pending),
+                "completed": self._completed,
+                "failed": self._failed,
+            }
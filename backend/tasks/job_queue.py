@@ -0,0 +1,348 @@
+"""
+知识库入库任务队列
+
+直接以主数据库中的 knowledge_base_queue 表作为唯一的持久化任务表，
+不再维护单独的 rag_queue.db 并反复全量同步：
+
+- 领取任务用一条 UPDATE ... RETURNING 原子完成，并写入租约（lease_owner / lease_expires_at）
+- 处理期间定时心跳续租；工作进程崩溃后租约过期，任务可被重新领取，尝试次数用完后转入死信
+- 失败后按指数退避重试，超过最大次数后标记为 failed（死信），不再自动重试
+- 进度更新在内存中合并，按时间间隔写入单行，不再每次回调都打开应用上下文并提交
+"""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE_DB_PATH = os.getenv(
+    "JOB_QUEUE_DB_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "database", "eduNova.sqlite")
+)
+# 租约时长（秒），超过该时间没有心跳的任务视为工作进程已崩溃
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+# 心跳间隔（秒）
+JOB_HEARTBEAT_INTERVAL = int(os.getenv("JOB_HEARTBEAT_INTERVAL", "30"))
+# 最大尝试次数，超过后进入死信状态
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# 重试退避基数（秒），第 n 次失败后等待 base * 2^(n-1)
+JOB_RETRY_BACKOFF = int(os.getenv("JOB_RETRY_BACKOFF", "60"))
+# 进度写入的最小间隔（秒）
+JOB_PROGRESS_FLUSH_INTERVAL = float(os.getenv("JOB_PROGRESS_FLUSH_INTERVAL", "2"))
+
+TABLE = "knowledge_base_queue"
+
+# 任务队列在原有队列表上新增的列
+JOB_COLUMNS = {
+    "attempts": "INTEGER DEFAULT 0",
+    "lease_owner": "TEXT",
+    "lease_expires_at": "INTEGER",
+    "available_at": "INTEGER DEFAULT 0",
+}
+
+# 可领取：未用完尝试次数的到期待处理任务，或租约已过期的处理中任务
+_CLAIMABLE = (
+    "COALESCE(attempts, 0) < :max AND ("
+    "(status = 'pending' AND COALESCE(available_at, 0) <= :now)"
+    " OR (status = 'processing' AND COALESCE(lease_expires_at, 0) < :now))"
+)
+# 租约过期且尝试次数已用完：工作进程在处理时崩溃（OOM、段错误、被杀死），不再重新领取
+_EXHAUSTED = (
+    "status = 'processing' AND COALESCE(lease_expires_at, 0) < :now AND COALESCE(attempts, 0) >= :max"
+)
+
+
+def default_worker_id() -> str:
+    """当前线程的工作者标识"""
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def _progress_detail(stage: str, message: str, progress: Optional[float] = None) -> str:
+    detail = {"stage": stage, "message": message, "timestamp": int(time.time())}
+    if progress is not None:
+        detail["progress"] = progress
+    return json.dumps(detail)
+
+
+class JobQueue:
+    """knowledge_base_queue 表上的租约式任务队列，线程安全"""
+
+    def __init__(self, path: str = JOB_QUEUE_DB_PATH, lease_seconds: int = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS, retry_backoff: int = JOB_RETRY_BACKOFF):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff = retry_backoff
+        self._local = threading.local()
+        self.ensure_schema()
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程使用独立的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def ensure_schema(self):
+        """为旧数据库补齐任务队列需要的列和索引"""
+        conn = self._conn()
+        columns = [row[1] for row in conn.execute(f"PRAGMA table_info({TABLE})")]
+        if not columns:
+            # 表尚未创建，由 Flask 的 db.create_all() 按模型建表
+            return
+        for name, definition in JOB_COLUMNS.items():
+            if name not in columns:
+                conn.execute(f"ALTER TABLE {TABLE} ADD COLUMN {name} {definition}")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE}_status_available ON {TABLE} (status, available_at)")
+        conn.commit()
+
+    def _execute(self, sql: str, params) -> sqlite3.Cursor:
+        conn = self._conn()
+        try:
+            cursor = conn.execute(sql, params)
+            conn.commit()
+            return cursor
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _dead_letter_expired(self, conn: sqlite3.Connection, now: int) -> int:
+        """把租约过期且尝试次数已用完的任务标记为 failed，不提交，由调用方在同一事务中提交"""
+        cursor = conn.execute(f'''
+        UPDATE {TABLE}
+        SET status = 'failed', error_message = :error, last_updated = :now,
+            lease_owner = NULL, lease_expires_at = NULL, progress_detail = :detail
+        WHERE {_EXHAUSTED}
+        ''', {
+            "now": now,
+            "max": self.max_attempts,
+            "error": "处理进程多次异常退出，已停止重试",
+            "detail": _progress_detail("failed", "处理进程多次异常退出，已停止重试"),
+        })
+        if cursor.rowcount:
+            logger.warning(f"{cursor.rowcount} 个任务的租约过期且已达到最大尝试次数，标记为失败")
+        return cursor.rowcount
+
+    def claim(self, worker_id: str, queue_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """原子地领取一个任务（指定 queue_id 时只领取该任务），无可领取任务时返回 None
+
+        同一事务中先把租约过期且尝试次数已用完的任务转入死信。
+        """
+        now = int(time.time())
+        params = {
+            "now": now,
+            "max": self.max_attempts,
+            "owner": worker_id,
+            "expires": now + self.lease_seconds,
+            "detail": _progress_detail("initializing", "正在初始化处理"),
+        }
+        if queue_id is not None:
+            target = f"id = :id AND {_CLAIMABLE}"
+            params["id"] = queue_id
+        else:
+            target = f"id = (SELECT id FROM {TABLE} WHERE {_CLAIMABLE} ORDER BY COALESCE(available_at, 0), id LIMIT 1)"
+        conn = self._conn()
+        try:
+            self._dead_letter_expired(conn, now)
+            row = conn.execute(f'''
+            UPDATE {TABLE}
+            SET status = 'processing', lease_owner = :owner, lease_expires_at = :expires,
+                attempts = COALESCE(attempts, 0) + 1, last_updated = :now, progress_detail = :detail
+            WHERE {target}
+            RETURNING id, course_id, file_path, purpose, attempts
+            ''', params).fetchone()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return dict(row) if row else None
+
+    def heartbeat(self, queue_id: int, worker_id: str) -> bool:
+        """续租，返回 False 表示租约已丢失（任务被其他工作者领取或已被删除）"""
+        now = int(time.time())
+        cursor = self._execute(f'''
+        UPDATE {TABLE} SET lease_expires_at = ?, last_updated = ?
+        WHERE id = ? AND lease_owner = ? AND status = 'processing'
+        ''', (now + self.lease_seconds, now, queue_id, worker_id))
+        return cursor.rowcount > 0
+
+    def update_progress(self, queue_id: int, worker_id: str, progress: float,
+                        stage: Optional[str] = None, message: Optional[str] = None) -> bool:
+        """写入单个任务的进度，只更新一行"""
+        now = int(time.time())
+        detail = _progress_detail(stage or "processing", message or f"处理进度: {progress:.1f}%", progress)
+        cursor = self._execute(f'''
+        UPDATE {TABLE} SET progress = ?, progress_detail = ?, last_updated = ?, lease_expires_at = ?
+        WHERE id = ? AND lease_owner = ? AND status = 'processing'
+        ''', (progress, detail, now, now + self.lease_seconds, queue_id, worker_id))
+        return cursor.rowcount > 0
+
+    def complete(self, queue_id: int, worker_id: str) -> bool:
+        """标记任务完成并释放租约"""
+        now = int(time.time())
+        cursor = self._execute(f'''
+        UPDATE {TABLE}
+        SET status = 'completed', progress = 100.0, completed_at = ?, last_updated = ?,
+            error_message = NULL, lease_owner = NULL, lease_expires_at = NULL, progress_detail = ?
+        WHERE id = ? AND lease_owner = ?
+        ''', (now, now, _progress_detail("completed", "处理完成", 100.0), queue_id, worker_id))
+        return cursor.rowcount > 0
+
+    def fail(self, queue_id: int, worker_id: str, error: str, retry: bool = True) -> str:
+        """记录失败：未超过最大次数时按退避时间重新排队，否则进入死信。返回新的状态"""
+        now = int(time.time())
+        row = self._conn().execute(f"SELECT attempts FROM {TABLE} WHERE id = ?", (queue_id,)).fetchone()
+        attempts = (row["attempts"] or 0) if row else self.max_attempts
+        if retry and attempts < self.max_attempts:
+            delay = self.retry_backoff * (2 ** max(0, attempts - 1))
+            status, available_at = "pending", now + delay
+            detail = _progress_detail("retrying", f"第 {attempts} 次处理失败，{delay} 秒后重试: {error}")
+        else:
+            status, available_at = "failed", 0
+            detail = _progress_detail("failed", error)
+        self._execute(f'''
+        UPDATE {TABLE}
+        SET status = ?, available_at = ?, error_message = ?, last_updated = ?,
+            lease_owner = NULL, lease_expires_at = NULL, progress_detail = ?
+        WHERE id = ? AND lease_owner = ?
+        ''', (status, available_at, error, now, detail, queue_id, worker_id))
+        return status
+
+    def due_jobs(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """返回当前可领取的任务（待处理到期的，或租约已过期的），顺带把用完尝试次数的过期任务转入死信"""
+        now = int(time.time())
+        conn = self._conn()
+        try:
+            if self._dead_letter_expired(conn, now):
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        rows = conn.execute(f'''
+        SELECT id, course_id FROM {TABLE} WHERE {_CLAIMABLE}
+        ORDER BY COALESCE(available_at, 0), id LIMIT :limit
+        ''', {"now": now, "max": self.max_attempts, "limit": limit}).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_job(self, queue_id: int) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute(f"SELECT * FROM {TABLE} WHERE id = ?", (queue_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list_jobs(self, course_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        if course_id is not None:
+            rows = self._conn().execute(
+                f"SELECT * FROM {TABLE} WHERE course_id = ? ORDER BY created_at DESC", (course_id,)
+            ).fetchall()
+        else:
+            rows = self._conn().execute(f"SELECT * FROM {TABLE} ORDER BY created_at DESC").fetchall()
+        return [dict(row) for row in rows]
+
+
+class JobLease:
+    """持有一个已领取任务的租约：后台心跳续租，合并进度更新
+
+    用法:
+        with JobLease(queue, job) as lease:
+            process(..., progress_callback=lease.report)
+            lease.complete()
+    """
+
+    def __init__(self, queue: JobQueue, job: Dict[str, Any], worker_id: str,
+                 heartbeat_interval: float = JOB_HEARTBEAT_INTERVAL,
+                 flush_interval: float = JOB_PROGRESS_FLUSH_INTERVAL):
+        self.queue = queue
+        self.job = job
+        self.queue_id = job["id"]
+        self.worker_id = worker_id
+        self.heartbeat_interval = heartbeat_interval
+        self.flush_interval = flush_interval
+        self.lost = False
+        self._lock = threading.Lock()
+        self._latest = None
+        self._last_flush = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._finished = False
+
+    def __enter__(self) -> "JobLease":
+        self._thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if exc is not None and not self._finished:
+            self.fail(str(exc))
+        return False
+
+    def _heartbeat_loop(self):
+        # 心跳线程有自己的数据库连接，同时负责写出合并后的进度
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                if not self.flush() and not self.queue.heartbeat(self.queue_id, self.worker_id):
+                    self.lost = True
+                    logger.warning(f"队列项 {self.queue_id} 的租约已丢失")
+                    return
+            except Exception as e:
+                logger.error(f"队列项 {self.queue_id} 心跳失败: {e}")
+
+    def report(self, progress: float, stage: Optional[str] = None, message: Optional[str] = None):
+        """进度回调：只保留最新值，距上次写入超过间隔时才写数据库"""
+        if progress < 0:
+            # 失败由 fail() 统一记录
+            return
+        with self._lock:
+            self._latest = (progress, stage, message)
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self) -> bool:
+        """写出尚未写入的最新进度，返回是否写入了数据库"""
+        with self._lock:
+            latest, self._latest = self._latest, None
+            if latest is None:
+                return False
+            self._last_flush = time.monotonic()
+        try:
+            if not self.queue.update_progress(self.queue_id, self.worker_id, *latest):
+                self.lost = True
+        except Exception as e:
+            logger.error(f"更新队列项 {self.queue_id} 进度失败: {e}")
+        return True
+
+    def complete(self) -> bool:
+        self._finished = True
+        with self._lock:
+            self._latest = None
+        return self.queue.complete(self.queue_id, self.worker_id)
+
+    def fail(self, error: str, retry: bool = True) -> str:
+        self._finished = True
+        with self._lock:
+            self._latest = None
+        return self.queue.fail(self.queue_id, self.worker_id, error, retry=retry)
+
+
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    """返回进程级共享的任务队列"""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = JobQueue()
+    return _queue
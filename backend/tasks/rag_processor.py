@@ -1,147 +1,108 @@
 import threading
 import time
 import os
-import json
-from flask import current_app
 import logging
 
-from backend.models.learning import KnowledgeBaseQueue
-from backend.extensions import db
 from backend.rag.create_db import process_document_with_progress
+from backend.tasks.ingestion_pool import IngestionPool
+from backend.tasks.job_queue import JobLease, default_worker_id, get_job_queue
 
 # Setup logging
 logger = logging.getLogger(__name__)
 
-def process_knowledge_queue(queue_id):
-    """Process a knowledge base queue item in a background thread"""
-    # 导入app对象
+# 扫描到期重试任务和过期租约的间隔（秒）
+JOB_DISPATCH_INTERVAL = int(os.getenv("JOB_DISPATCH_INTERVAL", "30"))
+
+def _upload_folder():
+    """上传目录，与 Flask 配置的 UPLOAD_FOLDER 一致"""
     from backend.main import app
+    return app.config['UPLOAD_FOLDER']
+
+def process_knowledge_queue(queue_id, split_executor=None, worker_id=None):
+    """Claim a knowledge base queue item and process it under a lease"""
+    job_queue = get_job_queue()
+    worker_id = worker_id or default_worker_id()
     
-    # 在应用上下文中执行所有操作
-    with app.app_context():
-        # Get the queue item
-        queue_item = db.session.get(KnowledgeBaseQueue, queue_id)
-        if not queue_item:
-            logger.error(f"Queue item {queue_id} not found")
-            return
+    job = job_queue.claim(worker_id, queue_id)
+    if not job:
+        # 已被其他工作者领取、已完成或尚未到重试时间
+        logger.info(f"Queue item {queue_id} is not claimable, skipping")
+        return False
+    
+    with JobLease(job_queue, job, worker_id) as lease:
+        # Get the full path to the file
+        file_path = os.path.join(_upload_folder(), job['file_path'].lstrip('/'))
+        
+        # Check if file exists
+        if not os.path.exists(file_path):
+            logger.error(f"File not found: {file_path}")
+            lease.fail(f"文件不存在: {job['file_path']}", retry=False)
+            return False
         
         try:
-            # Update status to processing
-            queue_item.status = 'processing'
-            queue_item.last_updated = int(time.time())
-            queue_item.progress_detail = json.dumps({
-                "stage": "initializing",
-                "message": "正在初始化处理",
-                "timestamp": int(time.time())
-            })
-            db.session.commit()
-            
-            # Define progress callback function
-            def progress_callback(progress, stage=None, message=None):
-                # 在应用上下文中执行进度更新
-                with app.app_context():
-                    # Get a fresh instance of the queue item
-                    current_item = db.session.get(KnowledgeBaseQueue, queue_id)
-                    if not current_item:
-                        logger.error(f"Queue item {queue_id} not found during progress update")
-                        return
-                    
-                    if progress < 0:
-                        # Error occurred
-                        current_item.status = 'failed'
-                        current_item.error_message = message or "Processing failed"
-                        current_item.last_updated = int(time.time())
-                    else:
-                        current_item.progress = progress
-                        
-                        # Update progress detail
-                        progress_detail = {
-                            "stage": stage or "processing",
-                            "progress": progress,
-                            "message": message or f"处理进度: {progress:.1f}%",
-                            "timestamp": int(time.time())
-                        }
-                        current_item.progress_detail = json.dumps(progress_detail)
-                        current_item.last_updated = int(time.time())
-                        
-                        logger.info(f"Queue item {queue_id}: {progress:.1f}% - {message or 'Processing'}")
-                    
-                    db.session.commit()
-            
-            # Get the full path to the file
-            file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], queue_item.file_path.lstrip('/'))
-            
-            # Check if file exists
-            if not os.path.exists(file_path):
-                logger.error(f"File not found: {file_path}")
-                progress_callback(-1, "error", f"文件不存在: {queue_item.file_path}")
-                return False
-                
             # Process the document
             success = process_document_with_progress(
-                course_id=str(queue_item.course_id),
+                course_id=str(job['course_id']),
                 file_path=file_path,
-                progress_callback=progress_callback,
-                purpose=queue_item.purpose or 'general'  # 传递文件用途参数
+                progress_callback=lease.report,
+                purpose=job['purpose'] or 'general',  # 传递文件用途参数
+                split_executor=split_executor
             )
-            
-            # Update status based on result
-            queue_item = db.session.get(KnowledgeBaseQueue, queue_id)
-            if not queue_item:
-                logger.error(f"Queue item {queue_id} not found after processing")
-                return False
-                
-            if success:
-                queue_item.status = 'completed'
-                queue_item.completed_at = int(time.time())
-                queue_item.progress = 100.0
-                queue_item.error_message = None  # 清除错误信息
-                queue_item.progress_detail = json.dumps({
-                    "stage": "completed",
-                    "progress": 100.0,
-                    "message": "处理完成",
-                    "timestamp": int(time.time())
-                })
-                queue_item.last_updated = int(time.time())
-                logger.info(f"Successfully processed queue item {queue_id}")
-            else:
-                queue_item.status = 'failed'
-                if not queue_item.error_message:
-                    queue_item.error_message = "Unknown error occurred"
-                queue_item.progress_detail = json.dumps({
-                    "stage": "failed",
-                    "message": queue_item.error_message,
-                    "timestamp": int(time.time())
-                })
-                queue_item.last_updated = int(time.time())
-                logger.error(f"Failed to process queue item {queue_id}")
-            
-            db.session.commit()
-            return success
-            
         except Exception as e:
             logger.error(f"Error processing queue item {queue_id}: {str(e)}")
-            # Update status to failed
-            try:
-                with app.app_context():
-                    queue_item = db.session.get(KnowledgeBaseQueue, queue_id)
-                    if queue_item:
-                        queue_item.status = 'failed'
-                        queue_item.error_message = str(e)
-                        queue_item.progress_detail = json.dumps({
-                            "stage": "error",
-                            "message": str(e),
-                            "timestamp": int(time.time())
-                        })
-                        queue_item.last_updated = int(time.time())
-                        db.session.commit()
-            except Exception as inner_e:
-                logger.error(f"Failed to update queue item status: {str(inner_e)}")
+            status = lease.fail(str(e))
+            logger.info(f"Queue item {queue_id} (attempt {job['attempts']}) -> {status}")
+            return False
+        
+        if success:
+            lease.complete()
+            logger.info(f"Successfully processed queue item {queue_id}")
+        else:
+            lease.fail("Unknown error occurred")
+            logger.error(f"Failed to process queue item {queue_id}")
+        return success
+
+_pool = None
+_pool_lock = threading.Lock()
+_dispatcher = None
+
+def _dispatch_due_jobs(pool):
+    """定期把到期的重试任务和租约过期的任务交给工作池"""
+    while True:
+        try:
+            for job in get_job_queue().due_jobs():
+                pool.submit(job['id'], job['course_id'])
+        except Exception as e:
+            logger.error(f"Failed to dispatch due queue items: {str(e)}")
+        time.sleep(JOB_DISPATCH_INTERVAL)
+
+def get_ingestion_pool():
+    """Return the process-wide ingestion worker pool"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = IngestionPool(process_knowledge_queue)
+    return _pool
+
+def start_job_dispatcher():
+    """Start the background dispatcher once per process
+
+    应在应用启动时调用（数据库表创建之后）：重启前遗留的待处理任务和租约已过期的任务
+    会立即交给工作池，不必等到下一次上传。
+    """
+    global _dispatcher
+    pool = get_ingestion_pool()
+    with _pool_lock:
+        if _dispatcher is not None:
             return False
+        _dispatcher = threading.Thread(
+            target=_dispatch_due_jobs, args=(pool,), name="job-dispatcher", daemon=True
+        )
+    _dispatcher.start()
+    logger.info("Knowledge base job dispatcher started")
+    return True
 
-def start_processing_queue_item(queue_id):
-    """Start processing a queue item in a background thread"""
-    thread = threading.Thread(target=process_knowledge_queue, args=(queue_id,))
-    thread.daemon = True
-    thread.start()
-    return thread 
\ No newline at end of file
+def start_processing_queue_item(queue_id, course_id=None):
+    """Submit a queue item to the shared ingestion worker pool"""
+    return get_ingestion_pool().submit(queue_id, course_id)
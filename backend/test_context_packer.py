@@ -0,0 +1,117 @@
+import os
+import sys
+import random
+import itertools
+
+# Add parent directory to path to import backend modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.rag import context_packer
+from backend.rag.context_packer import _merge_adjacent, deduplicate, knapsack, pack_context
+from backend.rag.embedding_engine import estimate_tokens
+
+
+def _brute_force(weights, values, capacity):
+    """枚举所有组合求最优价值"""
+    best = 0.0
+    for r in range(len(weights) + 1):
+        for combo in itertools.combinations(range(len(weights)), r):
+            if sum(weights[i] for i in combo) <= capacity:
+                best = max(best, sum(values[i] for i in combo))
+    return best
+
+
+def _item(content, score, index=None, source="a.pdf"):
+    metadata = {'source': source, 'file_hash': source}
+    if index is not None:
+        metadata['chunk_index'] = index
+    return {'content': content, 'metadata': metadata, 'score': score}
+
+
+def test_knapsack_optimal_on_small_cases():
+    """容量不超过分格数时按 1 个 token 分格，结果与穷举的最优解一致且不超出容量"""
+    rng = random.Random(7)
+    for _ in range(200):
+        n = rng.randint(1, 8)
+        weights = [rng.randint(1, 40) for _ in range(n)]
+        values = [round(rng.uniform(0, 1), 3) for _ in range(n)]
+        capacity = rng.randint(0, 120)
+        chosen = knapsack(weights, values, capacity)
+        assert sum(weights[i] for i in chosen) <= capacity
+        assert abs(sum(values[i] for i in chosen) - _brute_force(weights, values, capacity)) < 1e-9
+
+
+def test_knapsack_bucketed_stays_within_budget():
+    """大容量按格向上取整，选中组合的真实重量不超过容量"""
+    rng = random.Random(11)
+    for _ in range(50):
+        n = rng.randint(1, 30)
+        weights = [rng.randint(1, 3000) for _ in range(n)]
+        values = [rng.uniform(0, 1) for _ in range(n)]
+        capacity = rng.randint(1000, 20000)
+        chosen = knapsack(weights, values, capacity)
+        assert sum(weights[i] for i in chosen) <= capacity
+        assert chosen == sorted(set(chosen))
+    assert knapsack([10], [1.0], 0) == []
+    assert knapsack([], [], 100) == []
+    assert knapsack([5, 5], [0.0, -1.0], 100) == []
+
+
+def test_merge_adjacent_strips_overlap():
+    """同一文件中序号相邻的块合并为一段，重叠文本只保留一份，分数相加"""
+    groups = _merge_adjacent([
+        _item("第二段内容，结尾重叠", 0.5, index=1),
+        _item("开头的第一段，第二段内容", 0.9, index=0),
+        _item("结尾重叠之后的第三段", 0.2, index=2),
+        _item("另一个文件", 0.7, index=1, source="b.pdf"),
+        _item("不相邻的块", 0.1, index=5),
+    ])
+    assert [group['content'] for group in groups] == [
+        "开头的第一段，第二段内容，结尾重叠之后的第三段",
+        "另一个文件",
+        "不相邻的块",
+    ]
+    assert groups[0]['chunks'] == 3
+    assert abs(groups[0]['score'] - 1.6) < 1e-9
+    assert groups[0]['best'] == 0.9
+
+    # 没有重叠时以换行连接；没有序号的旧数据不合并
+    groups = _merge_adjacent([_item("甲", 0.3, index=0), _item("乙", 0.2, index=1)])
+    assert [group['content'] for group in groups] == ["甲\n乙"]
+    groups = _merge_adjacent([_item("甲", 0.3), _item("乙", 0.2)])
+    assert len(groups) == 2
+
+
+def test_deduplicate():
+    """去掉完全重复和被包含的条目，保留较高的分数，空内容丢弃"""
+    items = deduplicate([
+        _item("机器学习是人工智能的一个分支", 0.4, index=0),
+        _item("人工智能的一个分支", 0.8, index=1),
+        _item("机器学习是人工智能的一个分支", 0.6, index=2),
+        _item("深度学习", 0.5, index=3),
+        _item("   ", 0.9, index=4),
+    ])
+    assert [(item['content'], item['score']) for item in items] == [
+        ("机器学习是人工智能的一个分支", 0.8),
+        ("深度学习", 0.5),
+    ]
+
+
+def test_pack_context_within_budget():
+    """打包结果不超出预算（分词器未加载时按估算计数）"""
+    context_packer._tokenizers["test-model"] = None
+    items = [_item(f"第{i}段" + "内容" * (10 + i), 1.0 / (i + 1), index=i) for i in range(20)]
+    for budget in (0, 30, 100, 400):
+        packed = pack_context(items, budget, model="test-model")
+        assert sum(part['tokens'] for part in packed) <= budget
+        for part in packed:
+            assert part['tokens'] == estimate_tokens("文档片段:\n{content}\n".format(content=part['content']))
+
+
+if __name__ == "__main__":
+    test_knapsack_optimal_on_small_cases()
+    test_knapsack_bucketed_stays_within_budget()
+    test_merge_adjacent_strips_overlap()
+    test_deduplicate()
+    test_pack_context_within_budget()
+    print("context_packer 测试通过")
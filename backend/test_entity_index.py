@@ -0,0 +1,122 @@
+import os
+import sys
+import random
+
+import networkx as nx
+
+# Add parent directory to path to import backend modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.rag.entity_index import EntityIndex, get_entity_index, normalize_entity_name
+from backend.rag.graph_store import CSRGraph
+
+
+def _is_word_char(ch):
+    return ch.isascii() and ch.isalnum()
+
+
+def _brute_force_find_all(names, text):
+    """逐个实体名、逐个位置比较，英文实体名两侧要求断词"""
+    text = normalize_entity_name(text)
+    exact = {}
+    for name in names:
+        exact.setdefault(normalize_entity_name(name), name)
+    matches = set()
+    for key, name in exact.items():
+        if not key:
+            continue
+        start = text.find(key)
+        while start != -1:
+            end = start + len(key)
+            left_ok = not (_is_word_char(key[0]) and start > 0 and _is_word_char(text[start - 1]))
+            right_ok = not (_is_word_char(key[-1]) and end < len(text) and _is_word_char(text[end]))
+            if left_ok and right_ok:
+                matches.add((start, end, name))
+            start = text.find(key, start + 1)
+    return matches
+
+
+def test_find_all_matches_brute_force():
+    """随机的实体名和文本上，自动机结果与暴力查找一致"""
+    rng = random.Random(3)
+    alphabet = "ab机器学习 "
+    for _ in range(300):
+        names = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 12))]
+        text = "".join(rng.choice(alphabet + "x数") for _ in range(rng.randint(0, 40)))
+        index = EntityIndex(names)
+        found = index.find_all(text)
+        assert len(found) == len(set(found))
+        assert set(found) == _brute_force_find_all(names, text), (names, text)
+
+
+def test_match_prefers_longest():
+    """重叠时取最长的匹配，按出现顺序返回，同一实体只出现一次"""
+    index = EntityIndex(["机器学习", "学习", "机器", "深度学习", "Python"])
+    assert index.match("机器学习和深度学习都用python学习") == ["机器学习", "深度学习", "Python", "学习"]
+    assert index.match("机器学习与机器学习") == ["机器学习"]
+    assert index.match("没有实体") == []
+
+
+def test_english_word_boundary():
+    """英文实体名只在单词边界处匹配，中文实体名不受限制"""
+    index = EntityIndex(["AI", "C", "学习"])
+    assert index.find_all("send MAIL to me") == []
+    assert index.match("what is AI?") == ["AI"]
+    assert index.match("AI-based 学习") == ["AI", "学习"]
+    assert index.match("用C语言学习") == ["C", "学习"]
+    assert index.match("ABC") == []
+    # 大小写和多余空白不影响匹配
+    index = EntityIndex(["Neural  Network"])
+    assert index.match("a neural network model") == ["Neural  Network"]
+    assert index.lookup(" neural network ") == "Neural  Network"
+
+
+def test_fuzzy_and_resolve():
+    """模糊匹配容忍错字和缺字，相似度低于阈值的不返回"""
+    index = EntityIndex(["卷积神经网络", "循环神经网络", "支持向量机"])
+    assert index.resolve("卷积神经网络") == "卷积神经网络"
+    assert index.resolve("卷积神精网络") == "卷积神经网络"
+    assert index.resolve("卷积神经网") == "卷积神经网络"
+    assert index.resolve("决策树") is None
+    scored = index.fuzzy("神经网络", threshold=0.3)
+    assert {name for name, _ in scored} == {"卷积神经网络", "循环神经网络"}
+    assert all(0.3 <= score <= 1 for _, score in scored)
+    assert index.fuzzy("") == []
+
+
+def test_containing_matches_linear_scan():
+    """n-gram 倒排缩小候选后的结果与线性扫描一致"""
+    rng = random.Random(5)
+    alphabet = "ab神经网络"
+    for _ in range(200):
+        names = ["".join(rng.choice(alphabet) for _ in range(rng.randint(1, 6))) for _ in range(rng.randint(1, 15))]
+        index = EntityIndex(names)
+        term = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 3)))
+        key = normalize_entity_name(term)
+        expected = sorted({name for name in {normalize_entity_name(n): n for n in reversed(names)}.values()
+                           if key in normalize_entity_name(name)})
+        assert sorted(index.containing(term)) == expected, (names, term)
+    index = EntityIndex(["神经网络", "卷积神经网络", "网络"])
+    assert index.containing("神经网络") == ["神经网络", "卷积神经网络"]
+    assert index.containing("神经网络", limit=1) == ["神经网络"]
+    assert index.containing("") == []
+
+
+def test_index_cached_per_csr_graph():
+    """只读图的索引按图对象缓存，networkx 图每次重新构建"""
+    graph = nx.Graph()
+    graph.add_edge("机器学习", "深度学习")
+    csr = CSRGraph.from_networkx(graph)
+    assert get_entity_index(csr) is get_entity_index(csr)
+    assert get_entity_index(graph) is not get_entity_index(graph)
+    assert get_entity_index(csr).match("深度学习") == ["深度学习"]
+
+
+if __name__ == "__main__":
+    test_find_all_matches_brute_force()
+    test_match_prefers_longest()
+    test_english_word_boundary()
+    test_fuzzy_and_resolve()
+    test_containing_matches_linear_scan()
+    test_index_cached_per_csr_graph()
+    print("entity_index 测试通过")
@@ -0,0 +1,60 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+# Add parent directory to path to import backend modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("LLM_API_KEY", "test-key")
+
+from langchain_core.documents import Document
+from backend.rag.embedding_engine import estimate_tokens
+from backend.rag.knowledge_graph import GRAPH_OUTPUT_RATIO, KnowledgeGraphBuilder
+
+
+def _bound_max_tokens(builder):
+    """批量提取链实际发送的 max_tokens"""
+    for step in builder.batch_extraction_chain.steps:
+        kwargs = getattr(step, "kwargs", None)
+        if kwargs and "max_tokens" in kwargs:
+            return kwargs["max_tokens"]
+    return None
+
+
+@contextmanager
+def _workdir():
+    """在临时目录中运行（构建器会在相对路径 uploads/knowledge_base 下创建课程目录）"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(cwd)
+
+
+def test_planned_batches_fit_output_cap():
+    """每个多块批次的预期输出都不超过请求中发送的 max_tokens"""
+    with _workdir():
+        builder = KnowledgeGraphBuilder("test_graph_batching")
+    cap = _bound_max_tokens(builder)
+    assert cap == builder._batch_limit_tokens()[1]
+
+    chunks = [
+        Document(page_content="知识图谱测试文本。" * (20 + i * 37 % 200), metadata={"chunk_id": f"c{i}"})
+        for i in range(60)
+    ]
+    batches = builder.plan_batches(chunks)
+    assert sum(len(batch) for batch in batches) == len(chunks)
+    assert any(len(batch) > 1 for batch in batches)
+    for batch in batches:
+        if len(batch) == 1:
+            continue
+        expected = sum(int((estimate_tokens(c.page_content) + 16) * GRAPH_OUTPUT_RATIO) for c in batch)
+        assert expected <= cap, f"批次预期输出 {expected} 超过上限 {cap}"
+
+
+if __name__ == "__main__":
+    test_planned_batches_fit_output_cap()
+    print("知识图谱批量抽取测试通过")
@@ -0,0 +1,172 @@
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+
+import networkx as nx
+
+# Add parent directory to path to import backend modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.rag import graph_store
+from backend.rag.graph_store import (
+    CSRGraph, GRAPH_FILENAME, GRAPH_POINTER_FILENAME, LEGACY_GML_FILENAME,
+    course_graph_path, course_graph_signature, export_gml_file, import_gml_file,
+    load_course_graph, load_graph, remove_course_graph, save_course_graph, save_graph,
+)
+
+
+def _sample_graph() -> nx.Graph:
+    """带类型、标签、来源、附加属性、自环和孤立节点的测试图"""
+    graph = nx.Graph()
+    graph.add_node("Python", type="编程语言", source_chunks=["c1", "c2"], source_files=["a.pdf", "b.pdf"])
+    graph.add_node("机器学习", type="技术领域", source_chunks=["c1"], source_files=["a.pdf"], weight=3)
+    graph.add_node("张量", type="概念", source_chunks=["c3"], source_files=["b.pdf"])
+    graph.add_node("孤立节点", type="概念", source_chunks=["c4"], source_files=["c.pdf"])
+    graph.add_edge("Python", "机器学习", label="用于", source_chunks=["c1"], source_files=["a.pdf"])
+    graph.add_edge("机器学习", "张量", label="使用", source_chunks=["c3"], source_files=["b.pdf"], weight=0.5)
+    graph.add_edge("张量", "张量", label="自身", source_chunks=["c3"], source_files=["b.pdf"])
+    return graph
+
+
+def _assert_same(actual, expected: nx.Graph):
+    assert sorted(actual.nodes()) == sorted(expected.nodes())
+    for node, data in expected.nodes(data=True):
+        assert actual.nodes[node] == data, node
+    assert actual.number_of_edges() == expected.number_of_edges()
+    for u, v, data in expected.edges(data=True):
+        assert actual.has_edge(u, v) and actual.has_edge(v, u), (u, v)
+        assert actual.get_edge_data(u, v) == data, (u, v)
+
+
+@contextmanager
+def _workdir():
+    """在临时目录中运行（课程图谱位于相对路径 uploads/knowledge_base 下）"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(cwd)
+            with graph_store._cache_lock:
+                graph_store._cache.clear()
+
+
+def test_csr_round_trip():
+    """写入二进制文件并 mmap 读取后，节点、边和属性与原图一致，networkx 兼容接口结果相同"""
+    expected = _sample_graph()
+    with _workdir() as tmp:
+        path = os.path.join(tmp, "graph.bin")
+        save_graph(expected, path, export_gml=False)
+        graph = load_graph(path)
+
+        _assert_same(graph, expected)
+        _assert_same(graph.to_networkx(), expected)
+        assert dict(graph.degree()) == dict(expected.degree())
+        assert graph.degree("张量") == expected.degree("张量") == 3
+        for node in expected:
+            assert sorted(graph.neighbors(node)) == sorted(expected.neighbors(node))
+            assert len(graph[node]) == len(expected[node])
+        assert not graph.has_edge("Python", "张量")
+        assert graph.get_edge_data("Python", "张量", "无") == "无"
+        assert "不存在" not in graph
+        assert sorted(map(sorted, graph.edges("张量"))) == sorted(map(sorted, expected.edges("张量")))
+        _assert_same(graph.subgraph(["Python", "机器学习", "不存在"]),
+                     expected.subgraph(["Python", "机器学习"]))
+
+
+def test_empty_graph_round_trip():
+    """空图也能写入和读取"""
+    graph = CSRGraph.from_networkx(nx.Graph())
+    assert graph.number_of_nodes() == graph.number_of_edges() == 0
+    assert graph.to_networkx().number_of_nodes() == 0
+
+
+def test_provenance_index():
+    """来源倒排索引按文件名或文本块ID找到引用它的节点和边"""
+    graph = CSRGraph.from_networkx(_sample_graph())
+    assert graph.nodes_with_provenance(["a.pdf"]) == sorted(["Python", "机器学习"], key=lambda s: s.encode())
+    assert graph.nodes_with_provenance(["c3"]) == ["张量"]
+    assert sorted(map(sorted, graph.edges_with_provenance(["b.pdf"]))) == [["张量", "张量"], ["张量", "机器学习"]]
+    assert graph.edges_with_provenance(["c1", "c2"]) == [("Python", "机器学习")]
+    assert graph.nodes_with_provenance(["不存在.pdf"]) == []
+
+    # 没有 source_files 的旧图只按文本块ID索引，读取时也不补出 source_files
+    legacy = nx.Graph()
+    legacy.add_node("A", type="概念", source_chunks=["c9"])
+    legacy = CSRGraph.from_networkx(legacy)
+    assert legacy.nodes_with_provenance(["c9"]) == ["A"]
+    assert "source_files" not in legacy.nodes["A"]
+
+
+def test_gml_round_trip():
+    """导出 GML 再导入后与原图一致"""
+    expected = _sample_graph()
+    with _workdir() as tmp:
+        gml_path = os.path.join(tmp, "graph.gml")
+        export_gml_file(CSRGraph.from_networkx(expected), gml_path)
+        _assert_same(import_gml_file(gml_path), expected)
+        imported = import_gml_file(gml_path, os.path.join(tmp, "graph.bin"))
+        _assert_same(imported, expected)
+        assert dict(imported.degree()) == dict(nx.read_gml(gml_path).degree())
+
+
+def test_versioned_course_graph():
+    """每次保存写入新版本文件并切换指针，旧的映射在替换后仍可读取，旧版本文件被清理"""
+    with _workdir():
+        first = _sample_graph()
+        path = save_course_graph("1", first, export_gml=False)
+        assert course_graph_path("1") == path
+        signature = course_graph_signature("1")
+        assert os.path.basename(path) != GRAPH_FILENAME
+        old = load_course_graph("1")
+        assert load_course_graph("1") is old
+        _assert_same(old, first)
+
+        second = _sample_graph()
+        second.remove_node("Python")
+        save_course_graph("1", second, export_gml=False)
+        assert course_graph_path("1") != path
+        assert course_graph_signature("1") != signature
+        assert not os.path.exists(path)
+        _assert_same(load_course_graph("1"), second)
+        # 进行中的查询仍持有旧映射
+        _assert_same(old, first)
+
+        course_dir = os.path.dirname(path)
+        versions = [name for name in os.listdir(course_dir) if name.endswith(".bin")]
+        assert versions == [os.path.basename(course_graph_path("1"))]
+
+        remove_course_graph("1")
+        assert not os.path.exists(os.path.join(course_dir, GRAPH_POINTER_FILENAME))
+        assert not [name for name in os.listdir(course_dir) if name.endswith(".bin")]
+        assert course_graph_signature("1") is None
+        assert load_course_graph("1").number_of_nodes() == 0
+
+
+def test_legacy_course_graph_files():
+    """没有指针文件时读取旧版文件名，只有 GML 时转换为二进制版本"""
+    expected = _sample_graph()
+    with _workdir():
+        course_dir = os.path.join("uploads", "knowledge_base", "2")
+        os.makedirs(course_dir)
+        save_graph(expected, os.path.join(course_dir, GRAPH_FILENAME), export_gml=False)
+        assert course_graph_path("2") == os.path.join(course_dir, GRAPH_FILENAME)
+        _assert_same(load_course_graph("2"), expected)
+
+        course_dir = os.path.join("uploads", "knowledge_base", "3")
+        os.makedirs(course_dir)
+        nx.write_gml(expected, os.path.join(course_dir, LEGACY_GML_FILENAME))
+        _assert_same(load_course_graph("3"), expected)
+        assert os.path.exists(os.path.join(course_dir, GRAPH_POINTER_FILENAME))
+
+
+if __name__ == "__main__":
+    test_csr_round_trip()
+    test_empty_graph_round_trip()
+    test_provenance_index()
+    test_gml_round_trip()
+    test_versioned_course_graph()
+    test_legacy_course_graph_files()
+    print("graph_store 测试通过")
@@ -0,0 +1,128 @@
+import os
+import sys
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+
+# Add parent directory to path to import backend modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.tasks import job_queue
+from backend.tasks.job_queue import TABLE, JobQueue
+
+
+class _Clock:
+    """可手动推进的时钟，替换 job_queue 模块中的 time"""
+
+    def __init__(self, now: int):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@contextmanager
+def _queue(max_attempts=3, lease_seconds=60, retry_backoff=10):
+    """在临时数据库上建一个只有一条任务的队列"""
+    clock = _Clock(1_000_000)
+    original = job_queue.time
+    job_queue.time = clock
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "queue.sqlite")
+        conn = sqlite3.connect(path)
+        conn.execute(f'''
+        CREATE TABLE {TABLE} (
+            id INTEGER PRIMARY KEY, course_id INTEGER NOT NULL, file_path TEXT NOT NULL,
+            status TEXT DEFAULT 'pending', created_at INTEGER, completed_at INTEGER,
+            error_message TEXT, progress REAL DEFAULT 0, progress_detail TEXT,
+            last_updated INTEGER, file_hash TEXT, purpose TEXT DEFAULT 'general'
+        )''')
+        conn.execute(f"INSERT INTO {TABLE} (course_id, file_path, created_at) VALUES (1, 'a.pdf', 0)")
+        conn.commit()
+        conn.close()
+        try:
+            yield JobQueue(path, lease_seconds=lease_seconds, max_attempts=max_attempts,
+                           retry_backoff=retry_backoff), clock
+        finally:
+            job_queue.time = original
+
+
+def test_expired_lease_is_reclaimed():
+    """工作进程崩溃后租约过期，任务可被其他工作者重新领取"""
+    with _queue() as (queue, clock):
+        job = queue.claim("w1")
+        assert job["attempts"] == 1
+        assert queue.claim("w2") is None
+
+        clock.now += 30
+        assert queue.heartbeat(job["id"], "w1")
+        # 心跳把租约延长到续租后的 60 秒
+        clock.now += 50
+        assert queue.claim("w2") is None
+
+        clock.now += 20
+        job = queue.claim("w2")
+        assert job["attempts"] == 2
+        # 旧工作者的租约已丢失
+        assert not queue.heartbeat(job["id"], "w1")
+        assert not queue.complete(job["id"], "w1")
+        assert queue.complete(job["id"], "w2")
+        assert queue.get_job(job["id"])["status"] == "completed"
+
+
+def test_retry_backoff():
+    """失败后按指数退避重新排队，退避期间不可领取"""
+    with _queue(max_attempts=3, retry_backoff=10) as (queue, clock):
+        job = queue.claim("w1")
+        assert queue.fail(job["id"], "w1", "boom") == "pending"
+        assert queue.due_jobs() == []
+        clock.now += 9
+        assert queue.claim("w1") is None
+        clock.now += 1
+        assert queue.claim("w1")["attempts"] == 2
+
+        assert queue.fail(job["id"], "w1", "boom") == "pending"
+        clock.now += 19
+        assert queue.claim("w1") is None
+        clock.now += 1
+        assert queue.claim("w1")["attempts"] == 3
+
+        assert queue.fail(job["id"], "w1", "boom") == "failed"
+        clock.now += 10_000
+        assert queue.claim("w1") is None
+        assert queue.get_job(job["id"])["status"] == "failed"
+
+
+def test_expired_lease_dead_letters_after_max_attempts():
+    """每次处理都崩溃的任务在尝试次数用完后进入死信，不再被无限领取"""
+    with _queue(max_attempts=3, lease_seconds=60) as (queue, clock):
+        attempts = []
+        for _ in range(6):
+            job = queue.claim("worker")
+            if job is None:
+                break
+            attempts.append(job["attempts"])
+            clock.now += 61
+        assert attempts == [1, 2, 3]
+
+        job = queue.get_job(1)
+        assert job["status"] == "failed"
+        assert job["lease_owner"] is None
+        assert job["error_message"]
+
+
+def test_due_jobs_dead_letters_exhausted():
+    """调度线程只调用 due_jobs 时也会把用完次数的过期任务转入死信"""
+    with _queue(max_attempts=1, lease_seconds=60) as (queue, clock):
+        assert queue.claim("worker")["attempts"] == 1
+        clock.now += 61
+        assert queue.due_jobs() == []
+        assert queue.get_job(1)["status"] == "failed"
+
+
+if __name__ == "__main__":
+    test_expired_lease_is_reclaimed()
+    test_retry_backoff()
+    test_expired_lease_dead_letters_after_max_attempts()
+    test_due_jobs_dead_letters_exhausted()
+    print("job_queue 测试通过")
@@ -0,0 +1,217 @@
+import os
+import sys
+import json
+import asyncio
+import itertools
+
+import httpx
+import openai
+
+# Add parent directory to path to import backend modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.rag import llm_gateway
+from backend.rag.llm_gateway import LLM_MAX_CONCURRENCY, LLMGateway, LLMGatewayError
+from backend.rag.rate_limiter import TokenBucket
+
+# 重试不等待
+llm_gateway.LLM_BACKOFF_BASE = 0
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+_bases = itertools.count()
+
+
+def _completion(text: str) -> httpx.Response:
+    return httpx.Response(200, json={
+        "id": "cmpl", "object": "chat.completion", "created": 0, "model": "test-model",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5},
+    })
+
+
+def _sse(parts, fail_after=None):
+    """SSE 流式响应体；fail_after 指定在产出多少个增量后连接中断"""
+    for i, part in enumerate(parts):
+        if fail_after is not None and i == fail_after:
+            raise httpx.ReadError("连接中断")
+        chunk = {
+            "id": "cmpl", "object": "chat.completion.chunk", "created": 0, "model": "test-model",
+            "choices": [{"index": 0, "delta": {"content": part}, "finish_reason": None}],
+        }
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode()
+    yield b"data: [DONE]\n\n"
+
+
+async def _asse(parts, fail_after=None):
+    for chunk in _sse(parts, fail_after):
+        yield chunk
+
+
+def _stream(parts, fail_after=None, asynchronous=False) -> httpx.Response:
+    body = _asse(parts, fail_after) if asynchronous else _sse(parts, fail_after)
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body)
+
+
+class _Server:
+    """按顺序返回预设响应的 MockTransport 处理函数，记录请求次数"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        response = self.responses.pop(0)
+        return response() if callable(response) else response
+
+
+def _client(server: _Server, requests_rate: float = 0):
+    """使用 MockTransport 的网关客户端；每次使用独立的服务商地址和令牌桶"""
+    gateway = LLMGateway()
+    client = gateway.client(api_key="test-key", api_base=f"http://llm-{next(_bases)}.test/v1", model="test-model")
+    provider = client.provider
+    provider.requests = TokenBucket(requests_rate)
+    provider.http_client = httpx.Client(transport=httpx.MockTransport(server))
+    provider.client = openai.OpenAI(api_key="test-key", base_url=provider.api_base, max_retries=0,
+                                    http_client=provider.http_client)
+    return client
+
+
+def _bind_async(client, server: _Server):
+    """在当前事件循环上换成 MockTransport 的异步客户端"""
+    provider = client.provider
+    loop = asyncio.get_running_loop()
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(server))
+    async_client = openai.AsyncOpenAI(api_key="test-key", base_url=provider.api_base, max_retries=0,
+                                      http_client=http_client)
+    provider._async_clients[id(loop)] = (loop, async_client, http_client)
+
+
+def _slots_free(client) -> bool:
+    return client.provider.slots._value == LLM_MAX_CONCURRENCY
+
+
+def test_retry_policy():
+    """5xx 按重试次数上限重试，4xx（429 以外）不重试"""
+    server = _Server(httpx.Response(503), httpx.Response(500), _completion("好的"))
+    client = _client(server)
+    assert client.chat(MESSAGES) == "好的"
+    assert server.calls == 3
+    counters = client.gateway.metrics(client.api_base, "test-model").counters
+    assert counters["retries"] == 2 and counters["calls"] == 1
+
+    server = _Server(*[httpx.Response(502)] * (llm_gateway.LLM_MAX_RETRIES + 1))
+    client = _client(server)
+    try:
+        client.chat(MESSAGES)
+        raise AssertionError("应当抛出 LLMGatewayError")
+    except LLMGatewayError as e:
+        assert e.status_code == 502
+    assert server.calls == llm_gateway.LLM_MAX_RETRIES + 1
+
+    server = _Server(httpx.Response(400, json={"error": {"message": "bad request"}}))
+    client = _client(server)
+    try:
+        client.chat(MESSAGES)
+        raise AssertionError("应当抛出 LLMGatewayError")
+    except LLMGatewayError as e:
+        assert e.status_code == 400
+    assert server.calls == 1
+    assert _slots_free(client)
+
+
+def test_rate_limited_feeds_bucket():
+    """429 通知服务商的令牌桶降速，按 Retry-After 等待后重试成功"""
+    server = _Server(httpx.Response(429, headers={"Retry-After": "0.01"}), _completion("好的"))
+    client = _client(server, requests_rate=100)
+    assert client.chat(MESSAGES) == "好的"
+    assert server.calls == 2
+    stats = client.provider.requests.stats()
+    assert stats["rate_limited"] == 1
+    assert stats["rate"] < stats["max_rate"]
+
+
+def test_stream_retries_only_before_first_token():
+    """流式请求在第一个增量之前失败时重试，产出内容后中断则直接报错"""
+    server = _Server(httpx.Response(503), lambda: _stream(["你", "好"]))
+    client = _client(server)
+    assert list(client.stream(MESSAGES)) == ["你", "好"]
+    assert server.calls == 2
+
+    server = _Server(lambda: _stream(["你", "好"], fail_after=1), lambda: _stream(["不应重试"]))
+    client = _client(server)
+    received = []
+    try:
+        for part in client.stream(MESSAGES):
+            received.append(part)
+        raise AssertionError("应当抛出 LLMGatewayError")
+    except LLMGatewayError:
+        pass
+    assert received == ["你"]
+    assert server.calls == 1
+    assert _slots_free(client)
+
+
+def test_astream_retries_only_before_first_token():
+    """异步流式请求的重试规则与同步一致"""
+    async def run():
+        server = _Server(httpx.Response(500), lambda: _stream(["你", "好"], asynchronous=True))
+        client = _client(server)
+        _bind_async(client, server)
+        assert [part async for part in client.astream(MESSAGES)] == ["你", "好"]
+        assert server.calls == 2
+
+        server = _Server(lambda: _stream(["你", "好"], fail_after=1, asynchronous=True),
+                         lambda: _stream(["不应重试"], asynchronous=True))
+        client = _client(server)
+        _bind_async(client, server)
+        received = []
+        try:
+            async for part in client.astream(MESSAGES):
+                received.append(part)
+            raise AssertionError("应当抛出 LLMGatewayError")
+        except LLMGatewayError:
+            pass
+        assert received == ["你"]
+        assert server.calls == 1
+        assert _slots_free(client)
+
+        server = _Server(httpx.Response(503), _completion("好的"))
+        client = _client(server)
+        _bind_async(client, server)
+        assert await client.achat(MESSAGES) == "好的"
+        assert server.calls == 2
+
+    asyncio.run(run())
+
+
+def test_stream_closed_early_releases_slot():
+    """调用方提前关闭流时释放并发名额"""
+    server = _Server(lambda: _stream(["一", "二", "三"]))
+    client = _client(server)
+    stream = client.stream(MESSAGES)
+    assert next(stream) == "一"
+    assert not _slots_free(client)
+    stream.close()
+    assert _slots_free(client)
+
+    async def run():
+        server = _Server(lambda: _stream(["一", "二", "三"], asynchronous=True))
+        client = _client(server)
+        _bind_async(client, server)
+        stream = client.astream(MESSAGES)
+        assert await stream.__anext__() == "一"
+        assert not _slots_free(client)
+        await stream.aclose()
+        assert _slots_free(client)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    test_retry_policy()
+    test_rate_limited_feeds_bucket()
+    test_stream_retries_only_before_first_token()
+    test_astream_retries_only_before_first_token()
+    test_stream_closed_early_releases_slot()
+    print("llm_gateway 测试通过")
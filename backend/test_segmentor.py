@@ -1,10 +1,13 @@
 import os
 import sys
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from langchain_community.document_loaders import PyMuPDFLoader
 
 # Fix the import path
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from rag.segmentor import segment_text
+from backend.rag import segmentor
+from backend.rag.segmentor import segment_text
 
 def test_segmentor_with_pdf(pdf_path, chunk_size=300):
     """Test the custom segmentor with a PDF file"""
@@ -49,7 +52,81 @@ def test_segmentor_with_pdf(pdf_path, chunk_size=300):
         except Exception as e:
             print(f"Error during segmentation: {e}")
 
+def _sample_document(seed, blocks=400):
+    """随机生成包含标题、列表、表格、代码块（含空行）、长段落和 CRLF 换行的文本"""
+    rng = random.Random(seed)
+    words = ["知识图谱", "向量检索", "TensorFlow", "模型", "训练数据", "梯度下降", "。", "，", "；", "（示例）", "!", "?"]
+
+    def sentence(n):
+        return "".join(rng.choice(words) for _ in range(rng.randint(1, n)))
+
+    parts = []
+    for _ in range(blocks):
+        kind = rng.randrange(8)
+        if kind == 0:
+            parts.append("#" * rng.randint(1, 8) + " " + sentence(10))
+        elif kind == 1:
+            parts.append("\n".join(f"{rng.choice(['-', '*', '1.', '•'])} {sentence(20)}" for _ in range(rng.randint(1, 5))))
+        elif kind == 2:
+            parts.append("\n".join(f"| {sentence(5)} | {sentence(5)} |" for _ in range(rng.randint(1, 4))))
+        elif kind == 3:
+            body = "\n\n".join(sentence(30) for _ in range(rng.randint(1, 6)))
+            parts.append(f"```python\n{body}\n```")
+        elif kind == 4:
+            # 超过段落和句子长度上限的长行
+            parts.append(sentence(400))
+        elif kind == 5:
+            parts.append("\r\n".join(sentence(40) for _ in range(rng.randint(1, 4))))
+        else:
+            parts.append(sentence(80))
+        parts.append(rng.choice(["\n\n", "\n\n", "\n", "\n\n\n", "\r\n\r\n"]))
+    return "".join(parts)
+
+
+def _with_small_shards(func):
+    """把分片长度调小，使测试文本跨越多个分片边界"""
+    def wrapper():
+        original = segmentor.SEGMENT_SHARD_CHARS, segmentor.SEGMENT_PARALLEL_MIN_CHARS
+        segmentor.SEGMENT_SHARD_CHARS, segmentor.SEGMENT_PARALLEL_MIN_CHARS = 1500, 3000
+        try:
+            func()
+        finally:
+            segmentor.SEGMENT_SHARD_CHARS, segmentor.SEGMENT_PARALLEL_MIN_CHARS = original
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+@_with_small_shards
+def test_parallel_match_spans_equal_serial():
+    """分片并行扫描得到的匹配区间与单进程 finditer 完全相同"""
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        for seed in range(30):
+            text = _sample_document(seed)
+            for max_length in (100, 300, 1000):
+                seg = segmentor.get_segmenter(max_length)
+                spans = segmentor._parallel_match_spans(text, seg, pool)
+                assert spans is not None, "测试文本应至少有两个分片"
+                assert spans == [match.span() for match in seg.pattern.finditer(text)], (seed, max_length)
+
+
+@_with_small_shards
+def test_parallel_segment_equal_serial():
+    """在进程池上分割的结果与单进程分割相同"""
+    texts = [_sample_document(seed) for seed in range(100, 104)]
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        for text in texts:
+            assert segment_text(text, 300, executor=pool) == segment_text(text, 300)
+        assert segmentor.segment_many(texts, 300, executor=pool) == [segment_text(text, 300) for text in texts]
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--parallel":
+        test_parallel_match_spans_equal_serial()
+        test_parallel_segment_equal_serial()
+        print("并行分割与单进程分割结果一致")
+        sys.exit(0)
+
     # Use the provided PDF path or a default one
     if len(sys.argv) > 1:
         pdf_path = sys.argv[1]